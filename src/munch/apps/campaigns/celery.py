@@ -9,11 +9,16 @@ from munch.core.celery import munch_tasks_router
 
 def register_tasks():
     tasks_map = {
-        'core': ['munch.apps.campaigns.tasks.send_mail'],
+        'core': [
+            'munch.apps.campaigns.tasks.send_mail',
+            'munch.apps.campaigns.tasks.send_mails',
+            'munch.apps.campaigns.tasks.resolve_recipients_domains',
+        ],
         'status': [
             'munch.apps.campaigns.tasks.handle_dsn',
             'munch.apps.campaigns.tasks.handle_fbl',
             'munch.apps.campaigns.tasks.record_status',
+            'munch.apps.campaigns.utils.flush_status_buffer',
             'munch.apps.campaigns.tasks.handle_mail_optout',
         ]
     }
@@ -28,11 +33,14 @@ def configure_worker(instance, **kwargs):
         from .tasks import handle_dsn  # noqa
         from .tasks import handle_fbl  # noqa
         from .utils import record_status  # noqa
+        from .utils import flush_status_buffer  # noqa
         from .tasks import handle_mail_optout  # noqa
         sys.stdout.write('[campaigns-app] Registering worker as STATUS...')
         munch_tasks_router.register_as_worker('status')
 
     if any(t in worker_types for t in ['core', 'all']):
         from .tasks import send_mail  # noqa
+        from .tasks import send_mails  # noqa
+        from .tasks import resolve_recipients_domains  # noqa
         sys.stdout.write('[campaigns-app] Registering worker as CORE...')
         munch_tasks_router.register_as_worker('core')
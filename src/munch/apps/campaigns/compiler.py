@@ -0,0 +1,189 @@
+""" Message bodies compilation
+
+Individual filters (see CAMPAIGNS['*_INDIVIDUAL_FILTERS']) parse and
+serialize the whole body for each recipient, although only a few values
+differ from one recipient to another: the mail identifier (in unsubscribe,
+tracking and redirection urls), the web key (in web view url) and the
+mail-merge fields.
+
+So we run those filters once per message, with markers in place of these
+values, and split the result into static strings and slots. Rendering a
+body for a recipient is then a join.
+"""
+import re
+
+from django.conf import settings
+from django.template.base import tag_re
+from django.utils.module_loading import import_string
+
+from munch.core.mail.utils import mk_base64_uuid
+from munch.apps.tracking.utils import WebKey
+
+from .mailmerge import FieldsTemplate
+from .mailmerge import mailmerge_templates
+
+IDENTIFIER = 'identifier'
+WEB_KEY = 'web_key'
+
+MAILMERGE_FILTER = 'munch.apps.campaigns.contentfilters.apply_mailmerge'
+
+# Filters which handle per-recipient values as opaque strings, and thus
+# give the same output with markers.
+COMPILABLE_FILTERS = frozenset([
+    'munch.apps.optouts.contentfilters.set_unsubscribe_url',
+    'munch.apps.tracking.contentfilters.add_tracking_image',
+    'munch.apps.tracking.contentfilters.rewrite_html_links',
+    'munch.apps.tracking.contentfilters.rewrite_plaintext_links',
+    'munch.apps.hosted.contentfilters.set_web_link_url'])
+
+
+def compact_html(html):
+    """ Remove blank lines and leading/trailing spaces in HTML """
+    for exp in (r'^\s*$', r'^\s+', r'\s+$'):
+        html = re.sub(exp, '', html, flags=re.MULTILINE)
+    return html
+
+
+class CompiledBody:
+    """ A body as a mailmerge.FieldsTemplate, with markers as slots
+
+    Other mail-merge templates are kept as source: rendered as django
+    templates (see mailmerge), then markers are replaced.
+    """
+    def __init__(self, template=None, source=None, markers={}, compact=False):
+        self.template = template
+        self.source = source
+        self.markers = markers
+        # Compact (see compact_html()) after rendering, as fields values may
+        # contain spaces and line breaks.
+        self.compact = compact
+
+    @classmethod
+    def from_text(cls, text, markers, compact=False):
+        """
+        :param markers: the {marker: kind} used to build text
+        :return: a CompiledBody, None if a marker is part of a template tag
+        """
+        tags = tag_re.findall(text)
+        if any(marker in tag for tag in tags for marker in markers):
+            return None
+        if not tags:
+            # Markers (as values) are not spaces, so we can compact now
+            if compact:
+                text = compact_html(text)
+            return cls(FieldsTemplate.parse(text, markers))
+
+        template = FieldsTemplate.parse(text, markers)
+        if template is None:
+            return cls(source=text, markers={
+                marker: kind for marker, kind in markers.items()
+                if marker in text}, compact=compact)
+        return cls(template, compact=compact)
+
+    def get_kinds(self):
+        if self.template is not None:
+            return self.template.get_kinds()
+        return set(self.markers.values())
+
+    def render(self, values, properties):
+        """
+        :param values: {kind: value} for identifier and web_key slots
+        :param properties: mail-merge fields
+        """
+        if self.template is not None:
+            text = self.template.render(properties, values)
+        else:
+            text = mailmerge_templates.get(self.source).render(properties)
+            for marker, kind in self.markers.items():
+                text = text.replace(marker, values[kind])
+        if self.compact:
+            text = compact_html(text)
+        return text
+
+
+class CompiledMessage:
+    def __init__(self, plaintext, html):
+        self.plaintext = plaintext
+        self.html = html
+        self.has_web_key = WEB_KEY in (
+            plaintext.get_kinds() | html.get_kinds())
+
+    def render(self, mail):
+        """
+        :return: (plaintext, html) bodies for mail
+        """
+        values = {IDENTIFIER: mail.identifier}
+        if self.has_web_key:
+            values[WEB_KEY] = WebKey.from_instance(mail.identifier).token
+        properties = mail.properties or {}
+        return (
+            self.plaintext.render(values, properties),
+            self.html.render(values, properties))
+
+
+def get_compilable_filters(settings_key):
+    """ Mail-merge must be the last filter, it is applied at rendering
+
+    :return: the filters to run at compilation, None if some cannot be
+             compiled
+    """
+    filters = settings.CAMPAIGNS.get(settings_key, [])
+    if not filters or filters[-1] != MAILMERGE_FILTER or not (
+            set(filters[:-1]) <= COMPILABLE_FILTERS):
+        return None
+    return filters[:-1]
+
+
+def compile_message(message):
+    """ Compile message bodies
+
+    Slower than rendering them for a single recipient: use it once, and
+    render many.
+
+    :type message: campaigns.models.Message
+    :rtype: CompiledMessage, None if bodies cannot be compiled
+    """
+    from .models import Mail
+
+    plaintext_filters = get_compilable_filters('PLAINTEXT_INDIVIDUAL_FILTERS')
+    html_filters = get_compilable_filters('HTML_INDIVIDUAL_FILTERS')
+    if plaintext_filters is None or html_filters is None:
+        return None
+
+    # Random markers do not appear in message
+    identifier = mk_base64_uuid('slot')
+    web_key = mk_base64_uuid('slot')
+    markers = {identifier: IDENTIFIER}
+    mail = Mail(message=message, identifier=identifier)
+    rewrite_context = message.get_rewrite_context()
+    if message.track_open:
+        markers[web_key] = WEB_KEY
+        web_view_url = mail.mk_web_view_url(web_key)
+    else:
+        web_view_url = mail.mk_web_view_url()
+
+    generation_kwargs = {
+        'track_open': message.track_open,
+        'track_clicks': message.track_clicks,
+        'unsubscribe_url': mail.unsubscribe_url,
+        'app_url': rewrite_context.app_url,
+        'links_map': message.msg_links or {},
+        'rewrite_context': rewrite_context,
+        'mail_properties': {},
+        'mail_identifier': identifier,
+        'no_unsubscribe_placehoder_must_raise': True,
+        'web_view_url': web_view_url
+    }
+
+    def run(text, filters):
+        for func_dotted_path in filters:
+            text = import_string(func_dotted_path)(text, **generation_kwargs)
+        return text
+
+    plaintext = CompiledBody.from_text(
+        run(message.mk_plaintext(), plaintext_filters), markers)
+    html = CompiledBody.from_text(
+        run(message.mk_html(), html_filters), markers, compact=True)
+    if plaintext is None or html is None:
+        return None
+    return CompiledMessage(plaintext, html)
@@ -2,10 +2,10 @@ import lxml.html.clean
 from lxml import etree
 from lxml.html import defs
 from lxml.html import xhtml_to_html
-from django.template import Context
-from django.template import Template
 from premailer import Premailer
 
+from .mailmerge import mailmerge_templates
+
 
 def css_inline_html(html, **kwargs):
     """ Contentfilter to inline CSS into HTML """
@@ -252,5 +252,5 @@ def clean_html(html, **kwargs):
 
 
 def apply_mailmerge(html, mail_properties={}, **kwargs):
-    tpl = Template(html)
-    return tpl.render(Context(mail_properties))
+    """ Contentfilter to render mail properties (see mailmerge) """
+    return mailmerge_templates.get(html).render(mail_properties or {})
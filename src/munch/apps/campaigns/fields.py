@@ -54,6 +54,19 @@ class FSMAutoField(django_fsm.FSMField):
     If no matching transition is found, then we raise a TransitionNotAllowed.
     """
 
+    @staticmethod
+    def get_transition(Model, fieldname, old, new):
+        field = Model._meta.get_field(fieldname)
+        for transition in field.get_all_transitions(Model):
+            if (transition.target == new) and (
+                    transition.source in (old, '*')):
+                return transition
+
+    @classmethod
+    def is_transition_allowed(cls, Model, fieldname, old, new):
+        return (new == old) or (
+            cls.get_transition(Model, fieldname, old, new) is not None)
+
     @staticmethod
     def _fsm_check_transitions(sender, instance, raw, **kwargs):
         fieldname = instance._fsm_state_field
@@ -63,19 +76,12 @@ class FSMAutoField(django_fsm.FSMField):
             new = getattr(instance, fieldname)
             old = getattr(Model.objects.get(pk=instance.pk), fieldname)
             if new != old:
-                field = Model._meta.get_field(fieldname)
-                transitions = field.get_all_transitions(Model)
-
-                relevant_transitions = filter(
-                    lambda t: (t.target == new) and (t.source in (old, '*')),
-                    transitions)
-                try:
-                    transition = list(relevant_transitions)[0]
-                except IndexError:
+                transition = FSMAutoField.get_transition(
+                    Model, fieldname, old, new)
+                if transition is None:
                     raise django_fsm.TransitionNotAllowed(
                         '{} -> {} transition is not allowed'.format(old, new))
-                else:
-                    transition.method(instance)
+                transition.method(instance)
 
     def contribute_to_class(self, cls, name, virtual_only=False):
         super().contribute_to_class(cls, name, virtual_only=False)
@@ -0,0 +1,139 @@
+""" Mail-merge templates
+
+Messages bodies are django templates, rendered with the mail properties as
+context. Most of them only use {{ field }} tags, which FieldsTemplate
+renders without django templates machinery. Others are compiled as django
+templates. Either way, templates are compiled once per source (see
+MailMergeTemplates).
+"""
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.template import Engine
+from django.template import Context
+from django.template import Template
+from django.template.base import tag_re
+from django.template.base import render_value_in_context
+from django.utils.html import conditional_escape
+
+FIELD = 'field'
+
+field_re = re.compile(r'^{{\s*([A-Za-z]\w*)\s*}}$')
+
+# Resolved as literals (not context variables) by django templates
+LITERALS = frozenset(['True', 'False', 'None'])
+
+
+def get_field(tag):
+    """
+    :return: the field name if tag is a {{ field }} tag, None otherwise
+    """
+    match = field_re.match(tag)
+    if match is None or match.group(1) in LITERALS:
+        return None
+    try:
+        # inf, nan... are numbers for django templates
+        float(match.group(1))
+    except ValueError:
+        return match.group(1)
+    return None
+
+
+def render_field(properties, name):
+    """ Renders {{ name }} as django templates do """
+    try:
+        value = properties[name]
+    except KeyError:
+        return Engine.get_default().string_if_invalid
+    if isinstance(value, str):
+        return conditional_escape(value)
+    return render_value_in_context(value, Context(properties))
+
+
+class FieldsTemplate:
+    """ Template with {{ field }} tags only
+
+    A list of static strings and (kind, name) slots, which can be pickled.
+    Fields slots are mail properties, other kinds are given at rendering.
+    """
+    def __init__(self, parts):
+        self.parts = parts
+
+    @classmethod
+    def parse(cls, source, markers={}):
+        """
+        :param markers: {marker: kind} of other slots in source
+        :return: a FieldsTemplate, None if source has other template tags
+        """
+        tokens_re = re.compile('|'.join(
+            [re.escape(marker) for marker in markers] + [tag_re.pattern]))
+        parts, start = [], 0
+        for match in tokens_re.finditer(source):
+            token = match.group(0)
+            if token in markers:
+                slot = (markers[token], None)
+            else:
+                name = get_field(token)
+                if name is None:
+                    return None
+                slot = (FIELD, name)
+            parts.extend([source[start:match.start()], slot])
+            start = match.end()
+        parts.append(source[start:])
+        return cls([part for part in parts if part != ''])
+
+    def get_kinds(self):
+        return {part[0] for part in self.parts if not isinstance(part, str)}
+
+    def render(self, properties, values={}):
+        """
+        :param properties: mail properties, for fields
+        :param values: {kind: value} for other slots
+        """
+        out = []
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+            elif part[0] == FIELD:
+                out.append(render_field(properties, part[1]))
+            else:
+                out.append(values[part[0]])
+        return ''.join(out)
+
+
+class DjangoTemplate:
+    """ Same interface as FieldsTemplate, for other templates """
+    def __init__(self, source):
+        self.template = Template(source)
+
+    def render(self, properties):
+        return self.template.render(Context(properties))
+
+
+class MailMergeTemplates:
+    """ Bounded LRU cache of compiled mail-merge templates, by source digest
+
+    Only FieldsTemplate can be pickled (and shared with other processes, see
+    compiler.CompiledMessage).
+    """
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.templates = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, source):
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        with self.lock:
+            template = self.templates.pop(key, None)
+        if template is None:
+            template = FieldsTemplate.parse(source) or DjangoTemplate(source)
+        with self.lock:
+            self.templates[key] = template
+            if len(self.templates) > self.max_size:
+                self.templates.popitem(last=False)
+        return template
+
+
+mailmerge_templates = MailMergeTemplates()
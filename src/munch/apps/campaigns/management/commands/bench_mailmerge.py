@@ -0,0 +1,49 @@
+import time
+
+from django.template import Context
+from django.template import Template
+from django.core.management.base import BaseCommand
+
+from ...contentfilters import apply_mailmerge
+
+PROPERTIES = {'first_name': 'Jeanne', 'last_name': 'Doe', 'city': 'Paris'}
+SOURCES = [
+    ('fields', '<p>Hi {{ first_name }} {{ last_name }}</p>\n'),
+    ('django', '<p>Hi {{ first_name|upper }}{% if city %} from '
+               '{{ city }}{% endif %}</p>\n')]
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure mail-merge throughput, compiling templates for each mail '
+        'and with cached templates.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size', dest='size', type=int, default=50,
+            help='Template size in KB (default: 50)')
+        parser.add_argument(
+            '--iterations', dest='iterations', type=int, default=200)
+
+    def timeit(self, render, source, iterations):
+        render(source)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            render(source)
+        return iterations / (time.perf_counter() - start)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        for name, chunk in SOURCES:
+            source = chunk * (options['size'] * 1024 // len(chunk) + 1)
+            uncached = self.timeit(
+                lambda source: Template(source).render(Context(PROPERTIES)),
+                source, iterations)
+            cached = self.timeit(
+                lambda source: apply_mailmerge(
+                    source, mail_properties=PROPERTIES),
+                source, iterations)
+            self.stdout.write(
+                '{:>6} template: uncached {:8.0f} mails/s, '
+                'cached {:8.0f} mails/s ({:.1f}x)'.format(
+                    name, uncached, cached, cached / uncached))
@@ -0,0 +1,60 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from ...models import Mail
+from ...models import Message
+from ...models import get_base_mail_identifier
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure per-recipient rendering of a message bodies, with '
+        'individual filters and compiled. Mails are built in memory, '
+        'nothing is written to the database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('message', type=int, help='Message pk')
+        parser.add_argument(
+            '--recipients', dest='recipients', type=int, default=500)
+
+    def timeit(self, render, mails):
+        start = time.perf_counter()
+        for mail in mails:
+            render(mail)
+        return len(mails) / (time.perf_counter() - start)
+
+    def handle(self, *args, **options):
+        try:
+            message = Message.objects.select_related(
+                'author__organization', 'category').get(
+                    pk=options['message'])
+        except Message.DoesNotExist:
+            raise CommandError('No message #{}'.format(options['message']))
+
+        properties = {}
+        mail = message.mails.first()
+        if mail is not None:
+            properties = mail.properties or {}
+        mails = [
+            Mail(
+                message=message, identifier=get_base_mail_identifier(),
+                recipient='bench-{}@example.com'.format(i),
+                properties=properties)
+            for i in range(options['recipients'])]
+
+        start = time.perf_counter()
+        compiled = message.get_compiled()
+        if compiled is None:
+            raise CommandError('Message #{} cannot be compiled'.format(
+                message.pk))
+        self.stdout.write('Compiled in {:.2f} ms'.format(
+            (time.perf_counter() - start) * 1000))
+
+        filtered = self.timeit(message.filter_body, mails)
+        rendered = self.timeit(compiled.render, mails)
+        self.stdout.write(
+            'Filters {:8.0f} recipients/s, compiled {:8.0f} '
+            'recipients/s ({:.1f}x)'.format(
+                filtered, rendered, rendered / filtered))
@@ -2,6 +2,7 @@ import logging
 import datetime
 
 from django.db import models
+from django.db import connection
 from django.db.models import F
 from django.db.models import Max
 from django.db.models import Min
@@ -79,40 +80,80 @@ class MailManager(Manager):
 
 
 class MailQuerySet(OwnedModelQuerySet, BaseMailQuerySet):
-    def _legit_exclusionlist(
+    def _legit_exclusions(
             self, message, include_bounces=False, include_optouts=False):
-        from .models import OptOut
+        """ SQL subqueries finding why a recipient must not get message
 
-        exclusion_list = []
+        Opt-outs are looked up by (NOT) EXISTS subqueries rather than
+        listed, so that the query size does not depend on how many there
+        are, and the database can use anti-joins.
 
+        :return: a list of (sql, params)
+        """
+        from .models import OptOut
+        from munch.apps.users.models import MunchUser
+
+        qn = connection.ops.quote_name
+        names = {
+            'recipient': '{}.{}'.format(
+                qn(self.model._meta.db_table),
+                qn(self.model._meta.get_field('recipient').column)),
+            'optouts': qn(OptOut._meta.db_table),
+            'users': qn(MunchUser._meta.db_table),
+            'munchuser_id': qn(MunchUser._meta.pk.column),
+        }
+        for model, field in [
+                (OptOut, 'address'), (OptOut, 'origin'),
+                (OptOut, 'category'), (OptOut, 'author'),
+                (MunchUser, 'organization')]:
+            names['{}_{}'.format(model._meta.model_name, field)] = qn(
+                model._meta.get_field(field).column)
+
+        subqueries = []
         if not include_bounces:
-            exclusion_list += OptOut.objects.filter(
-                origin=OptOut.BY_BOUNCE).values_list('address', flat=True)
+            subqueries.append((
+                'SELECT 1 FROM {optouts} o '
+                'WHERE o.{optout_address} = {recipient} '
+                'AND o.{optout_origin} = %s', [OptOut.BY_BOUNCE]))
 
         if not include_optouts:
             # If we define a category, the optouts are valid in this category
             # and thats all.
             if message.category:
-                exclusion_list += OptOut.objects.exclude(
-                    origin=OptOut.BY_BOUNCE).filter(
-                        category=message.category).values_list(
-                            'address', flat=True)
+                subqueries.append((
+                    'SELECT 1 FROM {optouts} o '
+                    'WHERE o.{optout_address} = {recipient} '
+                    'AND o.{optout_origin} <> %s '
+                    'AND o.{optout_category} = %s',
+                    [OptOut.BY_BOUNCE, message.category_id]))
             else:
-                organization = message.author.organization
-                exclusion_list += OptOut.objects.exclude(
-                    origin=OptOut.BY_BOUNCE).filter(
-                        author__organization=organization).values_list(
-                            'address', flat=True)
+                subqueries.append((
+                    'SELECT 1 FROM {optouts} o '
+                    'INNER JOIN {users} u '
+                    'ON u.{munchuser_id} = o.{optout_author} '
+                    'WHERE o.{optout_address} = {recipient} '
+                    'AND o.{optout_origin} <> %s '
+                    'AND u.{munchuser_organization} = %s',
+                    [OptOut.BY_BOUNCE, message.author.organization_id]))
 
-        return exclusion_list
+        return [(sql.format(**names), params) for sql, params in subqueries]
 
     def legit_for(self, *args, **kwargs):
-        return self.exclude(
-            recipient__in=self._legit_exclusionlist(*args, **kwargs))
+        exclusions = self._legit_exclusions(*args, **kwargs)
+        if not exclusions:
+            return self.all()
+        return self.extra(
+            where=['NOT EXISTS ({})'.format(sql) for sql, _ in exclusions],
+            params=[param for _, params in exclusions for param in params])
 
     def not_legit_for(self, *args, **kwargs):
-        return self.filter(
-            recipient__in=self._legit_exclusionlist(*args, **kwargs))
+        exclusions = self._legit_exclusions(*args, **kwargs)
+        if not exclusions:
+            return self.none()
+        return self.extra(
+            where=[' OR '.join(
+                'EXISTS ({})'.format(sql) for sql, _ in exclusions)],
+            params=[param for _, params in exclusions for param in params])
 
     def with_bounds(self):
         return self.annotate(
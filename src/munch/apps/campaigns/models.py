@@ -1,9 +1,9 @@
 import html
 import email
 import magic
+import hashlib
 import urllib
 import logging
-import re
 from os.path import join
 from base64 import b64encode
 
@@ -15,6 +15,8 @@ import celery
 import django.core.mail.message
 from django.conf import settings
 from django.db import models
+from django.db import connection
+from django.core.cache import cache
 from django.db import transaction
 from django.utils import timezone
 from django.urls import reverse
@@ -25,6 +27,7 @@ from django.contrib.postgres.fields import JSONField
 from django.contrib.postgres.fields import HStoreField
 from django.template.loader import render_to_string
 from django_fsm import transition
+from django_fsm import TransitionNotAllowed
 from slimta.envelope import Envelope
 
 from munch.core.models import Category
@@ -33,6 +36,7 @@ from munch.core.utils import save_timer
 from munch.core.utils.models import AbstractOwnedModel
 from munch.core.mail.utils import mk_base64_uuid
 from munch.core.mail.utils import mk_msgid
+from munch.core.mail.utils import UrlTemplate
 from munch.core.mail.utils.emails import NotificationMessage
 from munch.core.mail.models import AbstractMail
 from munch.core.mail.models import AbstractMailStatus
@@ -46,10 +50,13 @@ from munch.apps.users.models import MunchUser
 from munch.apps.optouts.models import OptOut
 from munch.apps.tracking.utils import WebKey
 from munch.apps.tracking.utils import get_msg_links
+from munch.apps.tracking.utils import RewriteContext
 from munch.apps.tracking.models import TrackRecord
 from munch.apps.tracking.models import READ_BROWSER
 
 from .fields import FSMAutoField
+from .compiler import compact_html
+from .compiler import compile_message
 from .validators import slug_regex_validator
 from .exceptions import WrongHTML
 from .managers import MailManager
@@ -104,6 +111,22 @@ class MailStatus(AbstractOwnedModel, AbstractMailStatus):
         super().save(*args, **kwargs)
         self.update_message_status()
 
+    @classmethod
+    def post_bulk_record(cls, statuses):
+        super().post_bulk_record(statuses)
+        # Only check once per message for remaining mails
+        by_message = {}
+        for mailstatus in statuses:
+            if mailstatus.mail.curstatus in cls.FINAL_STATES:
+                by_message[mailstatus.mail.message_id] = mailstatus
+        for mailstatus in by_message.values():
+            try:
+                mailstatus.update_message_status()
+            except Exception:
+                log.exception(
+                    '[{}] Failed to update message status'.format(
+                        mailstatus.mail.identifier))
+
 
 class TolerantForeignKey(models.ForeignKey):
     """ A ForeignKey which can point to an unsaved object
@@ -118,6 +141,24 @@ def get_base_mail_identifier():
     return mk_base64_uuid('c-')
 
 
+class MessageRewriteContext(RewriteContext):
+    """ RewriteContext, plus the urls of the message mails """
+    def __init__(self, message):
+        app_url = message.get_app_url()
+        super().__init__(app_url, message.msg_links)
+        self.key = message.get_rewrite_context_key()
+        self.abuse_url = UrlTemplate(
+            lambda identifier: urllib.parse.urljoin(app_url, reverse(
+                'abuse-report', kwargs={'identifier': identifier})),
+            'identifier')
+        self.unsubscribe_url = UrlTemplate(
+            lambda identifier: urllib.parse.urljoin(app_url, reverse(
+                'unsubscribe', kwargs={'identifier': identifier})),
+            'identifier')
+        self.web_view_url = urllib.parse.urljoin(app_url, reverse(
+            'message_web_view', kwargs={'identifier': message.identifier}))
+
+
 class BaseMail(AbstractOwnedModel, AbstractMail):
     identifier = models.CharField(
         max_length=35, db_index=True, unique=True,
@@ -149,6 +190,18 @@ class BaseMail(AbstractOwnedModel, AbstractMail):
     def get_organization(self):
         return self.message.author.organization
 
+    def can_switch_status(self, status):
+        return FSMAutoField.is_transition_allowed(
+            self.__class__, 'curstatus', self.curstatus, status)
+
+    def check_status_transition(self, status):
+        # Mail is not saved by statuses, so pre_save transitions checks
+        # (see FSMAutoField) do not apply
+        if not self.can_switch_status(status):
+            raise TransitionNotAllowed(
+                '{} -> {} transition is not allowed'.format(
+                    self.curstatus, status))
+
     def get_category(self):
         if self.message.category:
             return self.message.category
@@ -171,29 +224,27 @@ class BaseMail(AbstractOwnedModel, AbstractMail):
 
     @property
     def abuse_url(self):
-        relative_url = reverse(
-            'abuse-report', kwargs={'identifier': self.identifier})
-        return urllib.parse.urljoin(self.message.get_app_url(), relative_url)
+        return self.message.get_rewrite_context().abuse_url.format(
+            identifier=self.identifier)
 
     @property
     def unsubscribe_url(self):
-        relative_url = reverse(
-            'unsubscribe', kwargs={'identifier': self.identifier})
-        return urllib.parse.urljoin(self.message.get_app_url(), relative_url)
+        return self.message.get_rewrite_context().unsubscribe_url.format(
+            identifier=self.identifier)
 
     @property
     def web_view_url(self):
-        relative_url = reverse(
-            'message_web_view', kwargs={'identifier': self.message.identifier})
-
-        abs_url = urllib.parse.urljoin(
-            self.message.get_app_url(), relative_url)
-
         if self.message.track_open:
-            return abs_url + '?web_key={}'.format(
+            return self.mk_web_view_url(
                 WebKey.from_instance(self.identifier).token)
         else:
-            return abs_url
+            return self.mk_web_view_url()
+
+    def mk_web_view_url(self, web_key=None):
+        abs_url = self.message.get_rewrite_context().web_view_url
+        if web_key:
+            return abs_url + '?web_key={}'.format(web_key)
+        return abs_url
 
     def as_message(self, with_body=True):
         return self.message.to_mail(self, with_body=with_body)
@@ -328,6 +379,10 @@ class Message(ValidationSignalsModel, AbstractOwnedModel):
         (SENDING, _('Sending')),
         (SENT, _('Sent')))
 
+    # Sending progress, updated by sending tasks
+    SENDING_PROGRESS_KEY = 'campaigns:message:{}:sending:{}'
+    SENDING_PROGRESS_TTL = 3600 * 24 * 7
+
     # Identifier is used as a key for public URLs.
     identifier = models.CharField(
         max_length=35, db_index=True, unique=True, editable=False,
@@ -427,6 +482,23 @@ class Message(ValidationSignalsModel, AbstractOwnedModel):
             domain=self.get_sending_domain(),
             organization=self.get_organization())
 
+    def get_rewrite_context_key(self):
+        return (
+            self.identifier, self.sender_email, self.author_id,
+            sorted((self.msg_links or {}).items()))
+
+    def get_rewrite_context(self):
+        """ Resolved app url, links map and url templates of mails
+
+        Built once, unless sender or links change.
+
+        :rtype: MessageRewriteContext
+        """
+        context = self.__dict__.get('_rewrite_context')
+        if context is None or context.key != self.get_rewrite_context_key():
+            context = self._rewrite_context = MessageRewriteContext(self)
+        return context
+
     def willsend_addresses(self):
         return self.mails.legit_for(self).values_list('recipient', flat=True)
 
@@ -527,12 +599,34 @@ class Message(ValidationSignalsModel, AbstractOwnedModel):
 
     @save_timer(name='campaigns.Message.mk_body')
     def mk_body(self, mail):
+        # Use max line length from RFC2822 (78) instead of RFC5322 (998)
+        # to force conversion to quoted-printable in almost all cases
+        # The idea is to avoid anarchic line-breaks in 7bits
+        # formatted mails which cause bad display of some utf-8 characters
+        # on some webmails.
+        # Note: this might cause problems in non-western character sets...
+        django.core.mail.message.RFC5322_EMAIL_LINE_LENGTH_LIMIT = 78
+
+        # Links of test mails are not rewritten (see tracking filters)
+        if not mail.identifier.startswith('test'):
+            compiled = self.get_compiled()
+            if compiled is not None:
+                return compiled.render(mail)
+        return self.filter_body(mail)
+
+    def filter_body(self, mail):
+        """ Runs individual filters on message bodies, for mail
+
+        See get_compiled() for a faster way to get the same result.
+        """
+        rewrite_context = self.get_rewrite_context()
         generation_kwargs = {
             'track_open': self.track_open,
             'track_clicks': self.track_clicks,
             'unsubscribe_url': mail.unsubscribe_url,
-            'app_url': self.get_app_url(),
+            'app_url': rewrite_context.app_url,
             'links_map': self.msg_links or {},
+            'rewrite_context': rewrite_context,
             'mail_properties': mail.properties,
             'mail_identifier': mail.identifier,
             'no_unsubscribe_placehoder_must_raise': True,
@@ -545,21 +639,62 @@ class Message(ValidationSignalsModel, AbstractOwnedModel):
         html = post_individual_html_generation.process(
             self.mk_html(), **generation_kwargs)
 
-        # Use max line length from RFC2822 (78) instead of RFC5322 (998)
-        # to force conversion to quoted-printable in almost all cases
-        # The idea is to avoid anarchic line-breaks in 7bits
-        # formatted mails which cause bad display of some utf-8 characters
-        # on some webmails.
-        # Note: this might cause problems in non-western character sets...
-        django.core.mail.message.RFC5322_EMAIL_LINE_LENGTH_LIMIT = 78
         # Also remove blank lines and leading/trailing spaces in HTML
         # content to make generated body more concise
-        for exp in (r'^\s*$', r'^\s+', r'\s+$'):
-            html = re.sub(exp, '', html, flags=re.MULTILINE)
+        return plaintext, compact_html(html)
 
-        return plaintext, html
+    def get_compiled(self):
+        """ Message bodies, compiled once per message version
+
+        :rtype: compiler.CompiledMessage, None if they cannot be compiled
+        """
+        digest = hashlib.sha1(repr((
+            self.track_open, self.track_clicks,
+            sorted((self.msg_links or {}).items()),
+            self.get_rewrite_context().app_url,
+            settings.CAMPAIGNS['HTML_INDIVIDUAL_FILTERS'],
+            settings.CAMPAIGNS['PLAINTEXT_INDIVIDUAL_FILTERS'])).encode(
+                'utf-8')).hexdigest()
+        # False is cached, not None
+        return self.get_rendered(
+            'compiled:{}'.format(digest),
+            lambda: compile_message(self) or False) or None
+
+    def get_render_key(self):
+        """ Cache key of template-level renderings of this message version
+        """
+        digest = hashlib.sha1(repr((
+            self.html, self.detach_images, self.author.organization_id,
+            settings.CAMPAIGNS['HTML_TEMPLATE_FILTERS'])).encode(
+                'utf-8')).hexdigest()
+        return 'campaigns:message:{}:render:{}'.format(self.pk, digest)
+
+    def get_rendered(self, name, render):
+        """ Template-level renderings are the same for every recipient
+
+        They are computed once per message version, then kept on the
+        instance and in cache (for other processes).
+        """
+        key = '{}:{}'.format(self.get_render_key(), name)
+        rendered = self.__dict__.setdefault('_rendered', {})
+        if key not in rendered:
+            value = cache.get(key) if self.pk else None
+            if value is None:
+                value = render()
+                if self.pk:
+                    cache.set(key, value, settings.CAMPAIGNS.get(
+                        'RENDER_CACHE_TTL', 3600 * 24))
+            rendered[key] = value
+        return rendered[key]
 
     def mk_plaintext(self):
+        return self.get_rendered('plaintext', self.render_plaintext)
+
+    def mk_html(self):
+        """ See render_html() """
+        return self.get_rendered('html', self.render_html)
+
+    def render_plaintext(self):
         try:
             h = html2text.HTML2Text()
             h.ignore_images = True
@@ -576,7 +711,7 @@ class Message(ValidationSignalsModel, AbstractOwnedModel):
 
         return h.handle(self.mk_html())
 
-    def mk_html(self):
+    def render_html(self):
         """Simply calls configured html template filters
 
         See settings.CAMPAIGNS['HTML_TEMPLATE_FILTERS']
@@ -656,17 +791,23 @@ class Message(ValidationSignalsModel, AbstractOwnedModel):
             message.send()
 
     def start_sending(self):
-        from .tasks import send_mail
+        from .tasks import send_mails
+        from .tasks import resolve_recipients_domains
 
         with transaction.atomic():
-            # Then, handle all ignored emails (optouts)
+            # First, handle all ignored emails (optouts)
+            optouts = self.get_related_optouts()
             now = timezone.now()
-            for i in self.mails.not_legit_for(self):
-                MailStatus.objects.create(
-                    mail=i, status=MailStatus.IGNORED,
-                    creation_date=timezone.now(),
+            ignored = [
+                (identifier, MailStatus(
+                    status=MailStatus.IGNORED, creation_date=now,
                     raw_msg='Ignored because of previous optout {}'.format(
-                        i.get_related_optout()))
+                        optouts.get(recipient))))
+                for identifier, recipient in self.mails.not_legit_for(
+                    self).values_list('identifier', 'recipient').iterator()]
+            batch_size = 1000
+            for i in range(0, len(ignored), batch_size):
+                MailStatus.objects.bulk_record(ignored[i:i + batch_size])
 
             # Then, handle the legit ones
             if not self.send_date:
@@ -675,21 +816,96 @@ class Message(ValidationSignalsModel, AbstractOwnedModel):
             self.notify(Message.SENDING)
             # locking ?
             legit_mails = self.mails.legit_for(self)
+            legit_pks = list(
+                legit_mails.order_by('pk').values_list('pk', flat=True))
             now = timezone.now()
             MailStatus.objects.bulk_create([
                 MailStatus(
-                    mail=i, status=MailStatus.QUEUED,
+                    mail_id=pk, status=MailStatus.QUEUED,
                     creation_date=now, raw_msg='Enqueued in celery')
-                for i in legit_mails])
+                for pk in legit_pks])
             # bulk_create do not update Mail (too high db cost)
             legit_mails.update(
                 curstatus=MailStatus.QUEUED, latest_status_date=now)
             # end_locking ?
-            tasks = celery.group([send_mail.s(m.pk) for m in legit_mails])
-            log.info('Starting sending {} (#{}) to {} recipients.'.format(
-                self, self.pk, len(tasks)))
 
-        tasks.apply_async()
+            # Each task sends a range of mails
+            chunk_size = settings.CAMPAIGNS.get('SEND_CHUNK_SIZE', 1000)
+            chunks = [
+                legit_pks[i:i + chunk_size]
+                for i in range(0, len(legit_pks), chunk_size)]
+            # Sending tasks will find recipients domains MX records in cache
+            # (immutable signatures: chained tasks get no parent result)
+            tasks = celery.chain(
+                resolve_recipients_domains.si(self.pk),
+                celery.group([
+                    send_mails.si(self.pk, chunk[0], chunk[-1])
+                    for chunk in chunks]))
+            self.init_sending_progress(len(legit_pks))
+            log.info(
+                'Starting sending {} (#{}) to {} recipients '
+                '({} tasks).'.format(
+                    self, self.pk, len(legit_pks), len(chunks)))
+
+        if chunks:
+            tasks.apply_async()
+
+    def get_related_optouts(self):
+        """ OptOuts (on any mail) of this message recipients, by address
+
+        See Mail.get_related_optout()
+        """
+        if self.category:
+            qs = OptOut.objects.filter(category=self.category)
+        else:
+            qs = OptOut.objects.filter(
+                author__organization=self.author.organization)
+        # Rather than listing recipients (see MailQuerySet.legit_for())
+        qn = connection.ops.quote_name
+        qs = qs.extra(
+            where=[
+                'EXISTS (SELECT 1 FROM {mails} m WHERE m.{recipient} = '
+                '{optouts}.{address} AND m.{message} = %s)'.format(
+                    mails=qn(Mail._meta.db_table),
+                    recipient=qn(Mail._meta.get_field('recipient').column),
+                    message=qn(Mail._meta.get_field('message').column),
+                    optouts=qn(OptOut._meta.db_table),
+                    address=qn(OptOut._meta.get_field('address').column))],
+            params=[self.pk])
+        if not qs.ordered:
+            qs = qs.order_by('pk')
+
+        optouts = {}
+        for optout in qs.iterator():
+            optouts.setdefault(optout.address, optout)
+        return optouts
+
+    def init_sending_progress(self, total):
+        cache.set_many({
+            self.SENDING_PROGRESS_KEY.format(self.pk, 'total'): total,
+            self.SENDING_PROGRESS_KEY.format(self.pk, 'done'): 0},
+            self.SENDING_PROGRESS_TTL)
+
+    def add_sending_progress(self, count):
+        try:
+            cache.incr(
+                self.SENDING_PROGRESS_KEY.format(self.pk, 'done'), count)
+        except ValueError:
+            # Expired
+            pass
+
+    def get_sending_progress(self):
+        """ (mails handed to the backend or ignored, mails to send)
+
+        None if no sending started lately.
+        """
+        keys = [
+            self.SENDING_PROGRESS_KEY.format(self.pk, name)
+            for name in ('done', 'total')]
+        values = cache.get_many(keys)
+        if len(values) < 2:
+            return None
+        return tuple(values[key] for key in keys)
 
     def has_no_msg_issues(self):
         return not self.has_msg_issues()
@@ -3,6 +3,7 @@ import email
 from email.utils import parseaddr
 
 import django_fsm
+from celery import task
 from django.utils.timezone import now as utc_now
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.exceptions import ValidationError
@@ -18,6 +19,8 @@ from munch.core.mail.models import unsubscribe_parser
 from munch.core.mail.exceptions import RejectForbiddenTransition
 from munch.apps.optouts.models import OptOut
 
+from .validators import mx_resolver
+from .validators import get_recipient_domain
 from .validators import validate_existing_mail_domain
 
 from .models import Mail
@@ -28,6 +31,14 @@ from .models import Message
 log = logging.getLogger(__name__)
 
 
+def get_backend():
+    # explicitly gets the backend asking for systematic DSN.
+    return Backend(
+        mailstatus_class_path='munch.apps.campaigns.models.MailStatus',
+        build_envelope_task_path='munch.apps.campaigns.utils.get_envelope',
+        record_status_task_path='munch.apps.campaigns.utils.record_status')
+
+
 @task_autoretry(
     autoretry_on=(Exception, ),
     default_retry_delay=60 * 3,
@@ -52,18 +63,101 @@ def send_mail(mail_pk):
     else:
         log.info('[{}] Queueing email for recipient {}'.format(
             m.identifier, m.recipient))
-        # explicitly gets the backend asking for systematic DSN.
-        backend = Backend(
-            mailstatus_class_path='munch.apps.campaigns.models.MailStatus',
-            build_envelope_task_path=(
-                'munch.apps.campaigns.utils.get_envelope'),
-            record_status_task_path=(
-                'munch.apps.campaigns.utils.record_status'))
-        backend.send_message(
+        get_backend().send_message(
             m.identifier, m.recipient, m.get_headers(), attempts=0)
         return 'Sent {}'.format(m.pk)
 
 
+@task
+def resolve_recipients_domains(message_pk):
+    """ Resolve MX records of the queued recipients domains of a message
+
+    First step of sending (see Message.start_sending()), so that send_mails
+    tasks find them in cache. It never fails: send_mails resolves missing
+    domains anyway.
+    """
+    try:
+        recipients = Mail.objects.filter(
+            message_id=message_pk, curstatus=MailStatus.QUEUED).values_list(
+                'recipient', flat=True)
+        checked = mx_resolver.check(
+            get_recipient_domain(recipient)
+            for recipient in recipients.iterator())
+        log.info('Resolved {} recipients domains of message #{}'.format(
+            len(checked), message_pk))
+    except Exception:
+        log.warning(
+            'Could not resolve recipients domains of message #{}'.format(
+                message_pk), exc_info=True)
+
+
+@task_autoretry(
+    autoretry_on=(Exception, ),
+    default_retry_delay=60 * 3,
+    max_retries=(2 * 7 * 24 * 60 * 60) / 180,
+    retry_message='Error while trying to send emails. Retrying')
+def send_mails(message_pk, min_pk, max_pk):
+    """ Send queued mails of a message, within a range of mail pks
+
+    Mails are loaded at once and share their message. Mails of domains
+    without MX record are ignored (in bulk) before anything is sent, so
+    that retrying does not send twice. A mail that could not be handed to
+    the backend is sent again alone, by send_mail.
+    """
+    message = Message.objects.select_related(
+        'author__organization', 'category').get(pk=message_pk)
+    mails = list(Mail.objects.filter(
+        message=message, pk__range=(min_pk, max_pk),
+        curstatus=MailStatus.QUEUED).order_by('pk'))
+
+    # Pre-resolved by resolve_recipients_domains, most likely in cache
+    checked = mx_resolver.check(
+        get_recipient_domain(mail.recipient) for mail in mails)
+    ignored = []
+    to_send = []
+    for mail in mails:
+        mail.message = message
+        try:
+            # Check if the recipient's domain has a MX record
+            validate_existing_mail_domain(mail.recipient, checked)
+        except ValidationError as exc:
+            log.info('[{}] Ignored recipient {}, MX check failed'.format(
+                mail.identifier, mail.recipient))
+            ignored.append((mail.identifier, MailStatus(
+                status=MailStatus.IGNORED, creation_date=utc_now(),
+                raw_msg=exc)))
+        else:
+            to_send.append(mail)
+    MailStatus.objects.bulk_record(ignored)
+
+    backend = get_backend()
+    for mail in to_send:
+        log.info('[{}] Queueing email for recipient {}'.format(
+            mail.identifier, mail.recipient))
+        try:
+            backend.send_message(
+                mail.identifier, mail.recipient, mail.get_headers(),
+                attempts=0)
+        except Exception:
+            log.warning(
+                '[{}] Error while queueing email, sending it alone'.format(
+                    mail.identifier), exc_info=True)
+            send_mail.apply_async([mail.pk])
+
+    # Mails are handed to the backend: failing now would send them twice
+    try:
+        message.add_sending_progress(len(mails))
+        progress = message.get_sending_progress()
+    except Exception:
+        log.warning(
+            'Unable to record sending progress of {} (#{})'.format(
+                message, message.pk), exc_info=True)
+        progress = None
+    log.info('Sent {} and ignored {} mails of {} (#{}), {}/{} done'.format(
+        len(to_send), len(ignored), message, message.pk,
+        *(progress or ('?', '?'))))
+
+
 @task_autoretry(
     default_retry_delay=60 * 30, max_retries=6 * 24 * 5,
     autoretry_on=(Exception, ), acks_late=True)
@@ -0,0 +1,109 @@
+import re
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from munch.apps.users.tests.factories import UserFactory
+
+from ..mailmerge import FIELD
+from ..compiler import IDENTIFIER
+from ..compiler import compile_message
+from .factories import MailFactory
+from .factories import MessageFactory
+
+web_key_re = re.compile(r'web_key=[^"\s]+')
+
+HTML = """<html><body>
+<h1>Hello {{{{ first_name }}}}</h1>
+<p>
+    Our <a href="http://example.com/news">news</a>, or
+    <a href="http://example.com/shop?ref=mail">shop</a>.
+</p>
+<p><a href="{}">Web version</a> - <a href="{}">Unsubscribe</a></p>
+</body></html>
+""".format(
+    settings.HOSTED['WEB_LINK_PLACEHOLDER'],
+    settings.OPTOUTS['UNSUBSCRIBE_PLACEHOLDER'])
+
+
+@override_settings(SKIP_SPAM_CHECK=True, BYPASS_DNS_CHECKS=True)
+class CompilerTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.message = MessageFactory(
+            author=UserFactory(), html=HTML,
+            track_open=True, track_clicks=True)
+
+    def mk_mail(self, **properties):
+        return MailFactory(message=self.message, properties=properties)
+
+    def assertSameBodies(self, mail):
+        compiled = self.message.mk_body(mail)
+        filtered = self.message.filter_body(mail)
+        # Web keys are timestamped
+        self.assertEqual(
+            [web_key_re.sub('', body) for body in compiled],
+            [web_key_re.sub('', body) for body in filtered])
+        return compiled
+
+    def test_slots(self):
+        compiled = compile_message(self.message)
+        slots = [
+            p for p in compiled.html.template.parts if not isinstance(p, str)]
+        # Unsubscribe url, 2 tracked links and tracking image
+        self.assertEqual(slots.count((IDENTIFIER, None)), 4)
+        self.assertIn((FIELD, 'first_name'), slots)
+        self.assertTrue(compiled.has_web_key)
+
+    def test_same_bodies(self):
+        mail = self.mk_mail(first_name='Jeanne')
+        plaintext, html = self.assertSameBodies(mail)
+        self.assertIn('Hello Jeanne', html)
+        self.assertIn(mail.identifier, html)
+        self.assertIn(mail.identifier, plaintext)
+
+    def test_same_bodies_escaped_fields(self):
+        self.assertIn(
+            'Hello &lt;b&gt;',
+            self.assertSameBodies(self.mk_mail(first_name='<b>'))[1])
+        self.assertSameBodies(self.mk_mail(first_name='\n  Jo  \n'))
+        self.assertSameBodies(self.mk_mail())
+
+    def test_same_bodies_complex_mailmerge(self):
+        self.message.html = HTML.replace(
+            '{{ first_name }}',
+            '{% if first_name %}{{ first_name|upper }}{% endif %}')
+        self.assertIsNone(compile_message(self.message).html.template)
+        html = self.assertSameBodies(self.mk_mail(first_name='Jeanne'))[1]
+        self.assertIn('Hello JEANNE', html)
+
+    def test_same_bodies_no_tracking(self):
+        self.message.track_open = False
+        self.message.track_clicks = False
+        self.assertFalse(compile_message(self.message).has_web_key)
+        self.assertSameBodies(self.mk_mail(first_name='Jeanne'))
+
+    def test_compiled_once(self):
+        self.message.mk_body(self.mk_mail())
+        compiled = self.message.get_compiled()
+        self.message.mk_body(self.mk_mail())
+        self.assertIs(self.message.get_compiled(), compiled)
+
+    def test_unknown_filter_not_compiled(self):
+        filters = settings.CAMPAIGNS['HTML_INDIVIDUAL_FILTERS'] + [
+            'munch.apps.campaigns.contentfilters.clean_html']
+        with self.settings(CAMPAIGNS=dict(
+                settings.CAMPAIGNS, HTML_INDIVIDUAL_FILTERS=filters)):
+            self.assertIsNone(compile_message(self.message))
+
+    def test_rendering_runs_no_filter(self):
+        self.message.mk_body(self.mk_mail())
+        with patch(
+                'munch.apps.campaigns.models.'
+                'post_individual_html_generation.process') as process:
+            html = self.message.mk_body(self.mk_mail(first_name='Jeanne'))[1]
+        process.assert_not_called()
+        self.assertIn('Hello Jeanne', html)
@@ -1,7 +1,17 @@
+from unittest.mock import patch
+from unittest.mock import MagicMock
+
+import dns.exception
+import dns.resolver
+from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.utils import override_settings
 from django.core.exceptions import ValidationError
 
+from ..validators import mx_resolver
+from ..validators import get_recipient_domain
+from ..validators import validate_existing_mail_domain
 from .factories import MailFactory
 from .factories import MessageFactory
 from munch.apps.users.tests.factories import UserFactory
@@ -44,3 +54,69 @@ class MailValidatorTest(TestCase):
             message=message, recipient='test@example.com')
         mail.full_clean()
         message.save()
+
+
+def mk_mx_answer(ttl=300):
+    answer = MagicMock()
+    answer.rrset.ttl = ttl
+    return answer
+
+
+def query_mx(domain, rdtype):
+    if domain == 'nomx.example.com':
+        raise dns.resolver.NoAnswer()
+    return mk_mx_answer()
+
+
+@patch.dict(settings.CAMPAIGNS, {'BYPASS_RECIPIENTS_MX_CHECK': False})
+class MXResolverTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_recipient_domain(self):
+        self.assertEqual(
+            get_recipient_domain('Foo <foo@Example.com>'), 'example.com')
+        self.assertIsNone(get_recipient_domain('foo'))
+
+    def test_validate_queries_domain(self):
+        with patch('dns.resolver.query', side_effect=query_mx) as query:
+            validate_existing_mail_domain('foo@example.com')
+            with self.assertRaises(ValidationError):
+                validate_existing_mail_domain('foo@nomx.example.com')
+        self.assertEqual(
+            [c[0] for c in query.call_args_list],
+            [('example.com', 'MX'), ('nomx.example.com', 'MX')])
+
+    def test_check_resolves_missing_domains_once(self):
+        domains = ['{}.example.com'.format(i) for i in range(50)]
+        with patch('dns.resolver.query', side_effect=query_mx) as query:
+            checked = mx_resolver.check(domains + ['nomx.example.com'])
+            self.assertEqual(query.call_count, 51)
+            self.assertEqual(mx_resolver.check(domains), {
+                domain: True for domain in domains})
+            self.assertEqual(query.call_count, 51)
+        self.assertFalse(checked['nomx.example.com'])
+        self.assertTrue(checked['0.example.com'])
+
+    def test_ttl(self):
+        with patch('dns.resolver.query', return_value=mk_mx_answer(7200)):
+            with patch.object(cache, 'set') as cache_set:
+                mx_resolver.check(['example.com'])
+        cache_set.assert_called_once_with('domcheck:example.com', False, 7200)
+
+        with patch('dns.resolver.query', side_effect=dns.exception.Timeout):
+            with patch.object(cache, 'set') as cache_set:
+                self.assertEqual(
+                    mx_resolver.check(['example.org']),
+                    {'example.org': False})
+        cache_set.assert_called_once_with(
+            'domcheck:example.org', True,
+            settings.CAMPAIGNS['MX_ERROR_TTL'])
+
+    def test_bypass(self):
+        with patch.dict(
+                settings.CAMPAIGNS, {'BYPASS_RECIPIENTS_MX_CHECK': True}):
+            with patch('dns.resolver.query') as query:
+                self.assertEqual(mx_resolver.check(['example.com']), {})
+                validate_existing_mail_domain('foo@example.com')
+        query.assert_not_called()
@@ -0,0 +1,75 @@
+import pickle
+from unittest.mock import patch
+
+from django.template import Context
+from django.template import Template
+from django.test import SimpleTestCase
+
+from ..contentfilters import apply_mailmerge
+from ..mailmerge import FIELD
+from ..mailmerge import DjangoTemplate
+from ..mailmerge import FieldsTemplate
+from ..mailmerge import MailMergeTemplates
+from ..mailmerge import mailmerge_templates
+
+PROPERTIES = {'first_name': 'Jeanne', 'last_name': '<b>', 'city': None}
+
+
+class MailMergeTestCase(SimpleTestCase):
+    def assertRendersLikeDjango(self, source, properties=PROPERTIES):
+        self.assertEqual(
+            apply_mailmerge(source, mail_properties=properties),
+            Template(source).render(Context(properties)))
+
+    def test_fields_template(self):
+        template = FieldsTemplate.parse('Hi {{ first_name }}{{last_name}}!')
+        self.assertEqual(template.parts, [
+            'Hi ', (FIELD, 'first_name'), (FIELD, 'last_name'), '!'])
+        self.assertIsNone(FieldsTemplate.parse('{{ first_name|upper }}'))
+        self.assertIsNone(FieldsTemplate.parse('{% if a %}{% endif %}'))
+        self.assertIsNone(FieldsTemplate.parse('{{ True }}'))
+        self.assertIsNone(FieldsTemplate.parse('{{ inf }}'))
+
+    def test_renders_like_django(self):
+        for source in [
+                'No tags', '', 'Hi {{ first_name }} {{ last_name }}',
+                '{{ city }}, {{ unknown }}', '{ {{first_name}} }',
+                '{{ first_name|upper }}', '{% if city %}x{% endif %}',
+                '{{ True }} {{ 1e3 }} {# comment #}', '{{ first_name ']:
+            self.assertRendersLikeDjango(source)
+        self.assertRendersLikeDjango('{{ first_name }}', None)
+
+    def test_templates_compiled_once(self):
+        source = 'Hi {{ first_name|upper }} {{ last_name }}'
+        apply_mailmerge(source, mail_properties=PROPERTIES)
+        with patch(
+                'munch.apps.campaigns.mailmerge.Template',
+                wraps=Template) as template:
+            for _ in range(3):
+                apply_mailmerge(source, mail_properties=PROPERTIES)
+            apply_mailmerge('Hi {{ city }}', mail_properties=PROPERTIES)
+        template.assert_not_called()
+        self.assertIsInstance(mailmerge_templates.get(source), DjangoTemplate)
+        self.assertIsInstance(
+            mailmerge_templates.get('Hi {{ city }}'), FieldsTemplate)
+
+    def test_templates_cache_bounded(self):
+        templates = MailMergeTemplates(max_size=10)
+        for i in range(20):
+            templates.get('Template {}'.format(i))
+        self.assertEqual(len(templates.templates), 10)
+
+    def test_fields_template_pickled(self):
+        template = FieldsTemplate.parse('Hi {{ first_name }}')
+        self.assertEqual(
+            pickle.loads(pickle.dumps(template)).render(PROPERTIES),
+            'Hi Jeanne')
+
+    def test_fields_template_skips_django(self):
+        source = '<p>Hi {{ first_name }}</p>' * 10
+        apply_mailmerge(source, mail_properties=PROPERTIES)
+        with patch('munch.apps.campaigns.mailmerge.Context') as context:
+            self.assertEqual(
+                apply_mailmerge(source, mail_properties=PROPERTIES),
+                '<p>Hi Jeanne</p>' * 10)
+        context.assert_not_called()
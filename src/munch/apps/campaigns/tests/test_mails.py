@@ -1,9 +1,11 @@
 from unittest.mock import patch
 
+from django.db import connection
 from django.test import TestCase
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.core.mail import EmailMultiAlternatives
 from django.core.files.storage import default_storage
 from slimta.envelope import Envelope
@@ -16,6 +18,8 @@ from munch.apps.spamcheck.tests import get_spam_result_mock
 from munch.apps.optouts.tests.factories import OptOutFactory
 
 from ..tasks import handle_dsn
+from ..tasks import send_mails
+from ..tasks import resolve_recipients_domains
 from ..models import Mail
 from ..models import Message
 from ..models import MailStatus
@@ -175,6 +179,94 @@ class MailSending(TestCase):
         self.assertEqual(
             Message.objects.get(pk=message.pk).status, message.SENT)
 
+    def test_fire_message_by_chunks(self):
+        mails = [MailFactory(message=self.message) for _ in range(5)]
+        optouted = mails[2]
+        optout = OptOutFactory(
+            author=self.message.author, category=self.message.category,
+            identifier=optouted.identifier, address=optouted.recipient)
+
+        self.message.status = 'sending'
+        self.message.author.organization.settings.notify_message_status = False
+        with patch.dict(settings.CAMPAIGNS, {'SEND_CHUNK_SIZE': 2}):
+            with patch(
+                    'munch.apps.campaigns.tasks.send_mails.si',
+                    wraps=send_mails.si) as chunk:
+                self.message.save()  # Fires the message
+
+        self.assertEqual(chunk.call_count, 2)
+        self.assertEqual(self.message.mails.filter(
+            curstatus=MailStatus.SENDING).count(), 4)
+        self.assertEqual(
+            optouted.statuses.get(status=MailStatus.IGNORED).raw_msg,
+            'Ignored because of previous optout {}'.format(optout))
+        self.assertEqual(self.message.get_sending_progress(), (4, 4))
+
+    def test_fire_message_does_not_list_optouts(self):
+        mails = [MailFactory(message=self.message) for _ in range(3)]
+        for mail in mails[:2]:
+            OptOutFactory(
+                author=self.message.author, category=self.message.category,
+                identifier=mail.identifier, address=mail.recipient)
+
+        self.message.status = 'sending'
+        self.message.author.organization.settings.notify_message_status = False
+        with CaptureQueriesContext(connection) as queries:
+            self.message.save()  # Fires the message
+
+        for query in queries.captured_queries:
+            self.assertNotIn(mails[0].recipient, query['sql'])
+        self.assertEqual(self.message.mails.filter(
+            curstatus=MailStatus.IGNORED).count(), 2)
+        self.assertEqual(self.message.mails.filter(
+            curstatus=MailStatus.SENDING).count(), 1)
+
+    def test_fire_message_resolves_domains_in_task(self):
+        MailFactory(message=self.message)
+        self.message.status = 'sending'
+        self.message.author.organization.settings.notify_message_status = False
+        with patch(
+                'munch.apps.campaigns.tasks.resolve_recipients_domains.si',
+                wraps=resolve_recipients_domains.si) as resolve:
+            self.message.save()  # Fires the message
+        resolve.assert_called_once_with(self.message.pk)
+        self.assertEqual(self.message.mails.filter(
+            curstatus=MailStatus.SENDING).count(), 1)
+
+    def test_fire_message_runs_sending_chain(self):
+        mails = [MailFactory(message=self.message) for _ in range(3)]
+        self.message.status = 'sending'
+        self.message.author.organization.settings.notify_message_status = False
+        with patch.dict(settings.CAMPAIGNS, {'SEND_CHUNK_SIZE': 2}):
+            with patch(
+                    'munch.apps.campaigns.tasks.get_backend') as get_backend:
+                self.message.save()  # Fires the message
+
+        sent = [
+            call[0][0]
+            for call in get_backend().send_message.call_args_list]
+        self.assertEqual(
+            sorted(sent), sorted(mail.identifier for mail in mails))
+
+    def test_resolve_recipients_domains_never_fails(self):
+        with patch(
+                'munch.apps.campaigns.tasks.mx_resolver.check',
+                side_effect=Exception):
+            resolve_recipients_domains(self.message.pk)
+
+    def test_send_mails_progress_failure(self):
+        """ Mails already handed to the backend must not be sent again """
+        mail = MailFactory(message=self.message)
+        with patch.object(
+                Message, 'add_sending_progress', side_effect=ConnectionError):
+            with patch(
+                    'munch.apps.campaigns.tasks.send_mail.apply_async'
+                    ) as send_mail:
+                send_mails(self.message.pk, mail.pk, mail.pk)
+        send_mail.assert_not_called()
+        self.assertEqual(
+            Mail.objects.get(pk=mail.pk).curstatus, MailStatus.SENDING)
+
     def test_fire_message_good_headers(self):
         """ Some headers are required for mass mailing, check them """
         MailFactory(message=self.message)
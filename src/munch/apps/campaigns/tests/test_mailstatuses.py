@@ -1,5 +1,6 @@
 from datetime import timedelta
 
+from django.core.cache import cache
 from django.test import TestCase
 from django.utils import timezone
 from django.test.utils import override_settings
@@ -20,6 +21,8 @@ class MailStatusManagerTest(TestCase):
 
 class MailStatusTest(TestCase):
     def setUp(self):
+        # Bounce counters are kept in cache
+        cache.clear()
         self.user = UserFactory()
         self.message = MessageFactory(author=self.user)
         self.mail = MailFactory(message=self.message)
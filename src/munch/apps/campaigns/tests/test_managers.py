@@ -1,5 +1,6 @@
 import datetime
 
+from django.db import connection
 from django.test import TestCase
 from django.utils import timezone
 from django.core.exceptions import ValidationError
@@ -112,6 +113,39 @@ class MailManagerTest(TestCase):
 
         self.assertNotEqual(legit_objs, all_objs)
 
+    def test_legit_query_size(self):
+        """ Opt-outs are looked up by the database, not listed in query """
+        def get_sql(qs):
+            sql, params = qs.query.sql_with_params()
+            return sql, len(params)
+
+        legit = self.message.mails.legit_for(self.message)
+        not_legit = self.message.mails.not_legit_for(self.message)
+        sizes = [get_sql(legit), get_sql(not_legit)]
+
+        for i in range(50):
+            OptOutFactory(
+                author=self.message.author, category=self.message.category,
+                identifier='optout-{}'.format(i))
+            OptOutFactory(
+                identifier='bounce-{}'.format(i), origin=OptOut.BY_BOUNCE)
+        mail = self.message.mails.first()
+        OptOutFactory(
+            author=self.message.author, category=self.message.category,
+            identifier=mail.identifier, address=mail.recipient)
+
+        legit = self.message.mails.legit_for(self.message)
+        not_legit = self.message.mails.not_legit_for(self.message)
+        self.assertEqual([get_sql(legit), get_sql(not_legit)], sizes)
+        self.assertEqual(set(not_legit), {mail})
+        self.assertEqual(legit.count(), 2)
+
+        sql, params = legit.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN {}'.format(sql), params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertIn('Anti Join', plan)
+
     def test_done(self):
         self.assertEqual(Mail.objects.done().count(), 3)
 
@@ -11,6 +11,8 @@ from munch.apps.spamcheck import SpamResult
 from munch.apps.users.tests.factories import UserFactory
 from munch.apps.spamcheck.tests import get_spam_result_mock
 
+from ..models import Message
+from ..munchers import post_template_html_generation
 from ..exceptions import InvalidSubmitedData
 from .factories import MessageFactory
 
@@ -204,6 +206,30 @@ class MessageTest(TestCase):
             'src="http://www.oasiswork.fr/uploads/logo_oasiswork.jpg"',
             self.message.mk_html())
 
+    def test_render_cached(self):
+        self.message.html = '<h1>Cached</h1>{}'.format(
+            settings.OPTOUTS['UNSUBSCRIBE_PLACEHOLDER'])
+        with patch(
+                'munch.apps.campaigns.models.post_template_html_generation'
+                '.process', wraps=post_template_html_generation.process) as p:
+            html = self.message.mk_html()
+            plaintext = self.message.mk_plaintext()
+            self.assertEqual(self.message.mk_html(), html)
+            self.assertEqual(p.call_count, 1)
+
+            # Other processes get it from cache
+            message = Message.objects.get(pk=self.message.pk)
+            message.html = self.message.html
+            self.assertEqual(message.mk_html(), html)
+            self.assertEqual(message.mk_plaintext(), plaintext)
+            self.assertEqual(p.call_count, 1)
+
+            # Until it changes
+            message.html = '<h1>Changed</h1>{}'.format(
+                settings.OPTOUTS['UNSUBSCRIBE_PLACEHOLDER'])
+            self.assertIn('Changed', message.mk_html())
+            self.assertEqual(p.call_count, 2)
+
     def test_invalid_html(self):
         """ Invalid because of missing src attr
         """
@@ -1,14 +1,21 @@
 import logging
 
+from celery import task
+from django.conf import settings
+
 from munch.core.utils.tasks import task_autoretry
 from munch.core.mail.exceptions import SoftFailure
 from munch.core.mail.exceptions import HardFailure
 from munch.core.mail.exceptions import RejectUnknownIdentifier
+from munch.core.mail.statuses import StatusBuffer
 
 from .models import Mail
+from .models import MailStatus
 
 log = logging.getLogger(__name__)
 
+status_buffer = StatusBuffer(MailStatus)
+
 
 def get_envelope(identifier, **kwargs):
     try:
@@ -45,12 +52,25 @@ def get_mail_or_raise(identifier):
     autoretry_exclude=(SoftFailure, HardFailure),
     retry_message='Error while trying to record_status. Retrying.')
 def record_status(mailstatus, identifier, relay_ehlo, reply=None):
-    """ Save MailStatus and send SMTP Status task """
+    """ Save MailStatus and send SMTP Status task
+
+    With STATUS_BATCHING, the status is buffered and saved later on by
+    flush_status_buffer.
+    """
     log.debug('[{}] Recording "{}" status...'.format(
         identifier, mailstatus.status))
+    if settings.CAMPAIGNS.get('STATUS_BATCHING', False):
+        status_buffer.push(mailstatus, identifier)
+        return
     try:
         mail_metadata = get_mail_or_raise(identifier)
         mailstatus.mail = mail_metadata
         mailstatus.save()
     except (SoftFailure, RejectUnknownIdentifier) as exc:
         raise SoftFailure(exc)
+
+
+@task
+def flush_status_buffer():
+    """ Record statuses buffered by record_status (see STATUS_BATCHING) """
+    status_buffer.flush(settings.CAMPAIGNS.get('STATUS_BATCH_SIZE', 1000))
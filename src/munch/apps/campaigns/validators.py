@@ -1,5 +1,6 @@
 import re
 from email.utils import parseaddr
+from concurrent.futures import ThreadPoolExecutor
 
 import dns
 import dns.exception
@@ -17,12 +18,89 @@ slug_regex_validator = RegexValidator(
     message='source should be composed of lowercase letters and dashes')
 
 
-def validate_existing_mail_domain(email):
+def get_recipient_domain(email):
+    """
+    :return: the domain of an email address, None if it has none
+    """
+    address = parseaddr(email)[1]
+    if '@' not in address:
+        return None
+    return address.rsplit('@', 1)[1].lower() or None
+
+
+class MXResolver:
+    """ Checks that domains have MX records, many at once
+
+    Answers are kept in cache (shared by workers) as long as their DNS TTL
+    says (within MX_CACHE_MIN_TTL and MX_CACHE_MAX_TTL). Domains without MX
+    record are kept MX_NEGATIVE_TTL, those which could not be resolved
+    (timeouts...) MX_ERROR_TTL. Missing domains are resolved concurrently,
+    by MX_RESOLVE_CONCURRENCY threads.
+    """
+    KEY = 'domcheck:{}'
+
+    def query(self, domain):
+        """
+        :return: (has MX record, seconds to keep that answer)
+        """
+        try:
+            answer = dns.resolver.query(domain, 'MX')
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return False, settings.CAMPAIGNS.get('MX_NEGATIVE_TTL', 3600)
+        except dns.exception.DNSException:
+            return False, settings.CAMPAIGNS.get('MX_ERROR_TTL', 60)
+        return True, min(
+            max(answer.rrset.ttl, settings.CAMPAIGNS.get(
+                'MX_CACHE_MIN_TTL', 60)),
+            settings.CAMPAIGNS.get('MX_CACHE_MAX_TTL', 3600 * 24))
+
+    def resolve(self, domains):
+        """ Resolve domains concurrently, and cache the answers
+
+        :return: {domain: has MX record}
+        """
+        domains = list(domains)
+        if not domains:
+            return {}
+        max_workers = min(
+            len(domains), settings.CAMPAIGNS.get('MX_RESOLVE_CONCURRENCY', 20))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            answers = dict(zip(domains, executor.map(self.query, domains)))
+
+        for domain, (has_mx, ttl) in answers.items():
+            cache.set(self.KEY.format(domain), not has_mx, ttl)
+        return {domain: has_mx for domain, (has_mx, _) in answers.items()}
+
+    def check(self, domains):
+        """ Resolve only the domains which are not in cache
+
+        :return: {domain: has MX record}, empty if MX check is bypassed
+        """
+        if settings.CAMPAIGNS['BYPASS_RECIPIENTS_MX_CHECK']:
+            return {}
+        keys = {
+            self.KEY.format(domain): domain
+            for domain in set(domains) if domain}
+        results = {
+            keys[key]: not has_error
+            for key, has_error in cache.get_many(list(keys)).items()}
+        results.update(self.resolve(
+            domain for domain in keys.values() if domain not in results))
+        return results
+
+
+mx_resolver = MXResolver()
+
+
+def validate_existing_mail_domain(email, checked=None):
     """ Just checks that the associated domain of an email has an MX record.
+
+    :param checked: {domain: has MX record}, as given by mx_resolver.check()
+                    for many emails at once
     """
     if settings.CAMPAIGNS['BYPASS_RECIPIENTS_MX_CHECK']:
         return
-    domain = parseaddr(email)[1]
+    domain = get_recipient_domain(email)
 
     if domain is None:
         # Trigger no error because email format is supposed to be checked
@@ -30,19 +108,10 @@ def validate_existing_mail_domain(email):
         return
 
     else:
-        key = 'domcheck:{}'.format(domain)
-        has_error = cache.get(key, None)
-
-        if has_error is None:  # Not present in cache
-            try:
-                dns.resolver.query(domain, 'MX')
-                has_error = False
-            except dns.exception.DNSException:
-                has_error = True
-            finally:
-                cache.set(key, has_error, 60)
-
-        if has_error:
+        if checked is None or domain not in checked:
+            checked = mx_resolver.check([domain])
+
+        if not checked[domain]:
             raise ValidationError(_(
                 'This domain "{}" doesn\'t seems to be '
                 'configured to received emails').format(domain))
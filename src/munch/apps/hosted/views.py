@@ -13,13 +13,15 @@ def hosted_message(request, identifier):
     mail = web_tracking_open(request, msg)
 
     if mail:
+        rewrite_context = msg.get_rewrite_context()
         html = post_web_html_individual.process(
-            msg.html,
-            app_url=msg.get_app_url(),
+            msg.mk_html(),
+            app_url=rewrite_context.app_url,
             track_clicks=msg.track_clicks,
             unsubscribe_url=mail.unsubscribe_url,
             mail_identifier=mail.identifier,
-            links_map=msg.msg_links)
+            links_map=msg.msg_links,
+            rewrite_context=rewrite_context)
     else:
-        html = msg.html
+        html = msg.mk_html()
     return HttpResponse(html)
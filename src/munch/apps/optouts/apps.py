@@ -7,4 +7,5 @@ class OptOutApp(AppConfig):
     verbose_name = _("Opt-out")
 
     def ready(self):
+        import munch.apps.optouts.signals  # noqa
         import munch.apps.optouts.api.v1.urls  # noqa
@@ -0,0 +1,267 @@
+import time
+import hashlib
+import logging
+from array import array
+from bisect import bisect_left
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.core.cache import cache
+
+log = logging.getLogger(__name__)
+
+VERSION_KEY = 'optouts:index:version'
+
+
+def hash_address(address):
+    """ 64 bits fingerprint of an email address """
+    return int.from_bytes(
+        hashlib.md5(address.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashedAddressSet:
+    """ Compact set of address fingerprints
+
+    Bulk-loaded fingerprints are kept in a sorted array (8 bytes per
+    address) and looked up by bisection, incremental additions go to a
+    small set which is merged into the array once it grows too big.
+
+    Fingerprints may collide, so a hit only means "maybe": callers must
+    confirm it against the database.
+    """
+    MERGE_THRESHOLD = 4096
+
+    def __init__(self, hashes=()):
+        self._base = array('Q', sorted(set(hashes)))
+        self._delta = set()
+
+    def __len__(self):
+        return len(self._base) + len(self._delta)
+
+    def __contains__(self, hashed):
+        if hashed in self._delta:
+            return True
+        i = bisect_left(self._base, hashed)
+        return i != len(self._base) and self._base[i] == hashed
+
+    def add(self, hashed):
+        if hashed in self:
+            return
+        self._delta.add(hashed)
+        if len(self._delta) >= self.MERGE_THRESHOLD:
+            self._base = array('Q', sorted(set(self._base) | self._delta))
+            self._delta = set()
+
+
+class OptOutIndex:
+    """ In-memory index answering "is this address suppressed ?"
+
+    Addresses are indexed in a global bounce set, and, for the other
+    origins, per-organization, per-category and per (organization,
+    category name) sets, which are the scopes used by campaigns and
+    transactional sending.
+
+    The index is loaded lazily and kept up-to-date by OptOut post-save
+    signals in the current process. Each committed opt-out also bumps a
+    shared version stamp (see bump_version()), read at most every
+    OPTOUTS['INDEX_VERSION_CHECK_INTERVAL'] seconds: whenever it changed,
+    the index is refreshed from the database before answering, so opt-outs
+    created by other processes are picked up within that interval. It is
+    also refreshed every OPTOUTS['INDEX_REFRESH_INTERVAL'] seconds, for
+    opt-outs saved without signals or while the cache is unavailable.
+    Positive answers are always confirmed with an exact query, so
+    stale or colliding entries never suppress a legit address.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.bounces = HashedAddressSet()
+        self.organizations = {}
+        self.categories = {}
+        self.category_names = {}
+        self.loaded = False
+        self.last_pk = 0
+        self.last_refresh = None
+        self.last_refresh_date = None
+        self.last_version_check = None
+        self.version = None
+
+    def _add(self, address, origin, organization_id, category_id,
+             category_name):
+        from .models import OptOut
+
+        hashed = hash_address(address)
+        if origin == OptOut.BY_BOUNCE:
+            self.bounces.add(hashed)
+            return
+        if organization_id is not None:
+            self.organizations.setdefault(
+                organization_id, HashedAddressSet()).add(hashed)
+        if category_id is not None:
+            self.categories.setdefault(
+                category_id, HashedAddressSet()).add(hashed)
+            self.category_names.setdefault(
+                (organization_id, category_name), HashedAddressSet()).add(
+                    hashed)
+
+    def _load(self, queryset):
+        count = 0
+        for pk, *row in queryset.values_list(
+                'pk', 'address', 'origin', 'author__organization_id',
+                'category_id', 'category__name').iterator():
+            self._add(*row)
+            self.last_pk = max(self.last_pk, pk)
+            count += 1
+        return count
+
+    def get_version(self):
+        """ Shared version stamp, None if it cannot be read """
+        try:
+            return cache.get(VERSION_KEY, 0)
+        except Exception:
+            log.warning('Unable to read opt-outs index version', exc_info=True)
+            return None
+
+    def load(self):
+        from .models import OptOut
+
+        self.clear()
+        self.version = self.get_version()
+        self.last_refresh = self.last_version_check = time.monotonic()
+        self.last_refresh_date = timezone.now()
+        count = self._load(OptOut.objects.all())
+        self.loaded = True
+        log.info('Loaded {} opt-outs in index'.format(count))
+
+    def refresh(self):
+        """ Pull opt-outs created or updated since last refresh """
+        from .models import OptOut
+
+        # Opt-outs committed during last refresh may be dated before it,
+        # and have a lower pk than the ones it loaded.
+        since = self.last_refresh_date - timedelta(
+            seconds=settings.OPTOUTS.get('INDEX_REFRESH_OVERLAP', 60))
+        self.last_refresh = time.monotonic()
+        self.last_refresh_date = timezone.now()
+        self._load(OptOut.objects.filter(
+            Q(pk__gt=self.last_pk) | Q(creation_date__gte=since)))
+
+    def ensure_fresh(self):
+        if not self.loaded:
+            self.load()
+            return
+        now = time.monotonic()
+        check_interval = settings.OPTOUTS.get(
+            'INDEX_VERSION_CHECK_INTERVAL', 1)
+        if now - self.last_version_check >= check_interval:
+            self.last_version_check = now
+            # Read before refreshing: opt-outs committed meanwhile will
+            # bump it
+            version = self.get_version()
+            if version is not None and version != self.version:
+                self.refresh()
+                self.version = version
+                return
+        # Cache unavailable or no change: periodic refresh only
+        interval = settings.OPTOUTS.get('INDEX_REFRESH_INTERVAL', 60)
+        if now - self.last_refresh > interval:
+            self.refresh()
+
+    def add(self, optout):
+        """ Index a single OptOut instance (see post_save signal) """
+        if not self.loaded:
+            # Will be part of the initial load anyway
+            return
+        organization_id, category_id, category_name = None, None, None
+        if optout.author_id:
+            organization_id = optout.author.organization_id
+        if optout.category_id:
+            category_id = optout.category_id
+            category_name = optout.category.name
+        self._add(
+            optout.address, optout.origin,
+            organization_id, category_id, category_name)
+
+    def _get_scope(self, organization_id, category_id, category_name):
+        if category_id is not None:
+            return self.categories.get(category_id)
+        if category_name is not None:
+            return self.category_names.get((organization_id, category_name))
+        if organization_id is not None:
+            return self.organizations.get(organization_id)
+
+    def _get_scope_filter(self, organization_id, category_id, category_name):
+        from .models import OptOut
+
+        q = Q(origin=OptOut.BY_BOUNCE)
+        if category_id is not None:
+            scope_q = Q(category_id=category_id)
+        elif category_name is not None:
+            scope_q = Q(
+                author__organization_id=organization_id,
+                category__name=category_name)
+        elif organization_id is not None:
+            scope_q = Q(author__organization_id=organization_id)
+        else:
+            return q
+        return q | (~Q(origin=OptOut.BY_BOUNCE) & scope_q)
+
+    def filter_suppressed(
+            self, addresses, organization_id=None,
+            category_id=None, category_name=None):
+        """ Return the set of addresses which must not be sent to
+
+        Bounce opt-outs always apply. Other opt-outs apply in the category
+        scope if a category (id or name) is given, organization-wide
+        otherwise.
+        """
+        from .models import OptOut
+
+        self.ensure_fresh()
+        scope = self._get_scope(organization_id, category_id, category_name)
+
+        candidates = set()
+        for address in addresses:
+            hashed = hash_address(address)
+            if hashed in self.bounces or (
+                    scope is not None and hashed in scope):
+                candidates.add(address)
+
+        if not candidates:
+            return set()
+
+        # Exact fallback, only for the (few) addresses which hit
+        suppressed = set()
+        candidates = list(candidates)
+        filters = self._get_scope_filter(
+            organization_id, category_id, category_name)
+        chunk_size = 1000
+        for i in range(0, len(candidates), chunk_size):
+            suppressed.update(OptOut.objects.filter(filters).filter(
+                address__in=candidates[i:i + chunk_size]).values_list(
+                    'address', flat=True))
+        return suppressed
+
+    def is_suppressed(
+            self, address, organization_id=None,
+            category_id=None, category_name=None):
+        return bool(self.filter_suppressed(
+            [address], organization_id=organization_id,
+            category_id=category_id, category_name=category_name))
+
+
+def bump_version():
+    """ Tell every process that an opt-out was committed """
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, None)
+    except Exception:
+        # Other processes will catch up at next periodic refresh
+        log.error('Unable to bump opt-outs index version', exc_info=True)
+
+
+optout_index = OptOutIndex()
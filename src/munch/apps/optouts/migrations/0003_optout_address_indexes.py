@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('optouts', '0002_permissions'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='optout',
+            index_together=set([
+                ('address', 'origin'),
+                ('address', 'category'),
+                ('address', 'author')]),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('optouts', '0003_optout_address_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='optout',
+            name='creation_date',
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
@@ -66,7 +66,7 @@ class OptOut(AbstractOwnedModel):
         max_length=150, db_index=True,
         unique=True, verbose_name=_('identifier'))
     address = models.EmailField(verbose_name=_('mail'))
-    creation_date = models.DateTimeField(default=timezone.now)
+    creation_date = models.DateTimeField(default=timezone.now, db_index=True)
     origin = models.CharField(
         _('origine'), max_length=20, choices=(
             (BY_MAIL, _('Email')),
@@ -84,6 +84,11 @@ class OptOut(AbstractOwnedModel):
     class Meta(AbstractOwnedModel.Meta):
         verbose_name = _('optout')
         verbose_name_plural = _('optouts')
+        # Recipients selection (see campaigns MailQuerySet.legit_for())
+        index_together = [
+            ('address', 'origin'),
+            ('address', 'category'),
+            ('address', 'author')]
 
     owner_path = 'author__organization'
     author_path = 'author'
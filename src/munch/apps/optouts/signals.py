@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.dispatch import receiver
+from django.db.models.signals import post_save
+
+from .index import optout_index
+from .index import bump_version
+from .models import OptOut
+
+
+@receiver(post_save, sender=OptOut)
+def index_optout(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    optout_index.add(instance)
+    transaction.on_commit(bump_version)
@@ -0,0 +1,137 @@
+from unittest.mock import patch
+
+from django.conf import settings
+from django.test import TestCase
+
+from munch.core.models import Category
+from munch.core.utils import mk_base64_uuid
+from munch.apps.users.tests.factories import UserFactory
+
+from ..models import OptOut
+from ..index import hash_address
+from ..index import optout_index
+from ..index import bump_version
+from ..index import HashedAddressSet
+from .factories import OptOutFactory
+
+
+class TestHashedAddressSet(TestCase):
+    def test_contains(self):
+        hashes = HashedAddressSet(
+            hash_address(a) for a in ['a@example.com', 'b@example.com'])
+        self.assertIn(hash_address('a@example.com'), hashes)
+        self.assertNotIn(hash_address('c@example.com'), hashes)
+
+        hashes.add(hash_address('c@example.com'))
+        self.assertIn(hash_address('c@example.com'), hashes)
+        self.assertEqual(len(hashes), 3)
+
+    def test_merge(self):
+        hashes = HashedAddressSet()
+        for i in range(HashedAddressSet.MERGE_THRESHOLD + 10):
+            hashes.add(hash_address('{}@example.com'.format(i)))
+        self.assertEqual(len(hashes), HashedAddressSet.MERGE_THRESHOLD + 10)
+        self.assertIn(hash_address('1@example.com'), hashes)
+
+
+class TestOptOutIndex(TestCase):
+    def setUp(self):
+        optout_index.clear()
+        self.user = UserFactory()
+        self.other_user = UserFactory()
+        self.category = Category.objects.create(
+            author=self.user, name='newsletter')
+
+    def optouts_settings(self, **kwargs):
+        optouts_settings = settings.OPTOUTS.copy()
+        optouts_settings.update(kwargs)
+        return optouts_settings
+
+    def mk_optout(self, address, **kwargs):
+        return OptOutFactory(
+            identifier=mk_base64_uuid(), address=address, **kwargs)
+
+    def test_bounce_is_global(self):
+        self.mk_optout('bounced@example.com', origin=OptOut.BY_BOUNCE)
+        self.assertTrue(optout_index.is_suppressed('bounced@example.com'))
+        self.assertTrue(optout_index.is_suppressed(
+            'bounced@example.com',
+            organization_id=self.other_user.organization_id))
+
+    def test_organization_scope(self):
+        self.mk_optout('optout@example.com', author=self.user)
+        self.assertEqual(
+            optout_index.filter_suppressed(
+                ['optout@example.com', 'legit@example.com'],
+                organization_id=self.user.organization_id),
+            {'optout@example.com'})
+        self.assertFalse(optout_index.is_suppressed(
+            'optout@example.com',
+            organization_id=self.other_user.organization_id))
+
+    def test_category_scope(self):
+        self.mk_optout(
+            'optout@example.com', author=self.user, category=self.category)
+        self.assertTrue(optout_index.is_suppressed(
+            'optout@example.com', category_id=self.category.pk))
+        self.assertTrue(optout_index.is_suppressed(
+            'optout@example.com',
+            organization_id=self.user.organization_id,
+            category_name='newsletter'))
+        self.assertFalse(optout_index.is_suppressed(
+            'optout@example.com',
+            organization_id=self.user.organization_id,
+            category_name='other'))
+
+    def test_added_after_load(self):
+        optout_index.load()
+        self.assertFalse(optout_index.is_suppressed('late@example.com'))
+        self.mk_optout('late@example.com', origin=OptOut.BY_BOUNCE)
+        with self.assertNumQueries(1):
+            self.assertTrue(optout_index.is_suppressed('late@example.com'))
+
+    def test_added_by_other_process(self):
+        optout_index.load()
+        self.assertFalse(optout_index.is_suppressed('other@example.com'))
+        # No post_save signal, as in another process
+        OptOut.objects.bulk_create([OptOut(
+            identifier=mk_base64_uuid(), address='other@example.com',
+            origin=OptOut.BY_BOUNCE)])
+        bump_version()
+        with self.settings(OPTOUTS=self.optouts_settings(
+                INDEX_VERSION_CHECK_INTERVAL=0)):
+            self.assertTrue(optout_index.is_suppressed('other@example.com'))
+
+    def test_version_read_throttled(self):
+        optout_index.load()
+        with patch.object(optout_index, 'get_version') as get_version:
+            for i in range(10):
+                optout_index.ensure_fresh()
+        get_version.assert_not_called()
+
+    def test_cache_unavailable(self):
+        optout_index.load()
+        with self.settings(OPTOUTS=self.optouts_settings(
+                INDEX_VERSION_CHECK_INTERVAL=0)):
+            with patch.object(optout_index, 'get_version', return_value=None):
+                with patch.object(optout_index, 'refresh') as refresh:
+                    optout_index.ensure_fresh()
+                    refresh.assert_not_called()
+
+                    optout_index.last_refresh -= settings.OPTOUTS[
+                        'INDEX_REFRESH_INTERVAL'] + 1
+                    optout_index.ensure_fresh()
+                    refresh.assert_called_once_with()
+
+    def test_no_query_for_unknown_addresses(self):
+        optout_index.load()
+        with self.assertNumQueries(0):
+            self.assertEqual(optout_index.filter_suppressed(
+                ['a@example.com', 'b@example.com'],
+                organization_id=self.user.organization_id), set())
+
+    def test_stale_entry_is_not_suppressed(self):
+        optout = self.mk_optout('gone@example.com', origin=OptOut.BY_BOUNCE)
+        optout_index.load()
+        optout.delete()
+        self.assertFalse(optout_index.is_suppressed('gone@example.com'))
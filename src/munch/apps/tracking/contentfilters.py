@@ -1,5 +1,6 @@
 import functools
 
+import lxml.html
 import lxml.etree
 from lxml.cssselect import CSSSelector
 from django.urls import reverse
@@ -7,6 +8,7 @@ from django.urls import reverse
 from munch.core.utils.regexp import mkd_footnote_url_re
 
 from .utils import WebKey
+from .utils import RewriteContext
 
 body_selector = CSSSelector('body')
 links_selector = CSSSelector('a')
@@ -25,7 +27,8 @@ def mk_tracking_url(app_url, mail_identifier):
 
 
 def add_tracking_image(
-        html, app_url=None, track_open=False, mail_identifier=None, **kwargs):
+        html, app_url=None, track_open=False, mail_identifier=None,
+        rewrite_context=None, **kwargs):
     """ Content filter to add tracking Pixel
 
     Appends a <img> tag to the HTML, pointing to a tracking with id in
@@ -34,37 +37,46 @@ def add_tracking_image(
     if track_open and app_url and mail_identifier:
         # use the root tree to preserve doctype
         doc = lxml.etree.HTML(html).getroottree()
-        img = lxml.etree.fromstring(
-            '<img src="{}" alt="" height="1" width="1" border="0" />'.format(
-                mk_tracking_url(app_url, mail_identifier)))
-
-        body = body_selector(doc)
-
-        if len(body) > 0:
-            body[0].append(img)
-        else:
-            doc.append(img)
-
+        append_tracking_image(doc, app_url, mail_identifier, rewrite_context)
         with_image = lxml.html.tostring(doc).decode()
         return with_image
     return html
 
 
+def append_tracking_image(doc, app_url, mail_identifier, context=None):
+    """ Appends the tracking pixel to an already parsed HTML tree
+
+    :type context: utils.RewriteContext
+    """
+    if context is not None:
+        url = context.open_url.format(identifier=mail_identifier)
+    else:
+        url = mk_tracking_url(app_url, mail_identifier)
+    img = lxml.etree.fromstring(
+        '<img src="{}" alt="" height="1" width="1" border="0" />'.format(url))
+
+    body = body_selector(doc)
+
+    if len(body) > 0:
+        body[0].append(img)
+    else:
+        doc.append(img)
+
+
 class LinksRewriter:
     @staticmethod
-    def rewrite(mail_identifier, app_url, links_map, url):
+    def rewrite(mail_identifier, app_url, links_map, url, context=None):
         """ Makes a redirection url used for email links
+
+        :type context: utils.RewriteContext, built from app_url and
+                       links_map if not given
         """
-        # invert the message links_map so we can look by URL
-        if links_map:
-            links_map = {v: k for k, v in links_map.items()}
-        if url in links_map:
-            return '{}/{}'.format(
-                app_url,
-                reverse('tracking-redirect',
-                        kwargs={
-                            'identifier': mail_identifier,
-                            'link_identifier': links_map[url]}).strip('/'))
+        if context is None:
+            context = RewriteContext(app_url, links_map)
+        if url in context.links:
+            return context.redirect_url.format(
+                identifier=mail_identifier,
+                link_identifier=context.links[url])
         return url
 
     @staticmethod
@@ -82,7 +94,8 @@ class HTMLLinksRewriter(LinksRewriter):
     @classmethod
     def _rewrite_html_links(
             cls, html, track_clicks, mail_identifier,
-            unsubscribe_url, app_url, links_map, rewrite_func):
+            unsubscribe_url, app_url, links_map, rewrite_func,
+            context=None):
         """ Generic Content filter to rewrite links
 
         :param rewrite_func: f(Mail, original_url) -> rewritten_url
@@ -91,31 +104,41 @@ class HTMLLinksRewriter(LinksRewriter):
                 not mail_identifier.startswith('test'):
             # use the root tree to preserve doctype
             doc = lxml.etree.HTML(html).getroottree()
-
-            for link in links_selector(doc):
-                original_url = link.get('href') or ''
-                original_url = original_url.strip()
-
-                if (
-                        original_url.startswith('http') and cls.should_rewrite(
-                            original_url, unsubscribe_url)):
-                    link.set('href', rewrite_func(
-                        mail_identifier, app_url,
-                        links_map, original_url))
-
+            cls.rewrite_doc_links(
+                doc, mail_identifier, unsubscribe_url,
+                app_url, links_map, rewrite_func, context)
             return lxml.html.tostring(doc).decode()
         return html
 
+    @classmethod
+    def rewrite_doc_links(
+            cls, doc, mail_identifier, unsubscribe_url,
+            app_url, links_map, rewrite_func, context=None):
+        """ Rewrites links of an already parsed HTML tree, in place """
+        if context is None:
+            context = RewriteContext(app_url, links_map)
+        for link in links_selector(doc):
+            original_url = link.get('href') or ''
+            original_url = original_url.strip()
+
+            if (
+                    original_url.startswith('http') and cls.should_rewrite(
+                        original_url, unsubscribe_url)):
+                link.set('href', rewrite_func(
+                    mail_identifier, app_url,
+                    links_map, original_url, context))
+
 
 class HTMLEMailLinksRewriter(HTMLLinksRewriter):
     def __call__(
             self, html, app_url=None, track_clicks=False,
             mail_identifier=None, unsubscribe_url=None,
-            links_map={}, **kwargs):
+            links_map={}, rewrite_context=None, **kwargs):
         """ Content filter to add tracked links for mails """
         return self._rewrite_html_links(
             html, track_clicks, mail_identifier,
-            unsubscribe_url, app_url, links_map, self.rewrite)
+            unsubscribe_url, app_url, links_map, self.rewrite,
+            rewrite_context)
 
 
 rewrite_html_links = HTMLEMailLinksRewriter()
@@ -124,24 +147,27 @@ rewrite_html_links = HTMLEMailLinksRewriter()
 class PlaintextLinksRewriter(LinksRewriter):
     def __call__(
             self, plaintext, app_url=None, unsubscribe_url=None,
-            mail_identifier=None, links_map={}, **kwargs):
+            mail_identifier=None, links_map={}, rewrite_context=None,
+            **kwargs):
         rewriter = functools.partial(
             self._rewrite_link,
             app_url=app_url,
             links_map=links_map,
             unsubscribe_url=unsubscribe_url,
-            mail_identifier=mail_identifier)
+            mail_identifier=mail_identifier,
+            context=rewrite_context or RewriteContext(app_url, links_map))
         return mkd_footnote_url_re.sub(rewriter, plaintext)
 
     @classmethod
     def _rewrite_link(
-            cls, m, app_url, links_map, unsubscribe_url, mail_identifier):
+            cls, m, app_url, links_map, unsubscribe_url, mail_identifier,
+            context=None):
         url = m.group('url')
         footnote_mark = m.group('fnmark')
         if cls.should_rewrite(url, unsubscribe_url) and \
                 not mail_identifier.startswith('test'):
             return '{} {}'.format(footnote_mark, cls.rewrite(
-                mail_identifier, app_url, links_map, url))
+                mail_identifier, app_url, links_map, url, context))
         return m.group(0)  # as-is
 
 
@@ -152,28 +178,23 @@ class WebVersionLinksRewriter(HTMLLinksRewriter):
     def __call__(
             self, html, app_url=None, track_clicks=False,
             unsubscribe_url=None, mail_identifier=None,
-            links_map={}, **kwargs):
+            links_map={}, rewrite_context=None, **kwargs):
         return self._rewrite_html_links(
             html, track_clicks, mail_identifier, unsubscribe_url,
-            app_url, links_map, self.rewrite)
+            app_url, links_map, self.rewrite, rewrite_context)
 
     @staticmethod
-    def rewrite(mail_identifier, app_url, links_map, url):
+    def rewrite(mail_identifier, app_url, links_map, url, context=None):
         """Makes a redirection url used for links in web version
 
         It's based on web key.
         """
-        webkey = WebKey.from_instance(mail_identifier)
-        # invert the message links_map so we can look by URL
-        links_map = {v: k for k, v in links_map.items()}
-
-        if url in links_map:
-            return '{}/{}'.format(
-                app_url,
-                reverse('web-tracking-redirect',
-                        kwargs={
-                            'web_key': webkey.token,
-                            'link_identifier': links_map[url]}).strip('/'))
+        if context is None:
+            context = RewriteContext(app_url, links_map)
+        if url in context.links:
+            return context.web_redirect_url.format(
+                web_key=WebKey.from_instance(mail_identifier).token,
+                link_identifier=context.links[url])
         return url
 
 
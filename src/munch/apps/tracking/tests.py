@@ -5,6 +5,7 @@ from datetime import timedelta
 
 from django.conf import settings
 from django.test import TestCase
+from django.urls import reverse
 from django.test.utils import override_settings
 from libfaketime import fake_time
 
@@ -18,6 +19,7 @@ from munch.apps.users.tests.factories import UserFactory
 from munch.apps.spamcheck.tests import get_spam_result_mock
 
 from .utils import WebKey
+from .utils import RewriteContext
 from .views import TRACKER_PIXEL
 from .models import LinkMap
 from .models import TrackRecord
@@ -25,6 +27,7 @@ from .models import READ_BROWSER
 from .models import READ_MUA_PIXEL
 
 from .contentfilters import LinksRewriter
+from .contentfilters import mk_tracking_url
 from .contentfilters import WebVersionLinksRewriter
 from .contentfilters import rewrite_plaintext_links
 
@@ -60,6 +63,34 @@ class TestTrackingPixel(TestCase):
         resp = self.client.get('/t/open/')
         self.assertEqual(resp.status_code, 404)
 
+    def test_rewrite_context(self):
+        context = RewriteContext('http://example.com', {'abc': 'http://a.b'})
+        self.assertEqual(context.links, {'http://a.b': 'abc'})
+        self.assertEqual(
+            context.redirect_url.format(
+                identifier=self.mail.identifier, link_identifier='abc'),
+            'http://example.com/' + reverse('tracking-redirect', kwargs={
+                'identifier': self.mail.identifier,
+                'link_identifier': 'abc'}).strip('/'))
+        self.assertEqual(
+            context.open_url.format(identifier=self.mail.identifier),
+            mk_tracking_url('http://example.com', self.mail.identifier))
+
+    def test_no_reverse_per_mail(self):
+        self.message.to_mail(self.mail)
+        mail = MailFactory(message=self.message)
+        with patch(
+                'munch.apps.tracking.utils.reverse',
+                wraps=reverse) as tracking_reverse, patch(
+                'munch.apps.campaigns.models.reverse',
+                wraps=reverse) as campaigns_reverse:
+            content = self.message.to_mail(mail)
+            plaintext, html = self.message.filter_body(mail)
+        tracking_reverse.assert_not_called()
+        campaigns_reverse.assert_not_called()
+        self.assertIn('/clicks/m/{}/'.format(mail.identifier), html)
+        self.assertEqual(content.alternatives[0][0], html)
+
     def test_invalid_tracker(self):
         resp = self.client.get('/t/open/4242')
         self.assertEqual(resp.status_code, 200)
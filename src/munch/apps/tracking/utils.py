@@ -4,11 +4,16 @@ import json
 import lxml.etree
 from lxml.cssselect import CSSSelector
 from django.core import signing
+from django.urls import reverse
 from django.utils.encoding import force_text
 from django.utils.encoding import force_bytes
 from django.utils.http import urlsafe_base64_encode
 from django.utils.http import urlsafe_base64_decode
 
+from munch.core.mail.utils import UrlTemplate
+
+links_selector = CSSSelector('a')
+
 
 class WebKey:
     """ Webkey protects access to model resources by signature
@@ -53,26 +58,62 @@ class WebKey:
 
 
 def get_msg_links(html):
-    from munch.apps.tracking.models import LinkMap
-
-    links_selector = CSSSelector('a')
-    links = []
-
     try:
         doc = lxml.etree.HTML(html).getroottree()
     except lxml.etree.XMLSyntaxError:
         return {}
 
+    return create_links_map(extract_doc_links(doc))
+
+
+def extract_doc_links(doc):
+    """ Ordered, deduplicated list of http(s) links of a parsed HTML tree """
+    links, seen = [], set()
     for link in links_selector(doc):
         original_url = link.get('href') or ''
         original_url = original_url.strip()
 
-        if original_url.startswith('http'):
-            if original_url not in links:
-                links.append(original_url)
+        if original_url.startswith('http') and original_url not in seen:
+            seen.add(original_url)
+            links.append(original_url)
+    return links
+
+
+def create_links_map(links):
+    from munch.apps.tracking.models import LinkMap
 
     # Store the links_map with IDs as keys
     links_maps = LinkMap.objects.bulk_create(
         [LinkMap(link=link) for link in links])
 
     return {lm.identifier: lm.link for lm in links_maps}
+
+
+class RewriteContext:
+    """ What tracking filters need to rewrite the mails of a message
+
+    Built once per message and given to filters (as rewrite_context), so
+    that links map is inverted and tracking urls are reversed once, rather
+    than for every link of every mail.
+    """
+    def __init__(self, app_url, links_map=None):
+        self.app_url = app_url
+        # By url
+        self.links = {v: k for k, v in (links_map or {}).items()}
+        self.open_url = UrlTemplate(
+            lambda identifier: '{}/{}'.format(app_url, reverse(
+                'tracking-open',
+                kwargs={'identifier': identifier}).strip('/')),
+            'identifier')
+        self.redirect_url = UrlTemplate(
+            lambda identifier, link_identifier: '{}/{}'.format(
+                app_url, reverse('tracking-redirect', kwargs={
+                    'identifier': identifier,
+                    'link_identifier': link_identifier}).strip('/')),
+            'identifier', 'link_identifier')
+        self.web_redirect_url = UrlTemplate(
+            lambda web_key, link_identifier: '{}/{}'.format(
+                app_url, reverse('web-tracking-redirect', kwargs={
+                    'web_key': web_key,
+                    'link_identifier': link_identifier}).strip('/')),
+            'web_key', 'link_identifier')
@@ -0,0 +1,86 @@
+import logging
+
+from django.conf import settings
+
+from munch.core.celery import app
+from munch.core.celery import munch_tasks_router
+
+log = logging.getLogger(__name__)
+
+
+class Backpressure:
+    """ Tells the edge when to stop accepting mail
+
+    Broker queue depths (by worker type, see CeleryRouteMap) are sampled
+    every EDGE_BACKPRESSURE_INTERVAL seconds by a background greenlet, so
+    that checking for overload from SMTP commands never waits on the
+    broker. The greenlet pool usage of the edge is checked live.
+
+    If the broker can't be sampled, the last known depths are forgotten
+    and mail is accepted (fail open).
+    """
+    def __init__(self):
+        self.pool = None
+        self.depths = {}
+        self._greenlet = None
+
+    def start(self, pool=None):
+        import gevent
+
+        self.pool = pool
+        if self.get_queues_high_water() and self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+
+    def _run(self):
+        import gevent
+
+        while True:
+            self.sample()
+            gevent.sleep(settings.TRANSACTIONAL.get(
+                'EDGE_BACKPRESSURE_INTERVAL', 5))
+
+    def get_queues_high_water(self):
+        return settings.TRANSACTIONAL.get(
+            'EDGE_BACKPRESSURE_QUEUES_HIGH_WATER') or {}
+
+    def sample(self):
+        depths = {}
+        try:
+            with app.connection_or_acquire() as connection:
+                channel = connection.default_channel
+                for worker_type in self.get_queues_high_water():
+                    queue = munch_tasks_router.queues.get(worker_type)
+                    if queue is None:
+                        continue
+                    declared = channel.queue_declare(
+                        queue=queue['name'], passive=True)
+                    depths[worker_type] = declared.message_count
+        except Exception as err:
+            log.warning('Unable to sample broker queues depth: {}'.format(
+                err))
+        self.depths = depths
+        return depths
+
+    def get_overload_reason(self):
+        """ Return why the edge is overloaded, None if it is not """
+        for worker_type, high_water in self.get_queues_high_water().items():
+            depth = self.depths.get(worker_type)
+            if depth is not None and depth > high_water:
+                return '{} queue holds {} messages (high-water: {})'.format(
+                    worker_type, depth, high_water)
+
+        pool_high_water = settings.TRANSACTIONAL.get(
+            'EDGE_BACKPRESSURE_POOL_HIGH_WATER')
+        if self.pool is not None and self.pool.size and pool_high_water:
+            usage = len(self.pool) / self.pool.size
+            if usage > pool_high_water:
+                return '{} of {} connections in use'.format(
+                    len(self.pool), self.pool.size)
+
+
+backpressure = Backpressure()
@@ -15,7 +15,10 @@ def register_tasks():
             'munch.apps.transactional.status.ForwardDSN',
             'munch.apps.transactional.status.HandleDSNStatus',
             'munch.apps.transactional.status.HandleSMTPStatus',
-            'munch.apps.transactional.status.record_status'
+            'munch.apps.transactional.status.record_status',
+            'munch.apps.transactional.status.flush_status_buffer',
+            'munch.apps.transactional.status.flush_webhooks',
+            'munch.apps.transactional.status.flush_webhook',
         ],
     }
     munch_tasks_router.import_tasks_map(tasks_map, 'transactional')
@@ -29,6 +32,9 @@ def configure_worker(instance, **kwargs):
         from .status import forward_dsn  # noqa
         from .status import send_webhook  # noqa
         from .status import record_status  # noqa
+        from .status import flush_status_buffer  # noqa
+        from .status import flush_webhooks  # noqa
+        from .status import flush_webhook  # noqa
         from .status import handle_dsn_status  # noqa
         from .status import handle_smtp_status  # noqa
         sys.stdout.write('[transactional] Registering worker as STATUS...')
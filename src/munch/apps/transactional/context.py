@@ -0,0 +1,165 @@
+import time
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.core.cache import cache
+
+from munch.core.mail.utils import extract_domain
+from munch.apps.users.models import SmtpApplication
+from munch.apps.domains.models import SendingDomain
+
+log = logging.getLogger(__name__)
+
+# Process-wide cache of resolved contexts, keyed by SMTP username.
+_contexts = {}
+
+INVALIDATION_KEY = 'transactional:auth-context:invalidated:{}:{}'
+
+
+class AuthContext:
+    """ Everything queue policies need to know about an authenticated client
+
+    It is resolved once per SMTP session (see EdgeValidators.handle_auth)
+    and shared, read-only, by every envelope of that session, including the
+    ones produced by RecipientSplit.
+
+    A context expires after AUTH_CONTEXT_TTL seconds, or once its
+    application, user or organization was invalidated, by any process,
+    after it was resolved (see invalidate_auth_contexts()). Invalidations
+    are looked up in the shared cache at most every
+    AUTH_CONTEXT_CHECK_INTERVAL seconds.
+    """
+    def __init__(self, application, sending_domains, resolved_at=None):
+        self.application_id = application.pk
+        self.application_identifier = application.identifier
+        self.username = application.username
+        self.user = application.author
+        self.user_id = self.user.pk
+        self.organization = self.user.organization
+        self.organization_id = self.user.organization_id
+        self.sending_domains = {
+            domain.name: domain for domain in sending_domains}
+        self.creation_time = time.monotonic()
+        self.resolved_at = resolved_at or time.time()
+        self.checked_at = self.creation_time
+        self.expired = False
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        # Envelope.copy() deep-copies envelope.client, there is no need to
+        # duplicate model instances for each recipient.
+        return self
+
+    @classmethod
+    def from_application(cls, application, resolved_at=None):
+        sending_domains = SendingDomain.objects.filter(
+            organization=application.author.organization)
+        return cls(application, sending_domains, resolved_at)
+
+    def get_invalidation_keys(self):
+        return [
+            INVALIDATION_KEY.format('application', self.application_id),
+            INVALIDATION_KEY.format('user', self.user_id),
+            INVALIDATION_KEY.format('organization', self.organization_id)]
+
+    def is_expired(self):
+        if self.expired:
+            return True
+        now = time.monotonic()
+        ttl = settings.TRANSACTIONAL.get('AUTH_CONTEXT_TTL', 60)
+        if now - self.creation_time > ttl:
+            self.expired = True
+            return True
+        interval = settings.TRANSACTIONAL.get(
+            'AUTH_CONTEXT_CHECK_INTERVAL', 1)
+        if now - self.checked_at < interval:
+            return False
+        self.checked_at = now
+        try:
+            invalidations = cache.get_many(self.get_invalidation_keys())
+        except Exception:
+            # AUTH_CONTEXT_TTL still bounds staleness
+            log.warning(
+                'Unable to check auth context of "{}"'.format(self.username),
+                exc_info=True)
+            return False
+        self.expired = any(
+            date >= self.resolved_at for date in invalidations.values())
+        return self.expired
+
+    def get_sending_domain(self, email_addr):
+        return self.sending_domains.get(extract_domain(email_addr))
+
+
+def get_application_queryset():
+    return SmtpApplication.objects.select_related(
+        'author__organization__settings',
+        'author__organization__parent__settings')
+
+
+def cache_auth_context(application, resolved_at=None):
+    """
+    :param resolved_at: when application was fetched, defaults to now
+    """
+    context = AuthContext.from_application(application, resolved_at)
+    _contexts[context.username] = context
+    return context
+
+
+def get_auth_context(username):
+    """ Return the cached context for username, resolving it if needed """
+    context = _contexts.get(username)
+    if context is None or context.is_expired():
+        resolved_at = time.time()
+        context = cache_auth_context(
+            get_application_queryset().get(username=username), resolved_at)
+    return context
+
+
+def get_envelope_auth_context(envelope):
+    """ Return the context attached to envelope by the edge
+
+    Falls back on the process-wide cache for envelopes which did not go
+    through an SMTP session (policies applied by hand, tests...).
+    """
+    context = envelope.client.get('context')
+    if context is None:
+        context = get_auth_context(envelope.client.get('auth')[0])
+        envelope.client['context'] = context
+    return context
+
+
+def invalidate_auth_contexts(
+        application_id=None, user_id=None, organization_id=None):
+    """ Expire matching contexts, in this process and in every edge """
+    keys = [
+        INVALIDATION_KEY.format(kind, pk) for kind, pk in [
+            ('application', application_id), ('user', user_id),
+            ('organization', organization_id)]
+        if pk is not None]
+
+    def publish():
+        ttl = settings.TRANSACTIONAL.get('AUTH_CONTEXT_TTL', 60)
+        now = time.time()
+        try:
+            cache.set_many({key: now for key in keys}, ttl)
+        except Exception:
+            # Other edges resolve contexts again within AUTH_CONTEXT_TTL
+            log.error('Unable to invalidate auth contexts', exc_info=True)
+
+    # Edges resolving the context before commit would get stale data
+    transaction.on_commit(publish)
+
+    criteria = [
+        ('application_id', application_id),
+        ('user_id', user_id),
+        ('organization_id', organization_id)]
+    criteria = [(attr, value) for attr, value in criteria if value is not None]
+
+    for username, context in list(_contexts.items()):
+        if any(getattr(context, attr) == value for attr, value in criteria):
+            log.debug('Invalidating auth context of "{}"'.format(username))
+            _contexts.pop(username, None)
@@ -0,0 +1,150 @@
+import hmac
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+log = logging.getLogger(__name__)
+
+REVOCATION_KEY = 'transactional:smtp-auth:revoked:{}:{}'
+
+
+def mk_revocation_keys(application_id, user_id):
+    return [
+        REVOCATION_KEY.format('application', application_id),
+        REVOCATION_KEY.format('user', user_id)]
+
+
+def revoke_credentials(application_id=None, user_id=None):
+    """ Tell every edge process that cached credentials are stale
+
+    Edges verify credentials against the database again if they were
+    cached before the revocation date.
+    """
+    ttl = settings.TRANSACTIONAL.get('EDGE_AUTH_CACHE_TTL', 300)
+    now = time.time()
+    if application_id is not None:
+        cache.set(
+            REVOCATION_KEY.format('application', application_id), now, ttl)
+    if user_id is not None:
+        cache.set(REVOCATION_KEY.format('user', user_id), now, ttl)
+    credentials_cache.invalidate(
+        application_id=application_id, user_id=user_id)
+
+
+class VerifiedCredentials:
+    def __init__(self, digest, application_id, user_id):
+        self.digest = digest
+        self.application_id = application_id
+        self.user_id = user_id
+        self.verified_at = time.time()
+        self.expires_at = time.monotonic() + settings.TRANSACTIONAL.get(
+            'EDGE_AUTH_CACHE_TTL', 300)
+
+
+class CredentialsCache:
+    """ Bounded LRU/TTL cache of SMTP credentials verified by the edge
+
+    Only a keyed digest (HMAC-SHA256 with SECRET_KEY) of each verified
+    secret is kept. Hits are checked against revocation markers stored in
+    the shared cache by revoke_credentials(), so that regenerated
+    credentials or deactivated users are refused by every edge process.
+
+    Failed logins are cached too (negative caching) and counted by client
+    address, so that brute-forcing clients get rate limited without
+    hitting the database.
+    """
+    def __init__(self):
+        self._verified = OrderedDict()
+        self._failed = OrderedDict()
+        self._failures_by_client = {}
+
+    def clear(self):
+        self._verified.clear()
+        self._failed.clear()
+        self._failures_by_client.clear()
+
+    @staticmethod
+    def mk_digest(username, secret):
+        return hmac.new(
+            settings.SECRET_KEY.encode('utf-8'),
+            '{}\0{}'.format(username, secret).encode('utf-8'),
+            hashlib.sha256).digest()
+
+    def get(self, username, secret):
+        """ Return cached VerifiedCredentials matching, or None """
+        entry = self._verified.get(username)
+        if entry is None:
+            return None
+        if time.monotonic() > entry.expires_at or not hmac.compare_digest(
+                entry.digest, self.mk_digest(username, secret)):
+            return None
+        revoked_at = [
+            date for date in cache.get_many(mk_revocation_keys(
+                entry.application_id, entry.user_id)).values() if date]
+        if revoked_at and max(revoked_at) >= entry.verified_at:
+            self._verified.pop(username, None)
+            return None
+        self._verified.move_to_end(username)
+        return entry
+
+    def add(self, username, secret, application_id, user_id):
+        self._verified[username] = VerifiedCredentials(
+            self.mk_digest(username, secret), application_id, user_id)
+        self._verified.move_to_end(username)
+        self._failed.pop(self.mk_digest(username, secret), None)
+        max_size = settings.TRANSACTIONAL.get('EDGE_AUTH_CACHE_SIZE', 10000)
+        while len(self._verified) > max_size:
+            self._verified.popitem(last=False)
+
+    def invalidate(self, application_id=None, user_id=None):
+        for username, entry in list(self._verified.items()):
+            if (application_id is not None and
+                    entry.application_id == application_id) or (
+                    user_id is not None and entry.user_id == user_id):
+                self._verified.pop(username, None)
+
+    def has_failed(self, username, secret):
+        """ Were these exact credentials refused recently ? """
+        expires_at = self._failed.get(self.mk_digest(username, secret))
+        return expires_at is not None and time.monotonic() < expires_at
+
+    def add_failure(self, username, secret, client):
+        ttl = settings.TRANSACTIONAL.get('EDGE_AUTH_FAILURES_TTL', 60)
+        now = time.monotonic()
+        digest = self.mk_digest(username, secret)
+        self._failed[digest] = now + ttl
+        self._failed.move_to_end(digest)
+        max_size = settings.TRANSACTIONAL.get('EDGE_AUTH_CACHE_SIZE', 10000)
+        while len(self._failed) > max_size:
+            self._failed.popitem(last=False)
+
+        count, window_start = self._failures_by_client.get(client, (0, now))
+        if now - window_start > ttl:
+            count, window_start = 0, now
+        self._failures_by_client[client] = (count + 1, window_start)
+        if len(self._failures_by_client) > max_size:
+            self.purge_failures()
+
+    def purge_failures(self):
+        ttl = settings.TRANSACTIONAL.get('EDGE_AUTH_FAILURES_TTL', 60)
+        now = time.monotonic()
+        for client, (_, window_start) in list(
+                self._failures_by_client.items()):
+            if now - window_start > ttl:
+                del self._failures_by_client[client]
+
+    def is_rate_limited(self, client):
+        """ Did client fail to log in too many times recently ? """
+        count, window_start = self._failures_by_client.get(client, (0, 0))
+        ttl = settings.TRANSACTIONAL.get('EDGE_AUTH_FAILURES_TTL', 60)
+        if time.monotonic() - window_start > ttl:
+            return False
+        return count >= settings.TRANSACTIONAL.get(
+            'EDGE_AUTH_MAX_FAILURES', 10)
+
+
+credentials_cache = CredentialsCache()
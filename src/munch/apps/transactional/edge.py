@@ -11,11 +11,28 @@ from slimta.util.proxyproto import ProxyProtocolV2
 from slimta.util.proxyproto import LocalConnection
 from slimta.util.proxyproto import invalid_pp_source_address
 
+from munch.core.db.pool import release_connections
 from munch.apps.users.models import SmtpApplication
 
+from .context import get_auth_context
+from .backpressure import backpressure
+from .context import cache_auth_context
+from .context import get_application_queryset
+from .credentials import credentials_cache
+
 log = logging.getLogger(__name__)
 
 
+def get_plain_secret(creds):
+    """ Secret sent by the client, None for challenge-based mechanisms """
+    if not getattr(creds, 'has_secret', True):
+        return None
+    try:
+        return creds.secret
+    except Exception:
+        return None
+
+
 class EdgeValidators(SmtpValidators):
 
     def handle_banner(self, reply, address):
@@ -25,6 +42,12 @@ class EdgeValidators(SmtpValidators):
             self.cid, address[0], address[1]))
 
     def handle_auth(self, reply, creds):
+        try:
+            self.authenticate(reply, creds)
+        finally:
+            release_connections()
+
+    def authenticate(self, reply, creds):
         tls_settings = settings.TRANSACTIONAL.get('SMTP_SMARTHOST_TLS')
         if tls_settings is not None and not self.session.security:
             # Force authentication over TLS
@@ -32,18 +55,46 @@ class EdgeValidators(SmtpValidators):
             reply.message = '5.7.0 Must issue a STARTTLS command first'
             return
 
+        client = self.session.address[0]
+        if credentials_cache.is_rate_limited(client):
+            reply.code = '454'
+            reply.message = (
+                '4.7.0 Too many authentication failures, try again later')
+            log.warning(
+                '[{}] Refused login from "{}" (too many failures)'.format(
+                    self.cid, creds.authcid))
+            return
+
         authenticated = False
-        application = SmtpApplication.objects.filter(
-            username=creds.authcid, author__is_active=True).only(
-                'secret').first()
-        if application:
-            authenticated = creds.check_secret(application.secret)
-            if authenticated:
-                log.info('[{}] Successfull login from "{}:{}"'.format(
-                    self.cid, application.author.identifier,
-                    application.identifier))
-
-        if not authenticated:
+        secret = get_plain_secret(creds)
+        if secret is not None and credentials_cache.get(
+                creds.authcid, secret):
+            try:
+                self.auth_context = get_auth_context(creds.authcid)
+                authenticated = True
+            except SmtpApplication.DoesNotExist:
+                pass
+        elif secret is None or not credentials_cache.has_failed(
+                creds.authcid, secret):
+            application = get_application_queryset().filter(
+                username=creds.authcid, author__is_active=True).first()
+            if application:
+                authenticated = creds.check_secret(application.secret)
+                if authenticated:
+                    # Resolved once here, then shared by all queue policies
+                    self.auth_context = cache_auth_context(application)
+                    if secret is not None:
+                        credentials_cache.add(
+                            creds.authcid, secret,
+                            application.pk, application.author_id)
+
+        if authenticated:
+            log.info('[{}] Successfull login from "{}:{}"'.format(
+                self.cid, self.auth_context.user.identifier,
+                self.auth_context.application_identifier))
+        else:
+            if secret is not None:
+                credentials_cache.add_failure(creds.authcid, secret, client)
             reply.code = '535'
             reply.message = '5.7.8 Authentication credentials invalid'
             log.warning(
@@ -57,8 +108,47 @@ class EdgeValidators(SmtpValidators):
             reply.message = '5.7.0 Authentification is required'
             log.warning('[{}] Unauthenticated traffic from {} refused'.format(
                 self.cid, self.session.address[0]))
+            return
+        self.check_backpressure(reply)
+
+    def handle_data(self, reply):
+        self.check_backpressure(reply)
+
+    def check_backpressure(self, reply):
+        """ Shed load at SMTP level when workers can't keep up """
+        reason = backpressure.get_overload_reason()
+        if reason:
+            reply.code = '451'
+            reply.message = (
+                '4.3.2 System not accepting messages, try again later')
+            log.warning('[{}] Deferring mail from {}: {}'.format(
+                self.cid, self.session.address[0], reason))
+
+    def handle_have_data(self, reply, data):
+        context = getattr(self, 'auth_context', None)
+        if context is not None and context.is_expired():
+            # The session may outlive a change of its application, user or
+            # organization: resolve it again for this envelope.
+            try:
+                context = get_auth_context(context.username)
+            except SmtpApplication.DoesNotExist:
+                context = None
+            finally:
+                release_connections()
+            if context is None or not context.user.is_active:
+                reply.code = '535'
+                reply.message = '5.7.8 Authentication credentials revoked'
+                log.warning(
+                    '[{}] Refused mail from revoked "{}"'.format(
+                        self.cid, self.auth_context.username))
+                return
+            self.auth_context = context
+        if context is not None:
+            self.session.envelope.client['context'] = context
 
     def handle_queued(self, reply, results):
+        # Queue policies are done with the database
+        release_connections()
         log.info('[{}] Queued message from <{}> to <{}>'.format(
             self.cid, self.session.envelope.sender,
             ', '.join(self.session.envelope.recipients)))
@@ -72,9 +162,13 @@ class TransactionalSmtpEdge(SmtpEdge):
             address[0], address[1]))
         request_started.send(
             sender='transactional-edge-{}-{}'.format(address[0], address[1]))
-        super().handle(socket, address)
-        request_finished.send(
-            sender='transactional-edge-{}-{}'.format(address[0], address[1]))
+        try:
+            super().handle(socket, address)
+        finally:
+            # Always release database connection (back to the pool if any)
+            request_finished.send(
+                sender='transactional-edge-{}-{}'.format(
+                    address[0], address[1]))
 
 
 class ProxyProtocolTransactionalSmtpEdge(
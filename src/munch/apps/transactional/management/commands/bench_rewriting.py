@@ -0,0 +1,116 @@
+import time
+import email
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+import lxml.etree
+from django.core.management.base import BaseCommand
+
+from munch.apps.tracking.utils import extract_doc_links
+from munch.apps.optouts.contentfilters import set_unsubscribe_url
+from munch.apps.tracking.contentfilters import add_tracking_image
+from munch.apps.tracking.contentfilters import rewrite_html_links
+
+from ...rewriting import MessageRewriter
+
+HTML_CHUNK = (
+    '<p>Lorem ipsum dolor sit amet, <b>consectetur</b> adipiscing elit. '
+    '<a href="http://example.com/article/{0}">Read article {0}</a> or '
+    '<a href="http://example.com/static/logo.png">see the logo</a>.</p>\n')
+
+
+def mk_message(size):
+    """ Builds a multipart/alternative message with a ~size bytes html part
+    """
+    chunks, length, i = [], 0, 0
+    while length < size:
+        chunk = HTML_CHUNK.format(i)
+        chunks.append(chunk)
+        length += len(chunk)
+        i += 1
+    html = (
+        '<!DOCTYPE html><html><head><title>Bench</title></head><body>'
+        '{}<a href="UNSUBSCRIBE_URL">Unsubscribe</a></body></html>').format(
+            ''.join(chunks))
+    message = MIMEMultipart('alternative')
+    message.attach(MIMEText('Plaintext version\nUNSUBSCRIBE_URL', 'plain'))
+    message.attach(MIMEText(html, 'html'))
+    return message.as_bytes()
+
+
+def mk_links_map(links):
+    """ In-memory stand-in for tracking.utils.create_links_map """
+    return {str(i): link for i, link in enumerate(links)}
+
+
+def legacy_rewrite(data, **munchers_kwargs):
+    """ Former Store behaviour: one parse and serialization per filter """
+    message = email.message_from_bytes(data)
+    html = ''
+    for part in message.walk():
+        if part.get_content_type() == 'text/html':
+            html += part.get_payload()
+    links_map = mk_links_map(
+        extract_doc_links(lxml.etree.HTML(html).getroottree()))
+    munchers_kwargs['links_map'] = links_map
+
+    track_open_done = False
+    for part in message.walk():
+        if part.get_content_type() == 'text/html':
+            html = part.get_payload()
+            if not track_open_done:
+                html = add_tracking_image(html, **munchers_kwargs)
+                track_open_done = True
+            html = rewrite_html_links(html, **munchers_kwargs)
+            part.set_payload(html)
+        content = part.get_payload()
+        if isinstance(content, str):
+            part.set_payload(set_unsubscribe_url(content, **munchers_kwargs))
+    return message
+
+
+def single_pass_rewrite(data, **munchers_kwargs):
+    message = email.message_from_bytes(data)
+    rewriter = MessageRewriter(message, **munchers_kwargs)
+    rewriter.rewrite(mk_links_map(rewriter.get_links()))
+    return message
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure per-message latency of transactional content rewriting '
+        '(tracking pixel, links rewriting, unsubscribe url). '
+        'Nothing is written to the database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size', dest='sizes', action='append', type=int,
+            help='HTML body size in KB (default: 50 and 500)')
+        parser.add_argument(
+            '--iterations', dest='iterations', type=int, default=20)
+
+    def timeit(self, func, data, iterations, **kwargs):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func(data, **kwargs)
+        return (time.perf_counter() - start) / iterations * 1000
+
+    def handle(self, *args, **options):
+        munchers_kwargs = {
+            'mail_identifier': 'bench-identifier',
+            'app_url': 'http://munch.example.com',
+            'track_open': True,
+            'track_clicks': True,
+            'unsubscribe_url': 'http://munch.example.com/h/unsubscribe/'}
+        iterations = options['iterations']
+
+        for size in options['sizes'] or [50, 500]:
+            data = mk_message(size * 1024)
+            legacy = self.timeit(
+                legacy_rewrite, data, iterations, **munchers_kwargs)
+            single = self.timeit(
+                single_pass_rewrite, data, iterations, **munchers_kwargs)
+            self.stdout.write(
+                '{:>5} KB html: legacy {:8.2f} ms/msg, '
+                'single-pass {:8.2f} ms/msg ({:.1f}x)'.format(
+                    size, legacy, single, legacy / single))
@@ -207,15 +207,15 @@ class Mail(AbstractOwnedModel, AbstractMail):
                 value = header.encode(linesep='\r\n')
             headers += "{}: {}\n".format(key, value)
 
-        message = ""
+        message = b""
         if self.message:
-            message = self.message.content or ""
+            message = self.message.raw_content
 
         if self.message is None and must_raise:
             raise Exception(
                 "Can't build this envelope because "
                 "there is no RawMail attached to it.")
-        envelope.parse(headers.encode('utf-8') + message.encode('utf-8'))
+        envelope.parse(headers.encode('utf-8') + message)
         envelope.sender = self.sender
         envelope.recipients.append(self.recipient)
         return envelope
@@ -246,22 +246,12 @@ class MailStatus(AbstractOwnedModel, AbstractMailStatus):
     owner_path = 'mail__author__organization'
     author_path = 'mail__author'
 
+    release_final_messages = True
+
     class Meta:
         verbose_name = _('mail status')
         verbose_name_plural = _('mail statuses')
         get_latest_by = 'creation_date'
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        must_save_mail = False
-        if self.status in self.FINAL_STATES:
-            self.mail.message = None
-            must_save_mail = True
-        if self.status == AbstractMailStatus.DROPPED:
-            self.mail.had_delay = True
-            must_save_mail = True
-        if must_save_mail:
-            self.mail.save()
-
     def __str__(self):
         return _('Message {} is {}').format(self.mail.identifier, self.status)
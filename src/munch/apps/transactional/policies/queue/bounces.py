@@ -1,15 +1,13 @@
 import logging
 
 from django.conf import settings
-from django.db.models import Prefetch
 from slimta.policy import QueuePolicy
 from slimta.queue import QueueError
 from slimta.smtp.reply import Reply
 
-from munch.apps.optouts.models import OptOut
-from munch.apps.users.models import MunchUser
-from munch.apps.users.models import Organization
-from munch.apps.users.models import SmtpApplication
+from munch.apps.optouts.index import optout_index
+
+from ...context import get_envelope_auth_context
 
 logger = logging.getLogger(__name__)
 
@@ -21,36 +19,17 @@ class Check(QueuePolicy):
             code='521',
             message='5.7.1 Email to this recipient will not be delivered')
 
-        if OptOut.objects.filter(
-                origin=OptOut.BY_BOUNCE,
-                address=envelope.recipients[0]).exists():
-            raise error
-
-        # Sorry about that, it's just a big query set with prefetch related
-        user = SmtpApplication.objects.prefetch_related(
-            Prefetch(
-                'author',
-                MunchUser.objects.prefetch_related(
-                    Prefetch('organization', Organization.objects.all().only(
-                        'id'))).all().only('organization'))).only(
-                            'author').get(username=envelope.client.get(
-                                'auth')[0]).author
+        context = get_envelope_auth_context(envelope)
 
         # Attach theses attributs to envelope to avoid re-requesting it later
-        envelope.user = user
-        envelope.organization = user.organization
+        envelope.user = context.user
+        envelope.organization = context.organization
 
         category = envelope.headers.get(
             settings.TRANSACTIONAL.get(
                 'X_MAIL_BATCH_CATEGORY_HEADER', None))
-        if category:
-            if OptOut.objects.exclude(
-                    origin=OptOut.BY_BOUNCE).filter(
-                        author__organization=envelope.organization,
-                        category__name=category).exists():
-                raise error
-        else:
-            if OptOut.objects.exclude(
-                    origin=OptOut.BY_BOUNCE).filter(
-                        author__organization=envelope.organization).exists():
-                raise error
+        if optout_index.is_suppressed(
+                envelope.recipients[0],
+                organization_id=context.organization_id,
+                category_name=category or None):
+            raise error
@@ -1,4 +1,5 @@
 import os
+import time
 import logging
 
 from django.conf import settings
@@ -8,44 +9,114 @@ from slimta.policy import QueuePolicy
 logger = logging.getLogger(__name__)
 
 
+def mk_sandbox_builtins():
+    sandbox_builtins = {
+        'settings': settings,
+        'cache': cache,
+        'logger': logger,
+        'print': print
+    }
+    for mod in settings.TRANSACTIONAL.get(
+            'EXEC_QUEUE_POLICIES_CONTEXT_BUILTINS'):
+        sandbox_builtins[mod] = __import__(mod)
+    return sandbox_builtins
+
+
+class CompiledPolicy:
+    """ An ephemeral policy file, compiled once per modification time
+
+    Sandbox builtins are built along with the code, and each execution gets
+    its own copy, so that a policy cannot alter them for other executions.
+    """
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+        with open(path) as module:
+            self.code = compile(module.read(), path, 'exec')
+        self.sandbox_builtins = mk_sandbox_builtins()
+        # Execution statistics (number of calls, cumulated seconds)
+        self.calls = 0
+        self.total_time = 0.
+
+    def __call__(self, envelope):
+        ephemeral_context = {}
+        start = time.perf_counter()
+        try:
+            exec(
+                self.code, {'__builtins__': dict(self.sandbox_builtins)},
+                ephemeral_context)
+            ephemeral_context.get('apply')(envelope)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self.total_time += elapsed
+            record_timing(self.path, elapsed)
+
+
+def record_timing(path, elapsed):
+    logger.debug('Ephemeral policy "{}" executed in {:.2f}ms'.format(
+        path, elapsed * 1000))
+    if settings.STATSD_ENABLED:
+        from statsd.defaults.django import statsd
+        name = os.path.splitext(os.path.basename(path))[0]
+        statsd.timing(
+            'transactional.exec_policies.{}'.format(name), elapsed * 1000)
+
+
 class Apply(QueuePolicy):
     """
     Execute abritary policies on file system based on EXEC_QUEUE_POLICIES
+
+    Policy files are compiled once and recompiled only when their
+    modification time changes (checked at most every
+    EXEC_QUEUE_POLICIES_CHECK_INTERVAL seconds).
     """
+    # Compiled policies, by path
+    policies = {}
+
+    @classmethod
+    def get_policy(cls, path):
+        """ Return the compiled policy at path, None if it doesn't exist """
+        policy = cls.policies.get(path)
+        interval = settings.TRANSACTIONAL.get(
+            'EXEC_QUEUE_POLICIES_CHECK_INTERVAL', 0)
+        if policy and time.monotonic() - policy.checked_at < interval:
+            return policy
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            cls.policies.pop(path, None)
+            return None
+
+        if policy is None or policy.mtime != mtime:
+            if policy is not None:
+                logger.info('Reloading ephemeral policy "{}"'.format(path))
+            policy = cls.policies[path] = CompiledPolicy(path, mtime)
+        else:
+            policy.checked_at = time.monotonic()
+        return policy
+
     def apply(self, envelope):
         for path in settings.TRANSACTIONAL.get('EXEC_QUEUE_POLICIES'):
-
-            if os.path.exists(path):
-                with open(path) as module:
-
-                    ephemeral_context = {}
-
-                    allowed_context = {'__builtins__': {
-                        'settings': settings,
-                        'cache': cache,
-                        'logger': logger,
-                        'print': print
-                    }}
-                    for mod in settings.TRANSACTIONAL.get('EXEC_QUEUE_POLICIES_CONTEXT_BUILTINS'):
-                        allowed_context['__builtins__'][mod] = __import__(mod)
-
-                    try:
-                        exec(module.read(), allowed_context, ephemeral_context)
-                        ephemeral_context.get('apply')(envelope)
-                    except Exception as err:
-                        logger.warning(
-                            '[{}] Failed to execute "{}" ephemeral '
-                            'policy: {}'.format(
-                                envelope.headers.get(
-                                    settings.TRANSACTIONAL.get(
-                                        'X_MESSAGE_ID_HEADER',
-                                        'NO-MESSAGE-ID')),
-                                path, err))
-
-            else:
+            try:
+                policy = self.get_policy(path)
+                if policy is None:
+                    logger.warning(
+                        "[{}] Following ephemeral policy doesn't "
+                        "exists: {}".format(
+                            envelope.headers.get(settings.TRANSACTIONAL.get(
+                                'X_MESSAGE_ID_HEADER', 'NO-MESSAGE-ID')),
+                            path))
+                    continue
+                policy(envelope)
+            except Exception as err:
                 logger.warning(
-                    "[{}] Following ephemeral policy doesn't "
-                    "exists: {}".format(
-                        envelope.headers.get(settings.TRANSACTIONAL.get(
-                            'X_MESSAGE_ID_HEADER', 'NO-MESSAGE-ID')),
-                        path))
+                    '[{}] Failed to execute "{}" ephemeral '
+                    'policy: {}'.format(
+                        envelope.headers.get(
+                            settings.TRANSACTIONAL.get(
+                                'X_MESSAGE_ID_HEADER',
+                                'NO-MESSAGE-ID')),
+                        path, err))
@@ -6,7 +6,7 @@ from slimta.policy import QueuePolicy
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
 
-from munch.apps.domains.models import SendingDomain
+from ...context import get_envelope_auth_context
 
 
 class Check(QueuePolicy):
@@ -27,10 +27,8 @@ class Check(QueuePolicy):
                     'Sending domain invalid').format(envelope.recipients[0]))
             raise error
 
-        organization_domain = SendingDomain.objects.filter(
-            organization=envelope.organization)
-        domain = organization_domain.get_from_email_addr(
-            sender_email, must_raise=False)
+        domain = get_envelope_auth_context(envelope).get_sending_domain(
+            sender_email)
 
         if not domain:
             error = QueueError()
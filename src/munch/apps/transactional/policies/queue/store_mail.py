@@ -1,7 +1,13 @@
 import email
+import socket
+from datetime import timedelta
 
 from django.conf import settings
+from django.db import router
 from django.db import transaction
+from django.db.models.signals import pre_save
+from django.db.models.signals import post_save
+from django.utils import timezone
 from slimta.policy import QueuePolicy
 from slimta.relay import PermanentRelayError
 
@@ -9,24 +15,81 @@ from munch.core.mail.models import RawMail
 from munch.core.mail.utils import get_app_url
 from munch.core.mail.utils import extract_domain
 from munch.apps.campaigns.models import Category
-from munch.apps.tracking.utils import get_msg_links
-from munch.apps.optouts.contentfilters import set_unsubscribe_url
-from munch.apps.tracking.contentfilters import add_tracking_image
-from munch.apps.tracking.contentfilters import rewrite_html_links
+from munch.apps.tracking.utils import create_links_map
 
 from ...models import Mail
 from ...models import MailBatch
 from ...models import MailStatus
+from ...rewriting import MessageRewriter
 
 
 class Store(QueuePolicy):
     """
     Should occur after a n eventual return-path rewrite,
     as data is return-path-indexed.
+
+    TransactionalQueue calls apply_batch() with all the envelopes of one
+    SMTP transaction (after recipients split), so that they are persisted
+    in a few bulk queries.
     """
 
-    @transaction.atomic()
     def apply(self, envelope):
+        self.apply_batch([envelope])
+
+    @transaction.atomic()
+    def apply_batch(self, envelopes):
+        prepared = [self.prepare(envelope) for envelope in envelopes]
+
+        # Links are content-addressed, resolve them once for the whole batch
+        all_links = []
+        for _, rewriter, _ in prepared:
+            all_links.extend(rewriter.get_links())
+        links_ids = {
+            link: identifier for identifier, link in create_links_map(
+                all_links).items()}
+
+        for envelope, rewriter, mail_kwargs in prepared:
+            msg_links = {
+                links_ids[link]: link for link in rewriter.get_links()}
+            mail_kwargs.update({'msg_links': msg_links})
+            rewriter.rewrite(msg_links)
+            envelope.parse_msg(rewriter.message)
+
+        batches = self.get_batches(prepared)
+        raw_mails = RawMail.objects.get_or_create_many(
+            [envelope.message for envelope in envelopes])
+
+        # Mails are created with their "queued" status already applied, as
+        # MailStatus.save() would do through update_mail_status()
+        now = timezone.now()
+        mails = []
+        for (envelope, _, mail_kwargs), raw_mail in zip(prepared, raw_mails):
+            mails.append(Mail(
+                author=envelope.user,
+                batch=batches.get(self.get_batch_key(envelope)),
+                identifier=envelope.headers.get(
+                    settings.TRANSACTIONAL['X_MESSAGE_ID_HEADER']),
+                headers={k: v.encode(
+                    'utf-8', 'surrogateescape').decode('utf-8') for k, v in
+                    envelope.headers.raw_items()},
+                message=raw_mail, sender=envelope.sender,
+                recipient=envelope.recipients[0],
+                curstatus=MailStatus.QUEUED,
+                first_status_date=now, latest_status_date=now,
+                delivery_duration=timedelta(),
+                **mail_kwargs))
+        mails = Mail.objects.bulk_create(mails)
+
+        source_hostname = socket.getfqdn()
+        statuses = [MailStatus(
+            mail=mail, status=MailStatus.QUEUED, creation_date=now,
+            source_hostname=source_hostname,
+            destination_domain=extract_domain(mail.recipient))
+            for mail in mails]
+        self.bulk_create_statuses(statuses)
+
+    def prepare(self, envelope):
+        """ Validate envelope and parse its content for rewriting """
         identifier = envelope.headers.get(
             settings.TRANSACTIONAL['X_MESSAGE_ID_HEADER'])
         if not identifier or not envelope.client.get('auth'):
@@ -41,11 +104,9 @@ class Store(QueuePolicy):
                 organization=envelope.organization),
         }
 
-        msg_links = {}
         mail_kwargs = {}
         track_open = envelope.headers.get(
             settings.TRANSACTIONAL.get('X_MAIL_TRACK_OPEN_HEADER', None))
-        track_open_done = False
         if track_open:
             munchers_kwargs.update({'track_open': True})
             mail_kwargs.update({'track_open': True})
@@ -63,67 +124,62 @@ class Store(QueuePolicy):
                 'unsubscribe_url': Mail.unsubscribe_url(
                     identifier, envelope.user, envelope.sending_domain)})
 
-        # Retrieve full html to extract links
-        html = ''
+        # Parse every html part once, links are extracted then rewritten
         message = email.message_from_bytes(b'\n'.join(envelope.flatten()))
-        for part in message.walk():
-            if part.get_content_type() == 'text/html':
-                html += part.get_payload()
-
-        msg_links = get_msg_links(html)
-        mail_kwargs.update({'msg_links': msg_links})
-        munchers_kwargs.update({'links_map': msg_links})
-
-        # Walk throught every parts to apply munchers on it
-        for part in message.walk():
-            if part.get_content_type() == 'text/html':
-                html = part.get_payload()
-                if track_open and not track_open_done:
-                    html = add_tracking_image(html, **munchers_kwargs)
-                    track_open_done = True
-                if track_clicks:
-                    html = rewrite_html_links(html, **munchers_kwargs)
-                part.set_payload(html)
-
-            content = part.get_payload()
-
-            if add_unsubscribe:
-                content = set_unsubscribe_url(content, **munchers_kwargs)
-
-            part.set_payload(content)
-
-        envelope.parse_msg(message)
+        return envelope, MessageRewriter(message, **munchers_kwargs), \
+            mail_kwargs
+
+    def get_batch_key(self, envelope):
+        return (
+            envelope.user.pk,
+            envelope.headers.get(
+                settings.TRANSACTIONAL.get('X_MAIL_BATCH_HEADER', None)),
+            envelope.headers.get(
+                settings.TRANSACTIONAL.get(
+                    'X_MAIL_BATCH_CATEGORY_HEADER', None)))
+
+    def get_batches(self, prepared):
+        """ Resolve each distinct (author, batch, category) only once """
+        batches = {}
+        for envelope, _, mail_kwargs in prepared:
+            key = self.get_batch_key(envelope)
+            _, batch, category = key
+            if not batch:
+                continue
+            msg_links = mail_kwargs['msg_links']
+            if key in batches:
+                # Keep links of the last mail, as sequential stores did
+                batches[key].msg_links = msg_links
+                continue
 
-        batch = envelope.headers.get(
-            settings.TRANSACTIONAL.get('X_MAIL_BATCH_HEADER', None))
-        if batch:
             batch, created = MailBatch.objects.get_or_create(
                 name=batch, author=envelope.user,
                 defaults={'msg_links': msg_links})
             if not created:
                 batch.msg_links = msg_links
-                batch.save()
-            category = envelope.headers.get(
-                settings.TRANSACTIONAL.get(
-                    'X_MAIL_BATCH_CATEGORY_HEADER', None))
             if category:
                 category, _ = Category.objects.get_or_create(
                     author=envelope.user, name=category)
                 batch.category = category
-                batch.save()
-
-        raw_mail, _ = RawMail.objects.get_or_create(content=envelope.message)
-        mail = Mail.objects.create(
-            author=envelope.user,
-            batch=batch,
-            identifier=envelope.headers.get(
-                settings.TRANSACTIONAL['X_MESSAGE_ID_HEADER']),
-            headers={k: v.encode(
-                'utf-8', 'surrogateescape').decode('utf-8') for k, v in
-                envelope.headers.raw_items()},
-            message=raw_mail, sender=envelope.sender,
-            recipient=envelope.recipients[0],
-            **mail_kwargs)
-        MailStatus.objects.create(
-            mail=mail,
-            destination_domain=extract_domain(envelope.recipients[0]))
+            batches[key] = batch
+
+        for batch in set(batches.values()):
+            batch.save()
+        return batches
+
+    def bulk_create_statuses(self, statuses):
+        """ bulk_create() does not send signals, send them by hand
+
+        Status-related backends (see core.mail.backend) listen to them.
+        """
+        using = router.db_for_write(MailStatus)
+        for status in statuses:
+            pre_save.send(
+                sender=MailStatus, instance=status, raw=False,
+                using=using, update_fields=None)
+        statuses = MailStatus.objects.bulk_create(statuses)
+        for status in statuses:
+            post_save.send(
+                sender=MailStatus, instance=status, created=True, raw=False,
+                using=using, update_fields=None)
+        return statuses
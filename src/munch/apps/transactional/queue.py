@@ -48,23 +48,22 @@ class TransactionalQueue:
         return results
 
     def _run_policies(self, envelope):
-        results = [envelope]
+        """ Apply policies in turn to the envelope, and to the envelopes
+        it was split into.
 
-        def recurse(current, i):
-            try:
-                policy = self.queue_policies[i]
-            except IndexError:
-                return
-            ret = policy.apply(current)
-            if ret:
-                results.remove(current)
-                results.extend(ret)
-                for env in ret:
-                    recurse(env, i + 1)
-            else:
-                recurse(current, i + 1)
-
-        recurse(envelope, 0)
+        Policies providing an apply_batch() method (see store_mail.Store)
+        are given every resulting envelope at once.
+        """
+        results = [envelope]
+        for policy in self.queue_policies:
+            if hasattr(policy, 'apply_batch'):
+                policy.apply_batch(results)
+                continue
+            envelopes = []
+            for current in results:
+                ret = policy.apply(current)
+                envelopes.extend(ret or [current])
+            results = envelopes
         return results
 
     def _initiate_attempt(self, envelope, attempts=0):
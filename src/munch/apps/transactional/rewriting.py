@@ -0,0 +1,106 @@
+import lxml.html
+import lxml.etree
+
+from munch.apps.tracking.utils import RewriteContext
+from munch.apps.tracking.utils import extract_doc_links
+from munch.apps.optouts.contentfilters import set_unsubscribe_url
+from munch.apps.tracking.contentfilters import rewrite_html_links
+from munch.apps.tracking.contentfilters import append_tracking_image
+
+
+def parse_html(html):
+    """ Parse html once, returning its root tree (None if unparsable) """
+    try:
+        root = lxml.etree.HTML(html)
+    except (lxml.etree.XMLSyntaxError, ValueError):
+        return None
+    if root is None:
+        return None
+    # use the root tree to preserve doctype
+    return root.getroottree()
+
+
+class HTMLPart:
+    """ A text/html MIME part, parsed only once """
+    def __init__(self, part):
+        self.part = part
+        self.doc = parse_html(part.get_payload())
+        self.modified = False
+
+    def serialize(self):
+        """ Write back the tree into the part, only if it was modified """
+        if self.modified:
+            self.part.set_payload(lxml.html.tostring(self.doc).decode())
+
+
+class MessageRewriter:
+    """ Single-pass rewriting of a transactional message
+
+    Each HTML part is parsed once; links extraction, tracking pixel
+    insertion and links rewriting all work on that same tree, which is then
+    serialized once. Unsubscribe placeholder substitution is a plain string
+    replacement applied on every part afterwards.
+
+    Usage::
+
+        rewriter = MessageRewriter(message, **munchers_kwargs)
+        links_map = create_links_map(rewriter.get_links())
+        rewriter.rewrite(links_map)
+    """
+    def __init__(
+            self, message, mail_identifier=None, app_url=None,
+            track_open=False, track_clicks=False, unsubscribe_url=None,
+            **kwargs):
+        self.message = message
+        self.mail_identifier = mail_identifier
+        self.app_url = app_url
+        self.track_open = track_open
+        self.track_clicks = track_clicks
+        self.unsubscribe_url = unsubscribe_url
+
+        self.html_parts = [
+            HTMLPart(part) for part in message.walk()
+            if part.get_content_type() == 'text/html']
+
+    def get_links(self):
+        """ Ordered, deduplicated links of all HTML parts """
+        links, seen = [], set()
+        for html_part in self.html_parts:
+            if html_part.doc is None:
+                continue
+            for link in extract_doc_links(html_part.doc):
+                if link not in seen:
+                    seen.add(link)
+                    links.append(link)
+        return links
+
+    def rewrite(self, links_map):
+        parts = [p for p in self.html_parts if p.doc is not None]
+        context = RewriteContext(self.app_url, links_map)
+
+        if self.track_open and self.app_url and self.mail_identifier and \
+                parts:
+            append_tracking_image(
+                parts[0].doc, self.app_url, self.mail_identifier, context)
+            parts[0].modified = True
+
+        if self.track_clicks and \
+                not self.mail_identifier.startswith('test'):
+            for html_part in parts:
+                rewrite_html_links.rewrite_doc_links(
+                    html_part.doc, self.mail_identifier,
+                    self.unsubscribe_url, self.app_url,
+                    links_map, rewrite_html_links.rewrite, context)
+                html_part.modified = True
+
+        for html_part in parts:
+            html_part.serialize()
+
+        if self.unsubscribe_url:
+            for part in self.message.walk():
+                content = part.get_payload()
+                if isinstance(content, str):
+                    part.set_payload(set_unsubscribe_url(
+                        content, unsubscribe_url=self.unsubscribe_url))
+
+        return self.message
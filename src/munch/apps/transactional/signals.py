@@ -1,10 +1,49 @@
+from django.dispatch import receiver
 from django.db.models.signals import pre_save
 from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
 
 from munch.core.mail import backend
+from munch.apps.users.models import MunchUser
+from munch.apps.users.models import Organization
+from munch.apps.users.models import SmtpApplication
+from munch.apps.users.models import OrganizationSettings
+from munch.apps.domains.models import SendingDomain
 
 from .models import MailStatus
+from .context import invalidate_auth_contexts
+from .credentials import revoke_credentials
 
 # MailStatus
 pre_save.connect(backend.pre_save_mailstatus_signal, sender=MailStatus)
 post_save.connect(backend.post_save_mailstatus_signal, sender=MailStatus)
+
+
+# Edge auth contexts
+@receiver(post_save, sender=SmtpApplication)
+@receiver(post_delete, sender=SmtpApplication)
+def invalidate_application_context(sender, instance, **kwargs):
+    invalidate_auth_contexts(application_id=instance.pk)
+    # Credentials may have been regenerated (see regen_credentials)
+    revoke_credentials(application_id=instance.pk)
+
+
+@receiver(post_save, sender=MunchUser)
+@receiver(post_delete, sender=MunchUser)
+def invalidate_user_context(sender, instance, **kwargs):
+    invalidate_auth_contexts(user_id=instance.pk)
+    if not instance.is_active or kwargs.get('signal') is post_delete:
+        revoke_credentials(user_id=instance.pk)
+
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def invalidate_organization_context(sender, instance, **kwargs):
+    invalidate_auth_contexts(organization_id=instance.pk)
+
+
+@receiver(post_save, sender=OrganizationSettings)
+@receiver(post_save, sender=SendingDomain)
+@receiver(post_delete, sender=SendingDomain)
+def invalidate_organization_related_context(sender, instance, **kwargs):
+    invalidate_auth_contexts(organization_id=instance.organization_id)
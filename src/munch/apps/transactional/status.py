@@ -7,11 +7,12 @@ from email.utils import parseaddr
 from email.utils import formatdate
 
 import celery
-import requests
+from celery import task
 from django.conf import settings
 from slimta.envelope import Envelope
 
 from munch.core.mail.backend import Backend
+from munch.core.mail.statuses import StatusBuffer
 from munch.core.mail.utils import extract_domain
 from munch.core.mail.utils import parse_email_date
 from munch.core.utils.tasks import task_autoretry
@@ -25,11 +26,15 @@ from munch.core.mail.exceptions import RejectInvalidDSN
 
 from .models import Mail
 from .models import MailStatus
-from .utils import get_envelope_from_identifier
+from .utils import MailHeaders
+from .webhooks import WebhookError
+from .webhooks import webhook_dispatcher
 from .policies.relay.headers import return_path_parser
 
 log = logging.getLogger(__name__)
 
+status_buffer = StatusBuffer(MailStatus)
+
 
 class SendWebhook(celery.task.Task):
     max_retries = None
@@ -45,47 +50,34 @@ class SendWebhook(celery.task.Task):
         :param: the CM-Message-Id mail address of just sent envelope
         :return: the URL to notify status updates
         """
-        mail = Mail.objects.get(identifier=identifier)
-        http_return_path = mail.headers.get(
-            settings.X_HTTP_DSN_RETURN_PATH_HEADER, None)
-        if http_return_path:
-            return http_return_path.strip()
+        return MailHeaders.get(identifier).http_return_path
 
     def http_post(self, url, data):
-        tmp_err_msg = None
-
         try:
-            response = requests.post(url, json=data)
-        except requests.exceptions.ConnectionError as e:
-            tmp_err_msg = (
-                'Failed to log status "{}" to {} : {}'.format(
-                    data['status'], url, str(e)))
+            webhook_dispatcher.post(url, data)
+        except WebhookError as err:
+            tmp_err_msg = 'Failed to log status "{}" to {} : {}'.format(
+                data['status'], url, str(err))
         else:
-            if response.status_code in (200, 201):
-                log.info('Logged "{}" status to {}'.format(
-                    data['status'], url))
-            else:
-                tmp_err_msg = (
-                    'Failed to log status "{}" to {} (HTTP {})'.format(
-                        data['status'], url, response.status_code))
-        finally:
-            if tmp_err_msg is not None:
-                try:
-                    self.retry(
-                        countdown=settings.TRANSACTIONAL[
-                            'STATUS_WEBHOOK_RETRY_INTERVAL'],
-                        max_retries=settings.TRANSACTIONAL[
-                            'STATUS_WEBHOOK_RETRIES'])
-                except celery.exceptions.MaxRetriesExceededError:
-                    log.warn(
-                        'Too many errors while sending webhook, giving up.',
-                        exc_info=True, extra={'error_message': tmp_err_msg})
-                except celery.exceptions.Retry:
-                    # In case we just queued a retry task
-                    log.info(
-                        'Error while sending webhook (will retry later)',
-                        exc_info=True, extra={'error_message': tmp_err_msg})
-                    raise
+            log.info('Logged "{}" status to {}'.format(data['status'], url))
+            return
+
+        try:
+            self.retry(
+                countdown=settings.TRANSACTIONAL[
+                    'STATUS_WEBHOOK_RETRY_INTERVAL'],
+                max_retries=settings.TRANSACTIONAL[
+                    'STATUS_WEBHOOK_RETRIES'])
+        except celery.exceptions.MaxRetriesExceededError:
+            log.warn(
+                'Too many errors while sending webhook, giving up.',
+                exc_info=True, extra={'error_message': tmp_err_msg})
+        except celery.exceptions.Retry:
+            # In case we just queued a retry task
+            log.info(
+                'Error while sending webhook (will retry later)',
+                exc_info=True, extra={'error_message': tmp_err_msg})
+            raise
 
     def log_no_http_returnpath(self, identifier):
         # may become log.info() once we handle properly the sending of
@@ -94,20 +86,45 @@ class SendWebhook(celery.task.Task):
             '[{}] No {}, unable to HTTP-push the status'.format(
                 identifier, settings.X_HTTP_DSN_RETURN_PATH_HEADER))
 
-    def __call__(self, identifier, headers, data):
-        webhook_url = self.get_http_returnpath(identifier, headers)
-        if not webhook_url:
+    def __call__(self, identifier, headers, data, url=None, batching=False):
+        """ url is None for tasks queued before it was part of payloads
+
+        With batching, data is posted later on, in a list, by
+        flush_webhooks() (see X_HTTP_DSN_RETURN_PATH_BATCHING_HEADER).
+        """
+        if url is None:
+            url = self.get_http_returnpath(identifier, headers)
+        if not url:
             self.log_no_http_returnpath(identifier)
+        elif batching:
+            webhook_dispatcher.enqueue(url, data)
         else:
-            self.http_post(webhook_url, data)
+            self.http_post(url, data)
 
 
 send_webhook = SendWebhook()
 
 
+@task
+def flush_webhooks():
+    """ Post statuses queued by send_webhook (batching endpoints)
+
+    Each endpoint is flushed by its own task, so that a slow endpoint does
+    not delay the others.
+    """
+    for url in webhook_dispatcher.get_pending():
+        flush_webhook.apply_async(args=[url])
+
+
+@task
+def flush_webhook(url):
+    webhook_dispatcher.flush_endpoint(
+        url, settings.TRANSACTIONAL.get('STATUS_WEBHOOK_BATCH_SIZE', 100))
+
+
 class SendDSN(celery.task.Task):
     @staticmethod
-    def get_smtp_returnpath(identifier, headers, mail=None):
+    def get_smtp_returnpath(identifier, headers, mail_headers=None):
         """ Fetch the smtp stored returnpath
 
         See smtp_returnpath policy for the inverse action (storing)
@@ -115,15 +132,9 @@ class SendDSN(celery.task.Task):
         :param: the Return-Path mail address of just sent envelope
         :return: the URL to notify status updates
         """
-        if not mail:
-            mail = Mail.objects.get(identifier=identifier)
-        if mail.headers.get(
-                settings.X_HTTP_DSN_RETURN_PATH_HEADER, None):
-            return mail.headers.get(
-                settings.X_SMTP_DSN_RETURN_PATH_HEADER, None)
-        else:
-            return mail.headers.get(
-                settings.X_SMTP_DSN_RETURN_PATH_HEADER, mail.sender)
+        if mail_headers is None:
+            mail_headers = MailHeaders.get(identifier)
+        return mail_headers.smtp_return_path
 
     def send_dsn(self, envelope, recipient):
         backend = Backend()
@@ -220,6 +231,15 @@ class HandleDSNStatus(celery.task.Task):
 
             original_domain = extract_domain(recipient)
 
+            try:
+                mail_headers = MailHeaders.get(message_id)
+            except Mail.DoesNotExist:
+                # Nothing to record it for, nor anyone to forward it to
+                log.warning(
+                    '[{}] Dropping "{}" DSN ({}) for {}: unknown mail'.format(
+                        message_id, status, dsn.esmtp_status, recipient))
+                return
+
             # We use a generic source_ip for this status
             # since it is not linked to one of our workers
             raw_msg = ''
@@ -249,13 +269,16 @@ class HandleDSNStatus(celery.task.Task):
             self.retry(exc=exc)
 
         send_webhook.apply_async(
-            args=[message_id, original_dsn.as_string(), data])
+            args=[message_id, original_dsn.as_string(), data],
+            kwargs={
+                'url': mail_headers.http_return_path or '',
+                'batching': mail_headers.http_return_path_batching})
 
         # Forward DSN by mail
         # Only if status is Bounced or Dropped
         if status in [MailStatus.BOUNCED, MailStatus.DROPPED]:
             smtp_return_path = SendDSN.get_smtp_returnpath(
-                message_id, original_dsn)
+                message_id, original_dsn, mail_headers=mail_headers)
             if smtp_return_path:
                 # First, replace the the DSN To: (our return address) by the
                 # original sender so that it appears properly
@@ -293,8 +316,7 @@ class HandleSMTPStatus(celery.task.Task):
 
     def __call__(self, status, status_date, identifier, reply, relay_ehlo):
         try:
-            envelope = get_envelope_from_identifier(
-                identifier, only_headers=True)
+            mail_headers = MailHeaders.get(identifier)
 
             webhook_data = {
                 'status': status,
@@ -302,7 +324,7 @@ class HandleSMTPStatus(celery.task.Task):
                 'smtp_status': reply.code,
                 'esmtp_status': self._extract_esmtp_status(reply),
                 'date': status_date.isoformat(),
-                'recipient': envelope.recipients[0]}
+                'recipient': mail_headers.recipient}
         except Exception as exc:
             log.error(
                 'Error while handling SMTP Status. Retrying.', exc_info=True)
@@ -310,16 +332,19 @@ class HandleSMTPStatus(celery.task.Task):
 
         # Send Webhook
         send_webhook.apply_async(
-            [identifier, dict(envelope.headers), webhook_data])
+            [identifier, mail_headers.headers, webhook_data],
+            {'url': mail_headers.http_return_path or '',
+             'batching': mail_headers.http_return_path_batching})
 
         # Send DSN by mail
         # Only if status is Bounced or Dropped
         if status in [MailStatus.BOUNCED, MailStatus.DROPPED]:
             smtp_return_path = SendDSN.get_smtp_returnpath(
-                identifier, envelope.headers)
+                identifier, mail_headers.headers, mail_headers=mail_headers)
             if smtp_return_path:
+                # No client information is known past the relay
                 create_dsn.apply_async([
-                    identifier, dict(envelope.headers), envelope.client,
+                    identifier, mail_headers.headers, {},
                     reply, smtp_return_path, status_date, relay_ehlo])
 
         else:
@@ -336,16 +361,29 @@ handle_smtp_status = HandleSMTPStatus()
     autoretry_exclude=(SoftFailure, HardFailure, ),
     retry_message='Error while trying to record_status. Retrying.')
 def record_status(mailstatus, identifier, relay_ehlo, reply=None):
-    """ Save MailStatus and send SMTP Status task """
+    """ Save MailStatus and send SMTP Status task
+
+    With STATUS_BATCHING, the status is buffered and saved later on by
+    flush_status_buffer.
+    """
     log.info('[{}] Recording "{}" status...'.format(
         identifier, mailstatus.status))
     try:
-        mail = Mail.objects.get(identifier=identifier)
-        mailstatus.mail = mail
-        mailstatus.save()
+        if settings.TRANSACTIONAL.get('STATUS_BATCHING', False):
+            status_buffer.push(mailstatus, identifier)
+        else:
+            mail = Mail.objects.get(identifier=identifier)
+            mailstatus.mail = mail
+            mailstatus.save()
         if reply:
             handle_smtp_status.apply_async([
                 mailstatus.status, mailstatus.creation_date, identifier,
                 reply, relay_ehlo])
     except (SoftFailure, Mail.DoesNotExist) as exc:
         raise SoftFailure(exc)
+
+
+@task
+def flush_status_buffer():
+    """ Record statuses buffered by record_status (see STATUS_BATCHING) """
+    status_buffer.flush(settings.TRANSACTIONAL.get('STATUS_BATCH_SIZE', 1000))
@@ -23,5 +23,5 @@ class MailFactory(factory.django.DjangoModelFactory):
     headers = factory.LazyAttribute(lambda x: {
         'To': faker.email(), 'Date': format_datetime(datetime.now(pytz.UTC))})
     message = factory.LazyAttribute(
-        lambda x: RawMail.objects.create(content='Test'))
+        lambda x: RawMail.objects.get_or_create(content='Test')[0])
     author = factory.SubFactory(UserFactory)
@@ -0,0 +1,39 @@
+from unittest.mock import MagicMock
+
+from django.conf import settings
+from django.test import TestCase
+
+from ..backpressure import Backpressure
+
+
+class TestBackpressure(TestCase):
+    def setUp(self):
+        transactional_settings = settings.TRANSACTIONAL.copy()
+        transactional_settings.update({
+            'EDGE_BACKPRESSURE_QUEUES_HIGH_WATER': {'core': 100},
+            'EDGE_BACKPRESSURE_POOL_HIGH_WATER': 0.5})
+        self.settings_override = self.settings(
+            TRANSACTIONAL=transactional_settings)
+        self.settings_override.enable()
+        self.backpressure = Backpressure()
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def test_not_sampled(self):
+        self.assertIsNone(self.backpressure.get_overload_reason())
+
+    def test_queue_depth(self):
+        self.backpressure.depths = {'core': 100}
+        self.assertIsNone(self.backpressure.get_overload_reason())
+        self.backpressure.depths = {'core': 101}
+        self.assertIn('core', self.backpressure.get_overload_reason())
+
+    def test_pool_usage(self):
+        pool = MagicMock(size=10)
+        pool.__len__.return_value = 5
+        self.backpressure.pool = pool
+        self.assertIsNone(self.backpressure.get_overload_reason())
+        pool.__len__.return_value = 6
+        self.assertIn('connections', self.backpressure.get_overload_reason())
+
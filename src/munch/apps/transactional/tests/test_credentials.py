@@ -0,0 +1,66 @@
+from django.test import TestCase
+
+from munch.apps.users.tests.factories import SmtpApplicationFactory
+
+from ..credentials import credentials_cache
+
+
+class TestCredentialsCache(TestCase):
+    def setUp(self):
+        credentials_cache.clear()
+        self.application = SmtpApplicationFactory()
+
+    def cache_application(self):
+        credentials_cache.add(
+            self.application.username, self.application.secret,
+            self.application.pk, self.application.author_id)
+
+    def test_verified(self):
+        self.cache_application()
+        self.assertIsNotNone(credentials_cache.get(
+            self.application.username, self.application.secret))
+        self.assertIsNone(credentials_cache.get(
+            self.application.username, 'wrong'))
+
+    def test_no_clear_secret_stored(self):
+        self.cache_application()
+        entry = credentials_cache.get(
+            self.application.username, self.application.secret)
+        self.assertNotIn(
+            self.application.secret.encode('utf-8'), entry.digest)
+
+    def test_regen_credentials(self):
+        self.cache_application()
+        username, secret = self.application.username, self.application.secret
+        self.application.regen_credentials()
+        self.application.save()
+        self.assertIsNone(credentials_cache.get(username, secret))
+
+    def test_user_deactivation(self):
+        self.cache_application()
+        user = self.application.author
+        user.is_active = False
+        user.save()
+        self.assertIsNone(credentials_cache.get(
+            self.application.username, self.application.secret))
+
+    def test_revoked_in_another_process(self):
+        self.cache_application()
+        # Simulate another process: local cache is not invalidated
+        entries = dict(credentials_cache._verified)
+        self.application.save()
+        credentials_cache._verified.update(entries)
+        self.assertIsNone(credentials_cache.get(
+            self.application.username, self.application.secret))
+
+    def test_failures_rate_limit(self):
+        with self.settings(TRANSACTIONAL={
+                'EDGE_AUTH_MAX_FAILURES': 3, 'EDGE_AUTH_FAILURES_TTL': 60}):
+            for i in range(3):
+                self.assertFalse(credentials_cache.is_rate_limited('1.2.3.4'))
+                credentials_cache.add_failure(
+                    'foo', 'bar{}'.format(i), '1.2.3.4')
+            self.assertTrue(credentials_cache.is_rate_limited('1.2.3.4'))
+            self.assertFalse(credentials_cache.is_rate_limited('4.3.2.1'))
+            self.assertTrue(credentials_cache.has_failed('foo', 'bar0'))
+            self.assertFalse(credentials_cache.has_failed('foo', 'baz'))
@@ -1,5 +1,12 @@
+import os
+import time
+import tempfile
+
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from slimta.envelope import Envelope
@@ -8,6 +15,7 @@ from slimta.queue import QueueError
 from faker import Factory as FakerFactory
 
 from munch.core.models import Category
+from munch.core.mail.models import RawMail
 # from munch.core.utils.tests import temporary_settings
 # from munch.core.tests.factories import CategoryFactory
 from munch.apps.users.tests.factories import UserFactory
@@ -18,8 +26,13 @@ from munch.apps.optouts.tests.factories import OptOutFactory
 
 from ..models import Mail
 from ..models import MailBatch
+from ..models import MailStatus
+from ..context import INVALIDATION_KEY
+from ..context import get_auth_context
+from ..context import get_envelope_auth_context
 from ..policies.relay import headers as headers_policy
 from ..policies.queue import bounces
+from ..policies.queue import exec as exec_policy
 from ..policies.queue import identifier
 from ..policies.queue import store_mail
 from ..policies.queue import sending_domain
@@ -121,6 +134,50 @@ class TestStoreHeaders(PolicyCase):
         self.assertEqual(MailBatch.objects.count(), 1)
         self.assertEqual(Category.objects.count(), 0)
 
+    def store_batch(self, count):
+        headers = (
+            "From: test-from@example.com\n"
+            "Subject: foo\nTo: foo@bar\n{}: foo").format(
+                settings.TRANSACTIONAL['X_MAIL_BATCH_HEADER'])
+        envelopes = []
+        for i in range(count):
+            env = self.mk_envelope(
+                headers.encode('utf-8') + b'\n\n<a href="http://a.b">a</a>',
+                sender="test@example.com",
+                recipients=['test-to-{}@example.com'.format(i)])
+            env.client = {'auth': (self.smtp_application.username, None)}
+            env.user = self.user
+            identifier.Add().apply(env)
+            bounces.Check().apply(env)
+            sending_domain.Check().apply(env)
+            envelopes.append(env)
+
+        with CaptureQueriesContext(connection) as queries:
+            store_mail.Store().apply_batch(envelopes)
+        return envelopes, len(queries)
+
+    def test_store_mail_batch(self):
+        envelopes, _ = self.store_batch(5)
+
+        self.assertEqual(MailBatch.objects.count(), 1)
+        self.assertEqual(RawMail.objects.count(), 1)
+        for env in envelopes:
+            mail = Mail.objects.get(
+                identifier=env.headers.get(settings.TRANSACTIONAL[
+                    'X_MESSAGE_ID_HEADER']))
+            self.assertEqual(mail.recipient, env.recipients[0])
+            self.assertEqual(mail.batch.name, 'foo')
+            self.assertEqual(mail.curstatus, MailStatus.QUEUED)
+            self.assertEqual(mail.statuses.get().status, MailStatus.QUEUED)
+            self.assertIsNotNone(mail.first_status_date)
+
+    def test_store_mail_batch_queries(self):
+        # Creates the shared batch, links and raw mail
+        self.store_batch(1)
+        _, few = self.store_batch(2)
+        _, many = self.store_batch(20)
+        self.assertEqual(few, many)
+
     def test_store_mail_another_with_category(self):
         headers = (
             "From: test-from@example.com\n"
@@ -418,6 +475,57 @@ class TestStoreHeaders(PolicyCase):
         headers, body = env.flatten()
         self.assertIn('/h/subscriptions/', body.decode('utf-8'))
 
+    def test_track_open_clicks_and_unsubscribe(self):
+        headers = (
+            'From: test-from@example.com\n'
+            'Content-Type: multipart/alternative;\n'
+            ' boundary="===============0445577956452755870=="\n'
+            'Subject: foo\n'
+            'To: foo@bar\n'
+            '{}: true\n{}: true\n{}: true').format(
+                settings.TRANSACTIONAL['X_MAIL_TRACK_OPEN_HEADER'],
+                settings.TRANSACTIONAL['X_MAIL_TRACK_CLICKS_HEADER'],
+                settings.TRANSACTIONAL['X_MAIL_UNSUBSCRIBE_HEADER'])
+        body = (
+            '--===============0445577956452755870==\n'
+            'Content-Type: text/plain; charset="us-ascii"\n'
+            'MIME-Version: 1.0\n'
+            'Content-Transfer-Encoding: 7bit\n'
+            '\n'
+            'Unsub here: {}\n'
+            '--===============0445577956452755870==\n'
+            'Content-Type: text/html; charset="us-ascii"\n'
+            'MIME-Version: 1.0\n'
+            'Content-Transfer-Encoding: 7bit\n'
+            '\n'
+            '<a href="http://google.fr">Google!</a>\n'
+            '<a href="http://google.fr">Google again!</a>\n'
+            '<a href="{}">Unsubscribe here</a>\n'
+            '--===============0445577956452755870==--\n').format(
+                settings.OPTOUTS['UNSUBSCRIBE_PLACEHOLDER'],
+                settings.OPTOUTS['UNSUBSCRIBE_PLACEHOLDER'])
+        env = self.mk_envelope(
+            headers.encode('utf-8') + body.encode('utf-8'),
+            sender="test@example.com", recipients=['test-to@example.com'])
+        env.client = {'auth': (self.smtp_application.username, None)}
+        env.user = self.user
+
+        identifier.Add().apply(env)
+        bounces.Check().apply(env)
+        sending_domain.Check().apply(env)
+        store_mail.Store().apply(env)
+        headers, body = env.flatten()
+        body = body.decode('utf-8')
+        mail = Mail.objects.get(identifier=env.headers.get(
+            settings.TRANSACTIONAL['X_MESSAGE_ID_HEADER']))
+
+        self.assertEqual(list(mail.msg_links.values()), ['http://google.fr'])
+        self.assertEqual(body.count('/t/clicks/m/'), 2)
+        self.assertNotIn('http://google.fr', body)
+        self.assertEqual(body.count('/h/subscriptions/'), 2)
+        self.assertNotIn(settings.OPTOUTS['UNSUBSCRIBE_PLACEHOLDER'], body)
+        self.assertIn('/t/open/{}'.format(mail.identifier), body)
+
 
 class TestBounces(PolicyCase):
     def setUp(self):
@@ -563,6 +671,68 @@ class TestBounces(PolicyCase):
         bounces.Check().apply(envelope)
 
 
+class TestAuthContext(PolicyCase):
+    def setUp(self):
+        self.smtp_application = SmtpApplicationFactory()
+        self.organization = self.smtp_application.author.organization
+        self.domain = SendingDomainFactory(
+            name='example.com', organization=self.organization)
+
+    def test_context_shared_by_split_envelopes(self):
+        env = self.mk_envelope(
+            b"From: test-from@example.com\nSubject: foo",
+            sender="test@example.com",
+            recipients=['foo@example.com', 'bar@example.com'])
+        env.client = {'auth': (self.smtp_application.username, None)}
+        get_envelope_auth_context(env)
+        envelopes = [env.copy([rcpt]) for rcpt in env.recipients]
+
+        with self.assertNumQueries(0):
+            for envelope in envelopes:
+                sending_domain.Check().apply(envelope)
+
+        self.assertIs(
+            envelopes[0].client['context'], envelopes[1].client['context'])
+        self.assertEqual(envelopes[1].sending_domain, self.domain)
+
+    def test_context_invalidated_on_sending_domain_change(self):
+        context = get_auth_context(self.smtp_application.username)
+        self.assertIsNone(context.get_sending_domain('foo@example.org'))
+
+        SendingDomainFactory(
+            name='example.org', organization=self.organization)
+
+        context = get_auth_context(self.smtp_application.username)
+        self.assertIsNotNone(context.get_sending_domain('foo@example.org'))
+
+    def test_context_invalidated_on_credentials_change(self):
+        username = self.smtp_application.username
+        get_auth_context(username)
+
+        self.smtp_application.regen_credentials()
+        self.smtp_application.save()
+
+        with self.assertRaises(self.smtp_application.DoesNotExist):
+            get_auth_context(username)
+
+    def test_context_invalidated_by_other_process(self):
+        context = get_auth_context(self.smtp_application.username)
+        self.assertFalse(context.is_expired())
+
+        # Another process saved the organization: only the shared stamp
+        # is visible from here
+        cache.set(
+            INVALIDATION_KEY.format('organization', self.organization.pk),
+            time.time())
+
+        transactional_settings = settings.TRANSACTIONAL.copy()
+        transactional_settings['AUTH_CONTEXT_CHECK_INTERVAL'] = 0
+        with self.settings(TRANSACTIONAL=transactional_settings):
+            self.assertTrue(context.is_expired())
+            self.assertIsNot(
+                get_auth_context(self.smtp_application.username), context)
+
+
 class TestReturnPath(PolicyCase):
     def test_no_prev_returnpath(self):
         """
@@ -616,3 +786,62 @@ class TestReturnPath(PolicyCase):
 
         self.assertIn(
             'Return-Path: rp-1234@example.com', headers.decode('utf-8'))
+
+
+class TestExecPolicies(PolicyCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.py')
+        os.close(fd)
+        self.write_policy('X-Exec-Policy', 'first')
+        transactional_settings = settings.TRANSACTIONAL.copy()
+        transactional_settings['EXEC_QUEUE_POLICIES'] = [self.path]
+        transactional_settings['EXEC_QUEUE_POLICIES_CHECK_INTERVAL'] = 0
+        self.settings_override = self.settings(
+            TRANSACTIONAL=transactional_settings)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        exec_policy.Apply.policies.pop(self.path, None)
+        os.remove(self.path)
+
+    def write_policy(self, header, value, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write(
+                'def apply(envelope):\n'
+                '    envelope.headers["{}"] = "{}"\n'.format(header, value))
+        if mtime:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_compiled_once(self):
+        for i in range(3):
+            envelope = self.mk_envelope(b'Subject: foo\n\nbody')
+            exec_policy.Apply().apply(envelope)
+            self.assertEqual(envelope.headers['X-Exec-Policy'], 'first')
+        policy = exec_policy.Apply.policies[self.path]
+        self.assertEqual(policy.calls, 3)
+
+    def test_reloaded_on_change(self):
+        envelope = self.mk_envelope(b'Subject: foo\n\nbody')
+        exec_policy.Apply().apply(envelope)
+        self.assertEqual(envelope.headers['X-Exec-Policy'], 'first')
+
+        self.write_policy(
+            'X-Exec-Policy', 'second', mtime=os.stat(self.path).st_mtime + 10)
+        envelope = self.mk_envelope(b'Subject: foo\n\nbody')
+        exec_policy.Apply().apply(envelope)
+        self.assertEqual(envelope.headers['X-Exec-Policy'], 'second')
+        self.assertEqual(exec_policy.Apply.policies[self.path].calls, 1)
+
+    def test_builtins_not_shared(self):
+        with open(self.path, 'w') as f:
+            f.write(
+                'def apply(envelope):\n'
+                '    leaked = "leaked" in __builtins__\n'
+                '    envelope.headers["X-Exec-Policy"] = (\n'
+                '        "True" if leaked else "False")\n'
+                '    __builtins__["leaked"] = True\n')
+        for i in range(2):
+            envelope = self.mk_envelope(b'Subject: foo\n\nbody')
+            exec_policy.Apply().apply(envelope)
+            self.assertEqual(envelope.headers['X-Exec-Policy'], 'False')
@@ -4,7 +4,7 @@ from unittest.mock import patch
 from unittest.mock import MagicMock
 
 import celery
-import requests
+from django.core.cache import cache
 from django.test import TestCase
 from django.conf import settings
 from libfaketime import fake_time
@@ -16,6 +16,8 @@ from munch.core.mail.utils import mk_base64_uuid
 from ..status import send_webhook
 from ..status import handle_dsn_status
 from ..status import handle_smtp_status
+from ..utils import MailHeaders
+from ..webhooks import webhook_dispatcher
 
 from .factories import MailFactory
 
@@ -26,8 +28,21 @@ def mock_status(status_code):
     return m
 
 
+def patch_post(status_code):
+    return patch.object(
+        webhook_dispatcher.session, 'post',
+        return_value=mock_status(status_code))
+
+
+def assert_posted(post, url, json):
+    post.assert_called_with(
+        url, json=json, timeout=webhook_dispatcher.get_timeout())
+
+
 class TestDSNStatus(TestCase):
     def setUp(self):
+        # Webhooks circuit breakers are kept in cache
+        cache.clear()
         identifier = mk_base64_uuid()
         self.mail = MailFactory(
             identifier=identifier,
@@ -39,7 +54,7 @@ class TestDSNStatus(TestCase):
             })
 
     def test_push_dsn_status(self):
-        with patch('requests.post', return_value=mock_status(200)):
+        with patch_post(200) as post:
             handle_dsn_status(
                 (
                     'To: return-{}@test.munch.example.com\n'
@@ -52,7 +67,7 @@ class TestDSNStatus(TestCase):
                     'Final-Recipient': 'foo@bar'
                 }
             )
-            requests.post.assert_called_with('http://example.com/ping', json={
+            assert_posted(post, 'http://example.com/ping', json={
                 'status': 'delivered',
                 'message': 'smtp; 200 Delivered',
                 'esmtp_status': '2.0.0',
@@ -61,8 +76,51 @@ class TestDSNStatus(TestCase):
                 'recipient': 'foo@bar'
             })
 
+    def test_push_dsn_status_batching(self):
+        self.mail.headers[settings.TRANSACTIONAL[
+            'X_HTTP_DSN_RETURN_PATH_BATCHING_HEADER']] = 'yes'
+        self.mail.save()
+        with patch_post(200) as post:
+            handle_dsn_status(
+                (
+                    'To: return-{}@test.munch.example.com\n'
+                    'Date: Fri,  5 Aug 2014 23:35:50 +0700 (WIT)').format(
+                        self.mail.identifier),
+                {
+                    'Diagnostic-Code': 'smtp; 200 Delivered',
+                    'Status': '2.0.0',
+                    'Final-Recipient': 'foo@bar'
+                }
+            )
+            post.assert_not_called()
+            self.assertEqual(
+                webhook_dispatcher.get_pending(), ['http://example.com/ping'])
+
+            webhook_dispatcher.flush_endpoint('http://example.com/ping')
+            self.assertEqual(post.call_count, 1)
+            self.assertEqual(
+                post.call_args[1]['json'][0]['recipient'], 'foo@bar')
+
+    def test_push_dsn_status_unknown_mail(self):
+        identifier = mk_base64_uuid()
+        with patch_post(200) as post:
+            with patch('munch.apps.transactional.status.forward_dsn') as fwd:
+                handle_dsn_status(
+                    (
+                        'To: return-{}@test.munch.example.com\n'
+                        'Date: Fri,  5 Aug 2014 23:35:50 +0700 (WIT)').format(
+                            identifier),
+                    {
+                        'Diagnostic-Code': 'smtp; 550 Unknown user',
+                        'Status': '5.1.1',
+                        'Final-Recipient': 'foo@bar'
+                    }
+                )
+        post.assert_not_called()
+        fwd.apply_async.assert_not_called()
+
     def test_push_dsn_status_no_smtp_diagnostic(self):
-        with patch('requests.post', return_value=mock_status(200)):
+        with patch_post(200) as post:
             handle_dsn_status(
                 (
                     'To: return-{}@test.munch.example.com\n'
@@ -75,7 +133,7 @@ class TestDSNStatus(TestCase):
                     'Final-Recipient': 'foo@bar'
                 }
             )
-            requests.post.assert_called_with('http://example.com/ping', json={
+            assert_posted(post, 'http://example.com/ping', json={
                 'status': 'delivered',
                 'message': 'FreeForm!',
                 'esmtp_status': '2.0.0',
@@ -86,7 +144,7 @@ class TestDSNStatus(TestCase):
 
     def test_push_dsn_status_no_arrival_date_nor_date(self):
         with fake_time('2015-12-18'):
-            with patch('requests.post', return_value=mock_status(200)):
+            with patch_post(200) as post:
                 handle_dsn_status(
                     'To: return-{}@test.munch.example.com'.format(
                         self.mail.identifier),
@@ -96,8 +154,8 @@ class TestDSNStatus(TestCase):
                         'Final-Recipient': 'foo@bar'
                     }
                 )
-                requests.post.assert_called_with(
-                    'http://example.com/ping',
+                assert_posted(
+                    post, 'http://example.com/ping',
                     json={
                         'status': 'delivered',
                         'message': 'FreeForm!',
@@ -109,7 +167,7 @@ class TestDSNStatus(TestCase):
 
     def test_push_dsn_status_no_arrival_date(self):
         with fake_time('2015-12-18'):
-            with patch('requests.post', return_value=mock_status(200)):
+            with patch_post(200) as post:
                 handle_dsn_status(
                     (
                         'To: return-{}@test.munch.example.com\n'
@@ -121,8 +179,8 @@ class TestDSNStatus(TestCase):
                         'Final-Recipient': 'foo@bar'
                     }
                 )
-                requests.post.assert_called_with(
-                    'http://example.com/ping',
+                assert_posted(
+                    post, 'http://example.com/ping',
                     json={
                         'status': 'delivered',
                         'message': 'FreeForm!',
@@ -135,7 +193,7 @@ class TestDSNStatus(TestCase):
 
     def test_push_dsn_status_webhook_error(self):
         with self.assertRaises(celery.exceptions.Retry):
-            with patch('requests.post', return_value=mock_status(500)):
+            with patch_post(500):
                 send_webhook(
                     self.mail.identifier,
                     {
@@ -157,7 +215,7 @@ class TestDSNStatus(TestCase):
 
     def test_push_dsn_status_broken_headers(self):
         with self.assertRaises(celery.exceptions.Reject):
-            with patch('requests.post', return_value=mock_status(201)):
+            with patch_post(201) as post:
                 handle_dsn_status(
                     'Date: Fri,  5 Aug 2014 23:35:50 +0700 (WIT)',
                     {
@@ -166,8 +224,8 @@ class TestDSNStatus(TestCase):
                         'Arrival-Date': 'Fri, 5 Aug 2014 23:35:50 +0700 (WIT)',
                     }
                 )
-                requests.post.assert_called_with(
-                    'http://example.com/ping',
+                assert_posted(
+                    post, 'http://example.com/ping',
                     json={
                         'status': 'delivered',
                         'message': 'smtp; 200 Delivered',
@@ -178,7 +236,7 @@ class TestDSNStatus(TestCase):
 
     def test_push_dsn_status_missing_esmtp_code(self):
         with self.assertRaises(celery.exceptions.Reject):
-            with patch('requests.post', return_value=mock_status(201)):
+            with patch_post(201):
                 handle_dsn_status(
                     (
                         'To: return-{}@test.munch.example.com\n'
@@ -191,7 +249,7 @@ class TestDSNStatus(TestCase):
 
     def test_push_dsn_status_unknown_email(self):
         with self.assertRaises(celery.exceptions.Reject):
-            with patch('requests.post', return_value=mock_status(201)):
+            with patch_post(201):
                 # This status is unknown to the DB
                 handle_dsn_status(
                     (
@@ -212,14 +270,14 @@ class TestDSNStatus(TestCase):
         env.parse(body.encode('utf-8'))
         reply = Reply('200', '2.0.0 Delivered')
 
-        with patch('requests.post', return_value=mock_status(201)):
+        with patch_post(201) as post:
             with fake_time('2015-12-18'):
                 handle_smtp_status(
                     'delivered', datetime.now(),
                     '{}'.format(self.mail.identifier), reply, 'localhost')
 
-            requests.post.assert_called_with(
-                'http://example.com/ping',
+            assert_posted(
+                post, 'http://example.com/ping',
                 json={
                     'status': 'delivered',
                     'message': '2.0.0 Delivered',
@@ -236,11 +294,47 @@ class TestDSNStatus(TestCase):
             mail.identifier).encode('utf-8'))
         reply = Reply('200', '2.0.0 Delivered')
 
-        with patch('requests.post'):
+        with patch_post(200) as post:
             with patch('logging.warning'):
                 handle_smtp_status(
                     'delivered', datetime.now(),
                     mail.identifier, reply, 'localhost')
 
-                requests.post.assert_not_called()
+                post.assert_not_called()
                 logging.warning.assert_called()
+
+
+class TestMailHeaders(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.mail = MailFactory(
+            recipient='someone@example.com', sender='sender@example.com',
+            headers={
+                'To': 'someone@example.com',
+                'Subject': 'Caf\xe9',
+                settings.TRANSACTIONAL['X_HTTP_DSN_RETURN_PATH_HEADER']: (
+                    ' http://example.com/ping ')})
+
+    def test_get(self):
+        with self.assertNumQueries(1):
+            mail_headers = MailHeaders.get(self.mail.identifier)
+        self.assertEqual(mail_headers.recipient, 'someone@example.com')
+        self.assertEqual(mail_headers.sender, 'sender@example.com')
+        self.assertEqual(mail_headers.headers['To'], 'someone@example.com')
+        self.assertEqual(
+            mail_headers.headers['Subject'], '=?utf-8?b?Q2Fmw6k=?=')
+        self.assertEqual(
+            mail_headers.http_return_path, 'http://example.com/ping')
+        self.assertIsNone(mail_headers.smtp_return_path)
+
+    def test_get_cached(self):
+        MailHeaders.get(self.mail.identifier)
+        with self.assertNumQueries(0):
+            mail_headers = MailHeaders.get(self.mail.identifier)
+        self.assertEqual(mail_headers.recipient, 'someone@example.com')
+
+    def test_smtp_return_path_defaults_to_sender(self):
+        mail = MailFactory(sender='sender@example.com')
+        self.assertEqual(
+            MailHeaders.get(mail.identifier).smtp_return_path,
+            'sender@example.com')
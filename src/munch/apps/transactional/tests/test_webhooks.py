@@ -0,0 +1,134 @@
+import time
+from unittest.mock import patch
+from unittest.mock import MagicMock
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase
+
+from ..webhooks import CircuitOpen
+from ..webhooks import WebhookError
+from ..webhooks import EndpointBusy
+from ..webhooks import webhook_dispatcher
+from ..status import flush_webhooks
+
+URL = 'http://example.com/ping'
+
+
+def patch_post(status_code=200, side_effect=None):
+    response = MagicMock()
+    response.status_code = status_code
+    return patch.object(
+        webhook_dispatcher.session, 'post',
+        return_value=response, side_effect=side_effect)
+
+
+class WebhookDispatcherTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_session_is_reused(self):
+        self.assertIs(webhook_dispatcher.session, webhook_dispatcher.session)
+
+    def test_post(self):
+        with patch_post(201) as post:
+            webhook_dispatcher.post(URL, {'status': 'delivered'})
+        post.assert_called_once_with(
+            URL, json={'status': 'delivered'},
+            timeout=webhook_dispatcher.get_timeout())
+
+    def test_circuit_breaker(self):
+        threshold = settings.TRANSACTIONAL['STATUS_WEBHOOK_BREAKER_THRESHOLD']
+        with patch_post(side_effect=requests.exceptions.ReadTimeout()):
+            for _ in range(threshold):
+                with self.assertRaises(WebhookError):
+                    webhook_dispatcher.post(URL, {})
+
+        with patch_post(200) as post:
+            with self.assertRaises(CircuitOpen):
+                webhook_dispatcher.post(URL, {})
+            post.assert_not_called()
+
+            # Other endpoints are still called
+            webhook_dispatcher.post('http://example.com/other', {})
+            self.assertEqual(post.call_count, 1)
+
+    def test_concurrency_limit(self):
+        webhook_dispatcher.conn.set(
+            webhook_dispatcher.INFLIGHT_KEY.format(
+                webhook_dispatcher.mk_endpoint_id(URL)),
+            settings.TRANSACTIONAL['STATUS_WEBHOOK_MAX_CONCURRENCY'])
+        with patch_post(200) as post:
+            with self.assertRaises(EndpointBusy):
+                webhook_dispatcher.post(URL, {})
+            post.assert_not_called()
+
+    def test_flush_batches(self):
+        for i in range(3):
+            webhook_dispatcher.enqueue(URL, {'status': i})
+
+        with patch_post(500):
+            self.assertEqual(
+                webhook_dispatcher.flush_endpoint(URL, batch_size=2), 0)
+
+        with patch_post(200) as post:
+            self.assertEqual(
+                webhook_dispatcher.flush_endpoint(URL, batch_size=2), 3)
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(
+            [call[1]['json'] for call in post.call_args_list],
+            [[{'status': 0}, {'status': 1}], [{'status': 2}]])
+
+        self.assertFalse(webhook_dispatcher.conn.smembers(
+            webhook_dispatcher.PENDING_KEY))
+
+    def test_flush_by_endpoint(self):
+        webhook_dispatcher.enqueue(URL, {})
+        webhook_dispatcher.enqueue('http://example.com/other', {})
+        with patch(
+                'munch.apps.transactional.status.flush_webhook.apply_async'
+                ) as apply_async:
+            flush_webhooks()
+        self.assertEqual(
+            sorted(call[1]['args'][0] for call in apply_async.call_args_list),
+            ['http://example.com/other', URL])
+
+    def test_flush_endpoint_locked(self):
+        webhook_dispatcher.enqueue(URL, {})
+        lock = webhook_dispatcher.conn.lock(
+            webhook_dispatcher.LOCK_KEY.format(
+                webhook_dispatcher.mk_endpoint_id(URL)))
+        lock.acquire()
+        try:
+            with patch_post(200) as post:
+                self.assertIsNone(webhook_dispatcher.flush_endpoint(URL))
+            post.assert_not_called()
+        finally:
+            lock.release()
+
+    def test_queue_bounded(self):
+        transactional = dict(
+            settings.TRANSACTIONAL, STATUS_WEBHOOK_MAX_QUEUE_SIZE=2)
+        with self.settings(TRANSACTIONAL=transactional):
+            for i in range(3):
+                webhook_dispatcher.enqueue(URL, {'status': i})
+        with patch_post(200) as post:
+            webhook_dispatcher.flush_endpoint(URL)
+        post.assert_called_once_with(
+            URL, json=[{'status': 1}, {'status': 2}],
+            timeout=webhook_dispatcher.get_timeout())
+
+    def test_old_statuses_not_retried(self):
+        with patch('munch.apps.transactional.webhooks.time.time',
+                   return_value=time.time() - 86400):
+            webhook_dispatcher.enqueue(URL, {'status': 'old'})
+        webhook_dispatcher.enqueue(URL, {'status': 'new'})
+        with patch_post(500):
+            webhook_dispatcher.flush_endpoint(URL)
+        with patch_post(200) as post:
+            webhook_dispatcher.flush_endpoint(URL)
+        post.assert_called_once_with(
+            URL, json=[{'status': 'new'}],
+            timeout=webhook_dispatcher.get_timeout())
+        self.assertFalse(webhook_dispatcher.get_pending())
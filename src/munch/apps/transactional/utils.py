@@ -1,3 +1,9 @@
+from email.header import make_header
+from email.header import decode_header
+
+from django.conf import settings
+from django.core.cache import cache
+
 from munch.core.mail.exceptions import SoftFailure
 
 
@@ -15,3 +21,75 @@ def get_envelope_from_identifier(identifier, only_headers=False):
     from .models import Mail
     return Mail.objects.get(identifier=identifier).as_envelope(
         must_raise=not only_headers)
+
+
+class MailHeaders:
+    """ What status handlers need to know about a Mail
+
+    Unlike Mail.as_envelope(), neither the message nor the related objects
+    are loaded, and headers filters are not applied (they only matter to
+    outgoing mail). Projections are kept in cache for
+    MAIL_HEADERS_CACHE_TTL seconds, as a mail gets several statuses.
+    """
+    FIELDS = ('identifier', 'recipient', 'sender', 'headers')
+    CACHE_KEY = 'transactional:mailheaders:{}'
+
+    def __init__(self, identifier, recipient, sender, headers):
+        self.identifier = identifier
+        self.recipient = recipient
+        self.sender = sender
+        self.headers = headers
+
+    @classmethod
+    def from_mail(cls, mail):
+        headers = dict(mail.headers)
+        if 'Subject' in headers:
+            headers['Subject'] = make_header(
+                decode_header(headers['Subject']), header_name='Subject',
+                maxlinelen=78).encode(linesep='\r\n')
+        return cls(mail.identifier, mail.recipient, mail.sender, headers)
+
+    @classmethod
+    def get(cls, identifier):
+        """
+        :raise: Mail.DoesNotExist
+        """
+        from .models import Mail
+
+        key = cls.CACHE_KEY.format(identifier)
+        values = cache.get(key)
+        if values is None:
+            mail_headers = cls.from_mail(Mail.objects.only(
+                *cls.FIELDS).get(identifier=identifier))
+            cache.set(
+                key, [getattr(mail_headers, f) for f in cls.FIELDS],
+                settings.TRANSACTIONAL.get('MAIL_HEADERS_CACHE_TTL', 300))
+            return mail_headers
+        return cls(*values)
+
+    @property
+    def http_return_path(self):
+        """ URL to notify status updates to (http_returnpath policy) """
+        http_return_path = self.headers.get(
+            settings.X_HTTP_DSN_RETURN_PATH_HEADER, None)
+        if http_return_path:
+            return http_return_path.strip()
+
+    @property
+    def http_return_path_batching(self):
+        """ Whether the URL accepts lists of statuses (see send_webhook) """
+        return bool(self.headers.get(
+            settings.TRANSACTIONAL['X_HTTP_DSN_RETURN_PATH_BATCHING_HEADER'],
+            None))
+
+    @property
+    def smtp_return_path(self):
+        """ Address to send DSN to (smtp_returnpath policy)
+
+        Defaults to the sender, unless statuses are notified by HTTP.
+        """
+        if self.headers.get(settings.X_HTTP_DSN_RETURN_PATH_HEADER, None):
+            return self.headers.get(
+                settings.X_SMTP_DSN_RETURN_PATH_HEADER, None)
+        return self.headers.get(
+            settings.X_SMTP_DSN_RETURN_PATH_HEADER, self.sender)
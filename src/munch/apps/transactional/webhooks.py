@@ -0,0 +1,241 @@
+import json
+import time
+import hashlib
+import logging
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django_redis import get_redis_connection
+
+log = logging.getLogger(__name__)
+
+
+class WebhookError(Exception):
+    pass
+
+
+class CircuitOpen(WebhookError):
+    """ Endpoint failed too many times lately, it is not called """
+
+
+class EndpointBusy(WebhookError):
+    """ Too many requests are already in flight to this endpoint """
+
+
+class WebhookDispatcher:
+    """ Posts statuses to webhooks (X-HTTP-Return-Path)
+
+    - Connections are kept alive, in a pool per endpoint host;
+    - Requests have connect and read timeouts (STATUS_WEBHOOK_TIMEOUT);
+    - At most STATUS_WEBHOOK_MAX_CONCURRENCY requests are in flight to an
+      endpoint, across every worker;
+    - After STATUS_WEBHOOK_BREAKER_THRESHOLD consecutive failures, an
+      endpoint is not called for STATUS_WEBHOOK_BREAKER_TIMEOUT seconds
+      (circuit breaker). Then a single failure opens it again, a success
+      closes it;
+    - For endpoints which opted in (X_HTTP_DSN_RETURN_PATH_BATCHING_HEADER),
+      statuses are queued by endpoint and flush_endpoint() posts them as
+      lists of (at most)
+      STATUS_WEBHOOK_BATCH_SIZE. Queues are bounded: they keep the latest
+      STATUS_WEBHOOK_MAX_QUEUE_SIZE statuses, and statuses queued for more
+      than STATUS_WEBHOOK_MAX_AGE seconds are dropped instead of retried.
+
+    Counters and queues are kept in redis, to be shared by workers.
+    """
+    # How many hosts to keep connections pools for
+    MAX_HOSTS = 100
+    PENDING_KEY = 'webhooks:pending'
+    QUEUE_KEY = 'webhooks:queue:{}'
+    LOCK_KEY = 'webhooks:lock:{}'
+    INFLIGHT_KEY = 'webhooks:inflight:{}'
+    FAILURES_KEY = 'webhooks:failures:{}'
+    OPEN_KEY = 'webhooks:open:{}'
+    TRIPPED_KEY = 'webhooks:tripped:{}'
+
+    # Forget an endpoint once its queue is empty, atomically
+    FORGET_SCRIPT = """
+    if redis.call('llen', KEYS[1]) == 0 then
+        redis.call('srem', KEYS[2], ARGV[1])
+    end
+    """
+
+    def __init__(self):
+        self._session = None
+
+    @property
+    def conn(self):
+        return get_redis_connection('default')
+
+    @property
+    def session(self):
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=self.MAX_HOSTS,
+                pool_maxsize=settings.TRANSACTIONAL.get(
+                    'STATUS_WEBHOOK_POOL_SIZE', 10))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    @staticmethod
+    def get_timeout():
+        return tuple(settings.TRANSACTIONAL.get(
+            'STATUS_WEBHOOK_TIMEOUT', (3.05, 10)))
+
+    @staticmethod
+    def mk_endpoint_id(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def is_open(self, endpoint_id):
+        return bool(self.conn.exists(self.OPEN_KEY.format(endpoint_id)))
+
+    def record_failure(self, url, endpoint_id):
+        breaker_timeout = settings.TRANSACTIONAL.get(
+            'STATUS_WEBHOOK_BREAKER_TIMEOUT', 60)
+        failures_key = self.FAILURES_KEY.format(endpoint_id)
+        pipe = self.conn.pipeline()
+        pipe.incr(failures_key)
+        pipe.expire(failures_key, breaker_timeout)
+        pipe.exists(self.TRIPPED_KEY.format(endpoint_id))
+        failures, _, tripped = pipe.execute()
+
+        if tripped or failures >= settings.TRANSACTIONAL.get(
+                'STATUS_WEBHOOK_BREAKER_THRESHOLD', 10):
+            log.warning(
+                'Webhook {} is failing, not calling it for {}s'.format(
+                    url, breaker_timeout))
+            pipe = self.conn.pipeline()
+            pipe.set(self.OPEN_KEY.format(endpoint_id), 1, ex=breaker_timeout)
+            pipe.set(
+                self.TRIPPED_KEY.format(endpoint_id), 1,
+                ex=breaker_timeout * 2)
+            pipe.delete(failures_key)
+            pipe.execute()
+
+    def record_success(self, endpoint_id):
+        self.conn.delete(
+            self.FAILURES_KEY.format(endpoint_id),
+            self.TRIPPED_KEY.format(endpoint_id))
+
+    @contextmanager
+    def acquire(self, url, endpoint_id):
+        key = self.INFLIGHT_KEY.format(endpoint_id)
+        pipe = self.conn.pipeline()
+        pipe.incr(key)
+        # Slots of killed workers are released eventually
+        pipe.expire(key, int(sum(self.get_timeout())) + 1)
+        count, _ = pipe.execute()
+        try:
+            if count > settings.TRANSACTIONAL.get(
+                    'STATUS_WEBHOOK_MAX_CONCURRENCY', 10):
+                raise EndpointBusy(
+                    'Too many requests in flight to {}'.format(url))
+            yield
+        finally:
+            self.conn.decr(key)
+
+    def post(self, url, data):
+        """ POST data as JSON to url
+
+        :raise: WebhookError if it failed or was not sent.
+        """
+        endpoint_id = self.mk_endpoint_id(url)
+        if self.is_open(endpoint_id):
+            raise CircuitOpen('Webhook {} is failing'.format(url))
+
+        with self.acquire(url, endpoint_id):
+            try:
+                response = self.session.post(
+                    url, json=data, timeout=self.get_timeout())
+            except requests.exceptions.RequestException as err:
+                self.record_failure(url, endpoint_id)
+                raise WebhookError(str(err))
+
+        if response.status_code not in (200, 201):
+            self.record_failure(url, endpoint_id)
+            raise WebhookError('HTTP {}'.format(response.status_code))
+        self.record_success(endpoint_id)
+        return response
+
+    def enqueue(self, url, data):
+        """ Queue data to be posted (in a list) by flush_endpoint() """
+        key = self.QUEUE_KEY.format(url)
+        max_size = settings.TRANSACTIONAL.get(
+            'STATUS_WEBHOOK_MAX_QUEUE_SIZE', 10000)
+        pipe = self.conn.pipeline()
+        pipe.rpush(key, json.dumps({'queued_at': time.time(), 'data': data}))
+        pipe.ltrim(key, -max_size, -1)
+        pipe.sadd(self.PENDING_KEY, url)
+        size, _, _ = pipe.execute()
+        if size > max_size:
+            log.warning(
+                'Webhook {} queue is full, dropped its oldest status'.format(
+                    url))
+
+    def get_pending(self):
+        """ Endpoints with queued data """
+        return [url.decode('utf-8') for url in self.conn.smembers(
+            self.PENDING_KEY)]
+
+    def pop(self, url, count):
+        pipe = self.conn.pipeline()
+        pipe.lrange(self.QUEUE_KEY.format(url), 0, count - 1)
+        pipe.ltrim(self.QUEUE_KEY.format(url), count, -1)
+        items, _ = pipe.execute()
+        return [json.loads(item.decode('utf-8')) for item in items]
+
+    def requeue(self, url, items):
+        """ Queue items again, in their order, unless they are too old """
+        max_age = settings.TRANSACTIONAL.get('STATUS_WEBHOOK_MAX_AGE', 86400)
+        now = time.time()
+        kept = [item for item in items if now - item['queued_at'] < max_age]
+        if len(kept) < len(items):
+            log.warning(
+                'Dropped {} statuses queued for more than {}s '
+                'for {}'.format(len(items) - len(kept), max_age, url))
+        if kept:
+            self.conn.lpush(self.QUEUE_KEY.format(url), *[
+                json.dumps(item) for item in reversed(kept)])
+
+    def flush_endpoint(self, url, batch_size=100):
+        """ Post data queued for url, as lists
+
+        Data that could not be posted is queued again (see requeue()).
+
+        :return: the number of items posted, None if another flush of this
+                 endpoint is already running.
+        """
+        lock = self.conn.lock(
+            self.LOCK_KEY.format(self.mk_endpoint_id(url)), timeout=600)
+        if not lock.acquire(blocking=False):
+            return None
+        forget = self.conn.register_script(self.FORGET_SCRIPT)
+        key = self.QUEUE_KEY.format(url)
+        count = 0
+        try:
+            while True:
+                items = self.pop(url, batch_size)
+                if not items:
+                    break
+                try:
+                    self.post(url, [item['data'] for item in items])
+                except WebhookError as err:
+                    log.info('Failed to post {} statuses to {}: {}'.format(
+                        len(items), url, err))
+                    self.requeue(url, items)
+                    break
+                log.info('Logged {} statuses to {}'.format(len(items), url))
+                count += len(items)
+                if len(items) < batch_size:
+                    break
+            forget(keys=[key, self.PENDING_KEY], args=[url])
+        finally:
+            lock.release()
+        return count
+
+
+webhook_dispatcher = WebhookDispatcher()
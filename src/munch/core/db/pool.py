@@ -0,0 +1,182 @@
+import time
+import logging
+
+import psycopg2
+import psycopg2.extensions
+from gevent.lock import BoundedSemaphore
+from django.conf import settings
+from django.db.utils import OperationalError
+
+log = logging.getLogger(__name__)
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+class ConnectionPool:
+    """ Bounded pool of psycopg2 connections, shared by greenlets
+
+    A greenlet checks out a connection the first time its DatabaseWrapper
+    connects and gives it back when Django closes it: after each unit of
+    work (see release_connections()), at the latest on request_finished.
+    Idle connections are health-checked before being handed out again.
+    """
+    # Idle connections older than that are checked with a "SELECT 1"
+    HEALTH_CHECK_AFTER = 30
+
+    def __init__(self, connect, max_size, timeout=None, max_idle=None):
+        self.connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._semaphore = BoundedSemaphore(max_size)
+        # Stack of (connection, last checkin time), most recent last
+        self._idle = []
+        self.stats = {
+            'checkouts': 0, 'created': 0, 'discarded': 0, 'timeouts': 0,
+            'wait_total': 0., 'wait_max': 0.}
+
+    @property
+    def in_use(self):
+        return self.max_size - self._semaphore.counter
+
+    def checkout(self):
+        start = time.monotonic()
+        if not self._semaphore.acquire(timeout=self.timeout):
+            self.stats['timeouts'] += 1
+            raise PoolTimeout(
+                'No database connection available after {}s '
+                '({} in use)'.format(self.timeout, self.in_use))
+        self.record_wait(time.monotonic() - start)
+
+        try:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                if self.is_usable(connection, last_used):
+                    return connection
+                self.discard(connection)
+            self.stats['created'] += 1
+            return self.connect()
+        except:
+            self._semaphore.release()
+            raise
+
+    def checkin(self, connection):
+        try:
+            if connection.closed:
+                self.stats['discarded'] += 1
+                return
+            status = connection.get_transaction_status()
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+            self._idle.append((connection, time.monotonic()))
+        except psycopg2.Error:
+            self.discard(connection)
+        finally:
+            self._semaphore.release()
+
+    def is_usable(self, connection, last_used):
+        if connection.closed:
+            return False
+        idle_time = time.monotonic() - last_used
+        if self.max_idle is not None and idle_time > self.max_idle:
+            return False
+        if idle_time > self.HEALTH_CHECK_AFTER:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+            except psycopg2.Error:
+                return False
+        return True
+
+    def discard(self, connection):
+        self.stats['discarded'] += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def record_wait(self, wait):
+        self.stats['checkouts'] += 1
+        self.stats['wait_total'] += wait
+        self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+        if settings.STATSD_ENABLED:
+            from statsd.defaults.django import statsd
+            statsd.timing('db_pool.checkout_wait', wait * 1000)
+            statsd.gauge('db_pool.in_use', self.in_use)
+
+    def close_all(self):
+        while self._idle:
+            connection, _ = self._idle.pop()
+            self.discard(connection)
+
+
+_pools = {}
+# Set by install(), defaults to the transactional edge settings
+_options = {}
+
+
+def get_options():
+    options = {
+        'max_size': settings.TRANSACTIONAL.get('EDGE_DB_POOL_SIZE', 20),
+        'timeout': settings.TRANSACTIONAL.get('EDGE_DB_POOL_TIMEOUT', 10),
+        'max_idle': settings.TRANSACTIONAL.get('EDGE_DB_POOL_MAX_IDLE', 300)}
+    options.update(_options)
+    return options
+
+
+def get_pool(alias, connect=None):
+    """ Return the pool of a database alias, creating it if needed """
+    if alias not in _pools:
+        _pools[alias] = ConnectionPool(connect, **get_options())
+    return _pools[alias]
+
+
+def install(aliases=None, **options):
+    """ Make `munch run smtp` use pooled, per-greenlet connections
+
+    Must be called after django.setup() and before any query. Each
+    greenlet gets its own DatabaseWrapper (connections are greenlet-local
+    instead of thread-local), backed by the process-wide pool.
+
+    options (max_size, timeout, max_idle) default to the EDGE_DB_POOL_*
+    transactional settings.
+    """
+    _options.update(options)
+    from gevent.local import local
+    from django.db import connections
+
+    for alias, database in settings.DATABASES.items():
+        if aliases is not None and alias not in aliases:
+            continue
+        if database['ENGINE'].endswith('postgresql_psycopg2') or \
+                database['ENGINE'].endswith('postgresql'):
+            database['ENGINE'] = 'munch.core.db.postgresql_pool'
+    connections._connections = local()
+
+    log.info('Database connections pool enabled (size: {})'.format(
+        get_options()['max_size']))
+
+
+def release_connections():
+    """ Give the current greenlet connections back to their pool
+
+    To be called after each unit of work (authentication, queued
+    message...), so that idle or slow SMTP sessions do not hold pooled
+    connections. Connections in a transaction are kept.
+    """
+    from django.db import connections
+
+    for alias in _pools:
+        connection = connections[alias]
+        if connection.connection is not None and \
+                not connection.in_atomic_block:
+            connection.close()
+
+
+def close_all_pools():
+    """ Close idle connections of every pool (connections in use are kept)
+    """
+    for pool in _pools.values():
+        pool.close_all()
@@ -0,0 +1,26 @@
+from django.db.backends.postgresql_psycopg2 import base
+
+from ..pool import get_pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """ PostgreSQL backend checking connections out of munch.core.db.pool
+
+    Closing the wrapper gives the connection back to the pool instead of
+    closing it.
+    """
+    def get_new_connection(self, conn_params):
+        pool = get_pool(
+            self.alias,
+            lambda: super(DatabaseWrapper, self).get_new_connection(
+                conn_params))
+        connection = pool.checkout()
+        # Otherwise only set by the parent class on brand new connections
+        self.isolation_level = self.settings_dict['OPTIONS'].get(
+            'isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                get_pool(self.alias).checkin(self.connection)
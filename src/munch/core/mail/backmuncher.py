@@ -1,10 +1,16 @@
+import time
 import email
 import logging
+from collections import Counter
 
 from django.conf import settings
+from django.core.signals import request_started
+from django.core.signals import request_finished
 from django.core.exceptions import ObjectDoesNotExist
 from slimta.queue import QueueError
 from slimta.policy import QueuePolicy
+from slimta.edge.smtp import SmtpEdge
+from slimta.util.proxyproto import ProxyProtocol
 
 # DSN tasks
 from munch.apps.campaigns.tasks import handle_dsn as campaigns_dsn
@@ -16,18 +22,49 @@ from munch.apps.campaigns.tasks import handle_mail_optout
 from munch.apps.campaigns.tasks import handle_fbl
 
 from munch.core.utils import get_mail_by_identifier
+from munch.core.mail.models import AbstractMailStatus
 from munch.core.mail.models import return_path_parser
 from munch.core.mail.models import unsubscribe_parser
+from munch.core.mail.utils.dsn import DSNParser
 from munch.core.mail.utils.parsers import extract_domain
+from munch.core.mail.identifiers import identifier_filter
 
 log = logging.getLogger(__name__)
 
 
+def is_known_identifier(identifier):
+    """ Does identifier (probably) belong to one of our mails ?
+
+    Identifiers are looked up in the identifiers filter, so that bounce
+    storms do not hit the database. Mails older than the filter are looked
+    up in database, unless IDENTIFIER_DB_FALLBACK is disabled.
+    """
+    if not identifier.startswith(('c-', 't-')):
+        return False
+    if identifier in identifier_filter:
+        return True
+    if settings.BACKMUNCHER.get('IDENTIFIER_DB_FALLBACK', True):
+        try:
+            get_mail_by_identifier(identifier)
+        except ObjectDoesNotExist:
+            return False
+        return True
+    return False
+
+
 class MailHandler:
     def __init__(self, envelope, message):
         self.envelope = envelope
         self.message = message
 
+    def get_headers(self):
+        """ Top-level headers of the message, as a string
+
+        Workers only need those, not the whole message.
+        """
+        return ''.join(
+            '{}: {}\n'.format(k, v) for k, v in self.message.items())
+
 
 class AbstractReportHandler(MailHandler):
     CONTENT_TYPE = 'multipart/report'
@@ -75,20 +112,31 @@ class DSNHandler(AbstractReportHandler):
             log.info('Invalid recipient: {}'.format(recipient))
             return None
 
-        try:
-            identifier = return_path_parser.get_uuid(recipient)
-            get_mail_by_identifier(identifier)
-        except (ValueError, ObjectDoesNotExist):
+        identifier = return_path_parser.get_uuid(recipient)
+        if not is_known_identifier(identifier):
             log.info('Cannot find any mail with this recipient: {}'.format(
                 recipient))
             return
 
+        report = self.get_report()
         if identifier.startswith('c-'):
             return campaigns_dsn.apply_async(args=[
-                self.message.as_string(), self.get_report()])
+                self.get_headers(), report])
         elif identifier.startswith('t-'):
             return transactional_dsn.apply_async(args=[
-                self.message.as_string(), self.get_report()])
+                self.get_dsn(report), report])
+
+    def get_dsn(self, report):
+        """ Failure DSN are forwarded to transactional senders, as a whole
+        """
+        try:
+            status = DSNParser(report).get_next_mailstatus()
+        except ValueError:
+            status = None
+        if status in (
+                AbstractMailStatus.DELIVERED, AbstractMailStatus.DELAYED):
+            return self.get_headers()
+        return self.message.as_string()
 
 
 class ARFHandler(AbstractReportHandler):
@@ -101,21 +149,14 @@ class ARFHandler(AbstractReportHandler):
             log.info('Invalid Return-Path: {}'.format(return_path))
             return None
 
-        try:
-            identifier = return_path_parser.get_uuid(return_path)
-            get_mail_by_identifier(identifier)
-        except (ValueError, ObjectDoesNotExist):
+        identifier = return_path_parser.get_uuid(return_path)
+        if not is_known_identifier(identifier):
             log.info('Cannot find any mail with this Return-Path: {}'.format(
                 return_path))
             return
 
-        original = self.get_original()
-        if not original:
-            log.info('Empty original message')
-            return
-
         return handle_fbl.apply_async(args=[
-            self.message.as_string(), original, self.get_report()])
+            self.get_headers(), original, self.get_report()])
 
 
 class UnsubscribeHandler(MailHandler):
@@ -125,10 +166,8 @@ class UnsubscribeHandler(MailHandler):
             log.info('Invalid recipient: {}'.format(recipient))
             return None
 
-        try:
-            identifier = unsubscribe_parser.get_uuid(recipient)
-            get_mail_by_identifier(identifier)
-        except (ValueError, ObjectDoesNotExist):
+        identifier = unsubscribe_parser.get_uuid(recipient)
+        if not is_known_identifier(identifier):
             log.info('Cannot find any mail with this recipient: {}'.format(
                 recipient))
             return
@@ -144,8 +183,51 @@ class UnsubscribeHandler(MailHandler):
         return True
 
 
+class ThroughputCounters:
+    """ Counts handled mails, by handler, for periodic reports """
+    def __init__(self):
+        self.counts = Counter()
+        self.last_report = time.monotonic()
+
+    def incr(self, name):
+        self.counts[name] += 1
+        if settings.STATSD_ENABLED:
+            from statsd.defaults.django import statsd
+            statsd.incr('backmuncher.{}'.format(name))
+
+    def report(self):
+        """ Mails/s by handler since last report, then reset counters """
+        now = time.monotonic()
+        duration = max(now - self.last_report, 1e-6)
+        rates = {
+            name: count / duration for name, count in self.counts.items()}
+        self.counts.clear()
+        self.last_report = now
+        return rates
+
+    def log_forever(self, interval):
+        from gevent import sleep
+
+        while True:
+            sleep(interval)
+            rates = self.report()
+            log.info('Throughput: {}'.format(', '.join(
+                '{} {:.1f}/s'.format(name, rate)
+                for name, rate in sorted(rates.items())) or 'idle'))
+
+
+counters = ThroughputCounters()
+
+
 class BackMuncherQueuePolicy(QueuePolicy):
     def apply(self, envelope):
+        try:
+            self.handle(envelope)
+        except QueueError:
+            counters.incr('rejected')
+            raise
+
+    def handle(self, envelope):
         if not envelope.recipients:
             raise QueueError('Missing recipient')
         recipient = envelope.recipients[0]
@@ -153,18 +235,13 @@ class BackMuncherQueuePolicy(QueuePolicy):
         if extract_domain(recipient) != settings.RETURNPATH_DOMAIN:
             raise QueueError('Domain not valid')
 
-        message = email.message_from_bytes(
-            envelope.flatten()[0] + envelope.flatten()[1])
-
         # Check recipient prefix
-        prefix_allowed = False
-        for prefix in ['return-', 'unsubscribe-', 'abuse']:
-            if recipient.startswith(prefix):
-                prefix_allowed = True
-                break
-        if not prefix_allowed:
+        if not recipient.startswith(('return-', 'unsubscribe-', 'abuse')):
             raise QueueError('Prefix not allowed')
 
+        header_data, message_data = envelope.flatten()
+        message = email.message_from_bytes(header_data + message_data)
+
         # Find handler
         handler_found = False
         for handler in [DSNHandler, ARFHandler, UnsubscribeHandler]:
@@ -176,6 +253,21 @@ class BackMuncherQueuePolicy(QueuePolicy):
         if not handler_found:
             raise QueueError('No handler found')
         handler.apply()
+        counters.incr(handler.__class__.__name__)
+
+
+class BackMuncherSmtpEdge(SmtpEdge):
+    def handle(self, socket, address):
+        """ Release the database connection (to the pool) of sessions """
+        request_started.send(sender='backmuncher-edge')
+        try:
+            super().handle(socket, address)
+        finally:
+            request_finished.send(sender='backmuncher-edge')
+
+
+class ProxyProtocolBackMuncherSmtpEdge(ProxyProtocol, BackMuncherSmtpEdge):
+    pass
 
 
 class Queue:
@@ -0,0 +1,130 @@
+import hashlib
+import logging
+from datetime import timedelta
+
+import pytz
+from django.conf import settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+log = logging.getLogger(__name__)
+
+
+class BounceCounters:
+    """ Rolling bounce counts, by recipient and BOUNCE_POLICY rule
+
+    Each recipient has a redis hash of daily buckets ("<rule>:<day>"
+    fields), so that counting a bounce is O(1) and counting the bounces
+    within a rule time frame reads at most as many buckets as the rule
+    spans days. Buckets out of every time frame are dropped on read, and
+    hashes of recipients that stopped bouncing expire.
+
+    Counters can be rebuilt from MailStatus history with the
+    rebuild_bounce_counters management command (needed when BOUNCE_POLICY
+    changes).
+    """
+    KEY = 'bounces:{}'
+
+    @property
+    def conn(self):
+        return get_redis_connection('default')
+
+    @staticmethod
+    def get_rules():
+        return settings.CAMPAIGNS['BOUNCE_POLICY']
+
+    @staticmethod
+    def mk_rule_id(rule):
+        matches, how_many, days = rule
+        return hashlib.md5(repr((sorted(matches), days)).encode(
+            'utf-8')).hexdigest()[:8]
+
+    @staticmethod
+    def get_day(date):
+        return date.astimezone(pytz.utc).date().toordinal()
+
+    def get_fields(self, status_code, date):
+        """ Buckets to increment for a bounce """
+        today = self.get_day(timezone.now())
+        day = self.get_day(date)
+        fields = []
+        for rule in self.get_rules():
+            matches, how_many, days = rule
+            if day > today - days and any(
+                    (status_code or '').startswith(lookup)
+                    for lookup in matches):
+                fields.append('{}:{}'.format(self.mk_rule_id(rule), day))
+        return fields
+
+    def add(self, recipient, status_code, date, pipe=None):
+        fields = self.get_fields(status_code, date)
+        if not fields:
+            return
+        key = self.KEY.format(recipient)
+        execute = pipe is None
+        if pipe is None:
+            pipe = self.conn.pipeline()
+        for field in fields:
+            pipe.hincrby(key, field, 1)
+        pipe.expire(key, 3600 * 24 * (1 + max(
+            days for _, _, days in self.get_rules())))
+        if execute:
+            pipe.execute()
+
+    def count(self, recipient, rule):
+        """ How many bounces did recipient get within rule time frame ? """
+        key = self.KEY.format(recipient)
+        rule_id = self.mk_rule_id(rule)
+        today = self.get_day(timezone.now())
+        spans = {
+            self.mk_rule_id(other_rule): other_rule[2]
+            for other_rule in self.get_rules()}
+
+        count = 0
+        expired = []
+        for field, value in self.conn.hgetall(key).items():
+            field_rule_id, day = field.decode('utf-8').split(':')
+            day = int(day)
+            if day <= today - spans.get(field_rule_id, 0):
+                expired.append(field)
+            elif field_rule_id == rule_id:
+                count += int(value)
+        if expired:
+            self.conn.hdel(key, *expired)
+        return count
+
+    def clear(self):
+        count = 0
+        for key in self.conn.scan_iter(self.KEY.format('*')):
+            count += self.conn.delete(key)
+        return count
+
+    def rebuild(self, batch_size=1000):
+        """ Recount bounces of every recipient from MailStatus history """
+        from munch.apps.campaigns.models import (
+            MailStatus as CampaignsMailStatus)
+        from munch.apps.transactional.models import (
+            MailStatus as TransactionalMailStatus)
+
+        self.clear()
+        since = timezone.now() - timedelta(
+            days=max(days for _, _, days in self.get_rules()))
+        count = 0
+        pipe = self.conn.pipeline(transaction=False)
+        for mailstatus_class in [
+                CampaignsMailStatus, TransactionalMailStatus]:
+            bounces = mailstatus_class.objects.filter(
+                status__in=[
+                    mailstatus_class.BOUNCED, mailstatus_class.DROPPED],
+                creation_date__gt=since).values_list(
+                    'mail__recipient', 'status_code', 'creation_date')
+            for recipient, status_code, creation_date in bounces.iterator():
+                self.add(recipient, status_code, creation_date, pipe=pipe)
+                count += 1
+                if count % batch_size == 0:
+                    pipe.execute()
+        pipe.execute()
+        return count
+
+
+bounce_counters = BounceCounters()
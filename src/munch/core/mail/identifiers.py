@@ -0,0 +1,86 @@
+import math
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+
+class IdentifierFilter:
+    """ Bloom filter of the mail identifiers we issued lately
+
+    Lets the backmuncher tell whether a return path or unsubscribe address
+    matches one of our mails without querying the database. There is one
+    filter (a redis bitmap) per day, kept IDENTIFIER_FILTER_DAYS days;
+    false positives are possible (and handled by workers), false negatives
+    only for mails older than the filters.
+
+    Filters are sized for IDENTIFIER_FILTER_EXPECTED_MAILS mails a day, so
+    that an unknown identifier matches one of them with a
+    IDENTIFIER_FILTER_ERROR_RATE probability. Days with more mails raise
+    it quickly. Changing those settings makes existing filters meaningless
+    until they expire.
+    """
+    KEY = 'identifiers:{}'
+    # Redis bitmaps limit
+    MAX_SIZE = 2 ** 32
+
+    @property
+    def conn(self):
+        return get_redis_connection('default')
+
+    @staticmethod
+    def get_days():
+        return settings.BACKMUNCHER.get('IDENTIFIER_FILTER_DAYS', 15)
+
+    def get_dimensions(self):
+        """ (bits, hashes) of each daily filter """
+        mails = settings.BACKMUNCHER.get(
+            'IDENTIFIER_FILTER_EXPECTED_MAILS', 1000000)
+        # Identifiers are checked against every daily filter
+        error_rate = settings.BACKMUNCHER.get(
+            'IDENTIFIER_FILTER_ERROR_RATE', 0.01) / self.get_days()
+        # Optimal count, but sha256 digests only provide 8 hashes of 32 bits
+        hashes = min(8, max(1, round(-math.log2(error_rate))))
+        size = math.ceil(
+            -hashes * mails / math.log(1 - error_rate ** (1 / hashes)))
+        return min(self.MAX_SIZE, size), hashes
+
+    def get_offsets(self, identifier):
+        digest = hashlib.sha256(identifier.encode('utf-8')).digest()
+        size, hashes = self.get_dimensions()
+        return [
+            int.from_bytes(digest[i:i + 4], 'big') % size
+            for i in range(0, 4 * hashes, 4)]
+
+    def get_keys(self):
+        """ Filters keys, today's first """
+        today = timezone.now().date()
+        return [
+            self.KEY.format((today - timedelta(days=i)).toordinal())
+            for i in range(self.get_days())]
+
+    def add(self, identifiers):
+        key = self.get_keys()[0]
+        pipe = self.conn.pipeline(transaction=False)
+        for identifier in identifiers:
+            for offset in self.get_offsets(identifier):
+                pipe.setbit(key, offset, 1)
+        pipe.expire(key, 3600 * 24 * self.get_days())
+        pipe.execute()
+
+    def __contains__(self, identifier):
+        offsets = self.get_offsets(identifier)
+        keys = self.get_keys()
+        pipe = self.conn.pipeline(transaction=False)
+        for key in keys:
+            for offset in offsets:
+                pipe.getbit(key, offset)
+        bits = pipe.execute()
+        return any(
+            all(bits[i:i + len(offsets)])
+            for i in range(0, len(bits), len(offsets)))
+
+
+identifier_filter = IdentifierFilter()
@@ -1,17 +1,25 @@
 import sys
+import zlib
 import socket
 import logging
 import hashlib
 from datetime import timedelta
 
 from django.db import models
+from django.db import connections
+from django.db import transaction
+from django.db import IntegrityError
 from django.db.models import Count
 from django.db.models import Prefetch
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_save
+from django.db.models.signals import post_save
 from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from ..utils.managers import MedianQuerySetMixin
+from .identifiers import identifier_filter
 from .utils import UniqueEmailAddressParser
 from .validators import rfc3463_regex
 from .validators import rfc3463_regex_validator
@@ -69,6 +77,63 @@ class TrackingSummary:
 
 
 class BaseMailStatusManager(models.Manager):
+    def bulk_record(self, items):
+        """ Record (mail identifier, status) couples in a few queries
+
+        Statuses are applied in the order of items, so that each mail ends
+        up as if they had been saved one by one. Statuses of unknown mails,
+        or not allowed by the current status of their mail, are dropped.
+        Raising means that nothing was written (see post_bulk_record()).
+
+        :return: the list of recorded statuses
+        """
+        mail_model = self.model._meta.get_field('mail').related_model
+        with transaction.atomic(using=self.db):
+            mails = mail_model.objects.using(self.db).select_for_update()
+            mails = {mail.identifier: mail for mail in mails.filter(
+                identifier__in={identifier for identifier, _ in items})}
+
+            statuses = []
+            for identifier, mailstatus in items:
+                mail = mails.get(identifier)
+                if mail is None:
+                    log.warning(
+                        '[{}] Unknown mail, dropping "{}" status'.format(
+                            identifier, mailstatus.status))
+                    continue
+                if not mail.can_switch_status(mailstatus.status):
+                    log.warning(
+                        '[{}] Forbidden transition, dropping "{}" status '
+                        '(current status is "{}")'.format(
+                            identifier, mailstatus.status, mail.curstatus))
+                    continue
+                mailstatus.mail = mail
+                mailstatus.apply_to_mail()
+                mailstatus.set_defaults()
+                statuses.append(mailstatus)
+
+            for mailstatus in statuses:
+                pre_save.send(
+                    sender=self.model, instance=mailstatus, raw=False,
+                    using=self.db, update_fields=None)
+            statuses = self.bulk_create(statuses)
+
+            fields = [
+                'curstatus', 'first_status_date', 'latest_status_date',
+                'delivery_duration', 'had_delay']
+            if self.model.release_final_messages:
+                fields.append('message')
+            mail_model.objects.using(self.db).bulk_update(
+                {mailstatus.mail for mailstatus in statuses}, fields)
+
+            for mailstatus in statuses:
+                post_save.send(
+                    sender=self.model, instance=mailstatus, created=True,
+                    raw=False, using=self.db, update_fields=None)
+
+        self.model.post_bulk_record(statuses)
+        return statuses
+
     def re_run_signals(self, since, mail_path='mail'):
         from munch.core.mail import backend
 
@@ -187,51 +252,106 @@ class AbstractMailStatus(models.Model):
 
     objects = BaseMailStatusManager()
 
+    # Should the content of a mail be released (mail.message set to None)
+    # once it reaches a final state ?
+    release_final_messages = False
+
     class Meta:
         abstract = True
         get_latest_by = 'creation_date'
         verbose_name_plural = "Mail Statuses"
 
+    def apply_to_mail(self):
+        """ Update status-related fields of self.mail, without saving it """
+        self.mail.curstatus = self.status
+        if not self.pk and not self.creation_date:
+            self.creation_date = timezone.now()
+
+        if not self.mail.first_status_date:
+            self.mail.first_status_date = self.creation_date
+        self.mail.latest_status_date = self.creation_date
+        self.mail.delivery_duration = self.mail.latest_status_date \
+            - self.mail.first_status_date
+        # a mail had issues if it had been softbounced at a certain time.
+        self.mail.had_delay = self.mail.had_delay or (
+            self.status == AbstractMailStatus.DROPPED)
+        if self.release_final_messages and self.status in self.FINAL_STATES:
+            self.mail.message = None
+
     def update_mail_status(self):
+        """ Apply status to the mail, in a single UPDATE
+
+        Only status-related columns are written, first_status_date and
+        had_delay are merged with their stored values in SQL.
+        """
         try:
-            self.mail.curstatus = self.status
-            if not self.pk and not self.creation_date:
+            self.mail.check_status_transition(self.status)
+            self.apply_to_mail()
+        except self.mail.DoesNotExist:
+            return
+
+        creation_date = models.Value(
+            self.creation_date, output_field=models.DateTimeField())
+        first_status_date = Coalesce('first_status_date', creation_date)
+        updates = {
+            'curstatus': self.status,
+            'first_status_date': first_status_date,
+            'latest_status_date': creation_date,
+            'delivery_duration': models.ExpressionWrapper(
+                creation_date - first_status_date,
+                output_field=models.DurationField())}
+        if self.status == AbstractMailStatus.DROPPED:
+            updates['had_delay'] = True
+        if self.release_final_messages and self.status in self.FINAL_STATES:
+            updates['message'] = None
+        self.mail.__class__._base_manager.filter(
+            pk=self.mail.pk).update(**updates)
+
+    def set_defaults(self):
+        if self.status_code:
+            status_code = rfc3463_regex.match(self.status_code)
+            if status_code:
+                self.status_code = status_code.group(0)
+
+        if not self.pk:
+            if not self.creation_date:
                 self.creation_date = timezone.now()
+            if not self.source_hostname:
+                self.source_hostname = socket.getfqdn()
 
-            if not self.mail.first_status_date:
-                self.mail.first_status_date = self.creation_date
-            self.mail.latest_status_date = self.creation_date
-            self.mail.delivery_duration = self.mail.latest_status_date \
-                - self.mail.first_status_date
-            # a mail had issues if it had been softbounced at a certain time.
-            self.mail.had_delay = self.mail.had_delay or (
-                self.status == AbstractMailStatus.DROPPED)
-            # warning : save_base_is not part of the public Django API
-            models.Model.save_base(self.mail)
-        except self.mail.DoesNotExist:
-            pass
+    @classmethod
+    def post_bulk_record(cls, statuses):
+        """ Called with statuses created by bulk_record(), once written
+
+        Statuses are already committed: failures are only logged.
+        """
+        for mailstatus in statuses:
+            if mailstatus.status in [cls.DROPPED, cls.BOUNCED]:
+                try:
+                    mailstatus.count_bounce()
+                    mailstatus.should_optout(create=True)
+                except Exception:
+                    log.exception(
+                        '[{}] Failed to process "{}" status'.format(
+                            mailstatus.mail.identifier, mailstatus.status))
+
+    def count_bounce(self):
+        """ Add this bounce to the rolling bounce counters """
+        from .bounces import bounce_counters
+
+        bounce_counters.add(
+            self.mail.recipient, self.status_code, self.creation_date)
 
     def should_optout(self, create=False):
         from munch.apps.optouts.models import OptOut
-        from munch.apps.campaigns.models import (
-            MailStatus as CampaignsMailStatus)
-        from munch.apps.transactional.models import (
-            MailStatus as TransactionalMailStatus)
-
-        filter_kwargs = {
-            'mail__recipient': self.mail.recipient,
-            'status__in': [self.DROPPED, self.BOUNCED]}
+        from .bounces import bounce_counters
 
         if OptOut.objects.filter(
                 address=self.mail.recipient, origin=OptOut.BY_BOUNCE).exists():
             return True
 
-        bounces = list(CampaignsMailStatus.objects.filter(
-            **filter_kwargs).only('creation_date'))
-        bounces += list(TransactionalMailStatus.objects.filter(
-            **filter_kwargs).only('creation_date'))
         relevant_rule = None
-        # Categorize and count the bounces in policies
+        # Categorize the bounce in policies
         for rule in settings.CAMPAIGNS['BOUNCE_POLICY']:
             if self.match_policy(rule):
                 relevant_rule = rule
@@ -242,8 +362,9 @@ class AbstractMailStatus(models.Model):
                 '"{}" do no match any BOUNCE_POLICY '
                 'entry, fix settings.').format(self.status_code))
 
-        # For this rule, count the total number of matching bounces
-        count = len([b for b in bounces if b.match_policy(relevant_rule)])
+        # For this rule, count the total number of matching bounces (see
+        # count_bounce())
+        count = bounce_counters.count(self.mail.recipient, relevant_rule)
 
         max_bounces = relevant_rule[1]
 
@@ -280,24 +401,67 @@ class AbstractMailStatus(models.Model):
         created = not self.pk
 
         self.update_mail_status()
-
-        if self.status_code:
-            status_code = rfc3463_regex.match(self.status_code)
-            if status_code:
-                self.status_code = status_code.group(0)
-
-        if not self.pk:
-            if not self.creation_date:
-                self.creation_date = timezone.now()
-            if not self.source_hostname:
-                self.source_hostname = socket.getfqdn()
+        self.set_defaults()
         super().save(*args, **kwargs)
 
         if created and self.status in [self.DROPPED, self.BOUNCED]:
+            self.count_bounce()
             self.should_optout(create=True)
 
 
+def add_to_identifier_filter(identifiers):
+    """ Best effort: the backmuncher falls back to the database anyway """
+    try:
+        identifier_filter.add(identifiers)
+    except Exception:
+        log.warning(
+            'Unable to add {} identifiers to filter'.format(len(identifiers)),
+            exc_info=True)
+
+
 class BaseMailQuerySet(MedianQuerySetMixin, models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        add_to_identifier_filter([obj.identifier for obj in objs])
+        return objs
+
+    def bulk_update(self, objs, fields):
+        """ Save fields of objs in a single UPDATE ... FROM (VALUES ...)
+
+        Does not send any signal.
+        """
+        objs = list(objs)
+        if not objs:
+            return
+        connection = connections[self.db]
+        quote_name = connection.ops.quote_name
+        pk = self.model._meta.pk
+        fields = [self.model._meta.get_field(name) for name in fields]
+
+        row = '({})'.format(', '.join(
+            ['%s::{}'.format(pk.rel_db_type(connection))] + [
+                '%s::{}'.format(field.db_type(connection))
+                for field in fields]))
+        params = []
+        for obj in objs:
+            params.append(obj.pk)
+            params.extend(
+                field.get_db_prep_save(getattr(obj, field.attname), connection)
+                for field in fields)
+
+        sql = 'UPDATE {table} SET {assignments} FROM (VALUES {rows}) ' \
+            'AS v({columns}) WHERE {table}.{pk} = v.{pk}'.format(
+                table=quote_name(self.model._meta.db_table),
+                assignments=', '.join(
+                    '{0} = v.{0}'.format(quote_name(field.column))
+                    for field in fields),
+                rows=', '.join([row] * len(objs)),
+                columns=', '.join(
+                    quote_name(field.column) for field in [pk] + fields),
+                pk=quote_name(pk.column))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
     def done(self):
         return self.filter(
             curstatus__in=AbstractMailStatus.FINAL_STATES).distinct()
@@ -419,6 +583,20 @@ class AbstractMail(models.Model):
     def __str__(self):
         return self.identifier
 
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        super().save(*args, **kwargs)
+        if created:
+            add_to_identifier_filter([self.identifier])
+
+    def can_switch_status(self, status):
+        """ Is curstatus allowed to become status ? """
+        return True
+
+    def check_status_transition(self, status):
+        """ Raise if curstatus is not allowed to become status """
+        pass
+
     @property
     def unsubscribe_addr(self):
         return unsubscribe_parser.new(self.identifier)
@@ -438,23 +616,90 @@ class AbstractMail(models.Model):
 
 
 class RawMailManager(models.Manager):
-    def get_or_create(self, defaults=None, **kwargs):
-        content = kwargs.get('content')
-        hasher = hashlib.md5()
-        if isinstance(content, bytes):
-            hasher.update(content)
-        else:
-            hasher.update(content.encode('utf-8'))
-        signature = hasher.hexdigest()
+    def get_or_create(self, defaults=None, content=None, **kwargs):
+        """ Content-addressed upsert: one row per distinct content
+
+        Safe against concurrent inserts of the same content, relying on the
+        unique constraint on signature.
+        """
+        content = RawMail.encode_content(content)
+        signature = RawMail.mk_signature(content)
         try:
             return self.get(signature=signature), False
         except self.model.DoesNotExist:
-            return self.create(
-                signature=signature, content=content), True
+            pass
+        try:
+            with transaction.atomic():
+                return self.create(content=content), True
+        except IntegrityError:
+            return self.get(signature=signature), False
+
+    def get_or_create_many(self, contents):
+        """ Bulk get_or_create, returns RawMails in the order of contents
+
+        Existing contents are looked up in one query and missing ones are
+        inserted in one query. Only pk and signature are loaded.
+        """
+        contents = [RawMail.encode_content(content) for content in contents]
+        signatures = [RawMail.mk_signature(content) for content in contents]
+        raw_mails = {
+            raw_mail.signature: raw_mail for raw_mail in self.filter(
+                signature__in=set(signatures)).only('pk', 'signature')}
+
+        missing = {}
+        for signature, content in zip(signatures, contents):
+            if signature not in raw_mails:
+                missing[signature] = content
+        if missing:
+            try:
+                with transaction.atomic():
+                    created = self.bulk_create([
+                        self.model(content=content)
+                        for content in missing.values()])
+                raw_mails.update({
+                    raw_mail.signature: raw_mail for raw_mail in created})
+            except IntegrityError:
+                # Concurrent insert of the same content, one by one then
+                for signature, content in missing.items():
+                    raw_mails[signature], _ = self.get_or_create(
+                        content=content)
+
+        return [raw_mails[signature] for signature in signatures]
 
 
 class RawMail(models.Model):
-    signature = models.CharField(max_length=32, verbose_name=_('signature'))
-    content = models.TextField(verbose_name=_('content'))
+    """ Mail body, stored once per distinct content
+
+    Headers are stored along with each Mail, the body is zlib-compressed
+    and addressed by its sha256 digest.
+    """
+    signature = models.CharField(
+        max_length=64, unique=True, verbose_name=_('signature'))
+    data = models.BinaryField(verbose_name=_('compressed content'))
 
     objects = RawMailManager()
+
+    @staticmethod
+    def encode_content(content):
+        if isinstance(content, str):
+            return content.encode('utf-8', 'surrogateescape')
+        return bytes(content)
+
+    @staticmethod
+    def mk_signature(content):
+        return hashlib.sha256(content).hexdigest()
+
+    @property
+    def raw_content(self):
+        """ Decompressed content, as bytes """
+        return zlib.decompress(self.data)
+
+    @property
+    def content(self):
+        return self.raw_content.decode('utf-8', 'surrogateescape')
+
+    @content.setter
+    def content(self, value):
+        value = self.encode_content(value)
+        self.signature = self.mk_signature(value)
+        self.data = zlib.compress(value)
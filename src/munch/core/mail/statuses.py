@@ -0,0 +1,151 @@
+import json
+import logging
+
+from django.db.utils import InterfaceError
+from django.db.utils import OperationalError
+from django.utils.dateparse import parse_datetime
+from django_redis import get_redis_connection
+
+log = logging.getLogger(__name__)
+
+# Errors meaning that nothing could be written, rather than a bad status
+DATABASE_UNAVAILABLE = (OperationalError, InterfaceError)
+
+
+class StatusBuffer:
+    """ Mail statuses waiting to be recorded by batches
+
+    Statuses are appended to a redis list (so that they are kept in their
+    arrival order) and drained by flush(), which records them with
+    MailStatus.objects.bulk_record(). Only one flush() runs at a time, so
+    that statuses of a given mail are always applied in order.
+
+    Statuses which fail to be recorded on their own are retried at next
+    flush, up to MAX_ATTEMPTS times, then moved to a dead-letter list.
+    """
+    FIELDS = (
+        'status', 'source_ip', 'source_hostname', 'destination_domain',
+        'status_code', 'raw_msg')
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, mailstatus_class):
+        self.mailstatus_class = mailstatus_class
+        self.key = 'mailstatuses:{}'.format(
+            mailstatus_class._meta.label_lower)
+        self.dead_letter_key = '{}:dead-letter'.format(self.key)
+
+    @property
+    def conn(self):
+        return get_redis_connection('default')
+
+    def dump(self, mailstatus, identifier):
+        # Statuses are dated on arrival, not when they are flushed
+        mailstatus.set_defaults()
+        data = {field: getattr(mailstatus, field) for field in self.FIELDS}
+        data['creation_date'] = mailstatus.creation_date.isoformat()
+        data['identifier'] = identifier
+        return json.dumps(data)
+
+    def load(self, item):
+        data = json.loads(item.decode('utf-8'))
+        identifier = data.pop('identifier')
+        data.pop('attempts', None)
+        data['creation_date'] = parse_datetime(data['creation_date'])
+        return identifier, self.mailstatus_class(**data)
+
+    def push(self, mailstatus, identifier):
+        self.conn.rpush(self.key, self.dump(mailstatus, identifier))
+
+    def __len__(self):
+        return self.conn.llen(self.key)
+
+    def pop(self, count):
+        """ Remove and return (at most) count raw items """
+        pipe = self.conn.pipeline()
+        pipe.lrange(self.key, 0, count - 1)
+        pipe.ltrim(self.key, count, -1)
+        items, _ = pipe.execute()
+        return items
+
+    def requeue(self, items, failed=False):
+        """ Put raw items back in front, to be retried in order
+
+        :param failed: count a failed attempt for each item, moving those
+                       failing too often to the dead-letter list
+        """
+        if failed:
+            retried, dead = [], []
+            for item in items:
+                try:
+                    data = json.loads(item.decode('utf-8'))
+                    data['attempts'] = data.get('attempts', 0) + 1
+                except ValueError:
+                    dead.append(item)
+                    continue
+                if data['attempts'] >= self.MAX_ATTEMPTS:
+                    dead.append(item)
+                else:
+                    retried.append(json.dumps(data))
+            if dead:
+                log.error('Moving {} {} statuses to "{}"'.format(
+                    len(dead), self.mailstatus_class._meta.label,
+                    self.dead_letter_key))
+                self.conn.rpush(self.dead_letter_key, *dead)
+            items = retried
+        if items:
+            self.conn.lpush(self.key, *reversed(items))
+
+    def record(self, items):
+        self.mailstatus_class.objects.bulk_record(
+            [self.load(item) for item in items])
+
+    def record_one_by_one(self, items):
+        """ Record raw items, so that bad ones do not block the others """
+        failed = []
+        for i, item in enumerate(items):
+            try:
+                self.record([item])
+            except DATABASE_UNAVAILABLE:
+                self.requeue(failed + items[i:])
+                raise
+            except Exception:
+                log.exception('Failed to record {} status {}'.format(
+                    self.mailstatus_class._meta.label, item))
+                failed.append(item)
+        self.requeue(failed, failed=True)
+
+    def flush(self, batch_size=1000):
+        """ Record buffered statuses, by batches of batch_size
+
+        :return: the number of statuses flushed, None if another flush is
+                 already running.
+        """
+        lock = self.conn.lock('{}:lock'.format(self.key), timeout=600)
+        if not lock.acquire(blocking=False):
+            return None
+        count = 0
+        try:
+            while True:
+                items = self.pop(batch_size)
+                if not items:
+                    break
+                try:
+                    self.record(items)
+                except DATABASE_UNAVAILABLE:
+                    self.requeue(items)
+                    raise
+                except Exception:
+                    log.exception(
+                        'Failed to record a batch of {} statuses, '
+                        'retrying them one by one'.format(
+                            self.mailstatus_class._meta.label))
+                    self.record_one_by_one(items)
+                count += len(items)
+                if len(items) < batch_size:
+                    break
+        finally:
+            lock.release()
+        if count:
+            log.info('Recorded {} buffered {} statuses'.format(
+                count, self.mailstatus_class._meta.label))
+        return count
@@ -1,8 +1,13 @@
 import os
+import math
 import email
 from unittest import TestCase
+from unittest.mock import patch
 
 from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext
 from slimta.queue import QueueError
 from slimta.envelope import Envelope
 
@@ -12,10 +17,12 @@ from munch.apps.campaigns.tests.factories import MessageFactory
 from munch.apps.campaigns.models import get_base_mail_identifier
 from munch.apps.transactional.models import get_mail_identifier
 
+from ..backmuncher import counters
 from ..backmuncher import DSNHandler
 from ..backmuncher import ARFHandler
 from ..backmuncher import UnsubscribeHandler
 from ..backmuncher import BackMuncherQueuePolicy
+from ..identifiers import identifier_filter
 
 UNSUBSCRIBE_EMAIL=open(os.path.join(
     os.path.dirname(__file__), 'samples/unsubscribe.eml')).read()
@@ -328,3 +335,90 @@ class UnsubscribeHandlerTestCase(TestCase):
         envelope.recipients = [recipient]
         handler = UnsubscribeHandler(envelope, message)
         self.assertIsNotNone(handler.apply())
+
+
+class ZeroQueryTestCase(TestCase):
+    def setUp(self):
+        self.mail = MailFactory(message=MessageFactory(author=UserFactory()))
+
+    def mk_handler(self, handler_class, sample, recipient, return_path):
+        message = email.message_from_string(
+            sample.replace('||TO||', recipient).replace(
+                '||RETURNPATH||', return_path))
+        envelope = Envelope()
+        envelope.parse_msg(message)
+        envelope.recipients = [recipient]
+        return handler_class(envelope, message)
+
+    def test_identifier_filter(self):
+        self.assertIn(self.mail.identifier, identifier_filter)
+        self.assertNotIn(get_base_mail_identifier(), identifier_filter)
+
+    def test_identifier_filter_dimensions(self):
+        backmuncher_settings = settings.BACKMUNCHER.copy()
+        backmuncher_settings.update({
+            'IDENTIFIER_FILTER_EXPECTED_MAILS': 3000000,
+            'IDENTIFIER_FILTER_ERROR_RATE': 0.01,
+            'IDENTIFIER_FILTER_DAYS': 15})
+        with override_settings(BACKMUNCHER=backmuncher_settings):
+            size, hashes = identifier_filter.get_dimensions()
+        # Probability for an unknown identifier to match any daily filter
+        error_rate = 1 - (
+            1 - (1 - math.exp(-hashes * 3000000 / size)) ** hashes) ** 15
+        self.assertLess(error_rate, 0.011)
+
+    def test_identifier_filter_unavailable(self):
+        with patch.object(
+                identifier_filter, 'add', side_effect=ConnectionError):
+            mail = MailFactory(message=self.mail.message)
+        self.assertTrue(mail.pk)
+
+    def test_dsn(self):
+        recipient = 'return-{}@test.munch.example.com'.format(
+            self.mail.identifier)
+        handler = self.mk_handler(DSNHandler, DSN_REPORT, recipient, recipient)
+        with patch('munch.core.mail.backmuncher.campaigns_dsn') as task:
+            with CaptureQueriesContext(connection) as queries:
+                handler.apply()
+        self.assertEqual(len(queries.captured_queries), 0)
+        original_dsn, report = task.apply_async.call_args[1]['args']
+        # Only headers are sent to workers
+        self.assertEqual(
+            email.message_from_string(original_dsn)['To'], recipient)
+        self.assertNotIn('Content-Description', original_dsn)
+        self.assertEqual(report['Status'], '2.0.0')
+
+    def test_arf(self):
+        return_path = 'return-{}@test.munch.example.com'.format(
+            self.mail.identifier)
+        handler = self.mk_handler(
+            ARFHandler, ARF_REPORT, 'abuse@test.munch.example.com',
+            return_path)
+        with patch('munch.core.mail.backmuncher.handle_fbl') as task:
+            with CaptureQueriesContext(connection) as queries:
+                handler.apply()
+        self.assertEqual(len(queries.captured_queries), 0)
+        main_headers, original, report = task.apply_async.call_args[1][
+            'args']
+        self.assertEqual(original['Return-Path'], return_path)
+        self.assertEqual(report['Feedback-Type'], 'abuse')
+
+
+class CountersTestCase(TestCase):
+    def test_counts_by_handler(self):
+        counters.report()
+        recipient = 'return-foo@test.munch.example.com'
+        envelope = Envelope()
+        envelope.parse_msg(email.message_from_string(
+            DSN_REPORT.replace('||TO||', recipient).replace(
+                '||RETURNPATH||', recipient)))
+        envelope.recipients = [recipient]
+        BackMuncherQueuePolicy().apply(envelope)
+
+        envelope.recipients = ['foo@test.munch.example.com']
+        with self.assertRaises(QueueError):
+            BackMuncherQueuePolicy().apply(envelope)
+
+        rates = counters.report()
+        self.assertEqual(set(rates), {'DSNHandler', 'rejected'})
+        self.assertEqual(counters.report(), {})
@@ -0,0 +1,53 @@
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from munch.apps.transactional.models import MailStatus
+from munch.apps.transactional.tests.factories import MailFactory
+
+from ..bounces import bounce_counters
+
+HARD_RULE = (['5.', ''], 3, 365)
+SOFT_RULE = (['4.'], 10, 30 * 6)
+
+
+class BounceCountersTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.now = timezone.now()
+
+    def test_count_by_rule(self):
+        bounce_counters.add('i@example.com', '5.1.1', self.now)
+        bounce_counters.add('i@example.com', '5.1.1', self.now)
+        bounce_counters.add('i@example.com', '4.2.2', self.now)
+        bounce_counters.add('other@example.com', '5.1.1', self.now)
+
+        self.assertEqual(bounce_counters.count('i@example.com', HARD_RULE), 3)
+        self.assertEqual(bounce_counters.count('i@example.com', SOFT_RULE), 1)
+        self.assertEqual(
+            bounce_counters.count('nobody@example.com', HARD_RULE), 0)
+
+    def test_time_frame(self):
+        bounce_counters.add(
+            'i@example.com', '4.2.2', self.now - timedelta(days=200))
+        bounce_counters.add(
+            'i@example.com', '4.2.2', self.now - timedelta(days=100))
+        self.assertEqual(bounce_counters.count('i@example.com', SOFT_RULE), 1)
+        self.assertEqual(bounce_counters.count('i@example.com', HARD_RULE), 2)
+
+    def test_rebuild(self):
+        mail = MailFactory(recipient='i@example.com')
+        for status in [MailStatus.QUEUED, MailStatus.SENDING]:
+            MailStatus.objects.create(
+                mail=mail, status=status, destination_domain='example.com')
+        MailStatus.objects.create(
+            mail=mail, status=MailStatus.BOUNCED, status_code='5.1.1',
+            destination_domain='example.com')
+        self.assertEqual(bounce_counters.count('i@example.com', HARD_RULE), 1)
+
+        cache.clear()
+        self.assertEqual(bounce_counters.count('i@example.com', HARD_RULE), 0)
+        self.assertEqual(bounce_counters.rebuild(), 1)
+        self.assertEqual(bounce_counters.count('i@example.com', HARD_RULE), 1)
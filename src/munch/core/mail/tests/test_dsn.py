@@ -0,0 +1,48 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from ..utils.dsn import DSN
+from ..utils.dsn import environment
+from ..utils.dsn import templates_cache
+
+
+def generate(template=None):
+    return DSN('dsn@example.com', 'sender@example.com').generate(
+        original_headers={'To': 'someone@example.com', 'Subject': 'Hi'},
+        original_body=b'[message omitted]', reply_code='550',
+        reply_message='5.1.1 Unknown user', reporting_mta='mx.example.com',
+        remote_mta='mx.example.org', date='Fri, 5 Aug 2014 23:35:50 +0700',
+        template=template)
+
+
+class DSNTestCase(SimpleTestCase):
+    def test_generate(self):
+        message = generate().decode('utf-8')
+        self.assertIn('To: sender@example.com', message)
+        self.assertIn('Final-Recipient: rfc822; someone@example.com', message)
+        self.assertIn('Status: 5.1.1', message)
+
+    def test_custom_template(self):
+        message = generate('Sorry about {{ original_recipient }}')
+        self.assertIn(b'Sorry about someone@example.com', message)
+
+    def test_templates_compiled_once(self):
+        generate('Custom {{ reply_code }}')
+        with patch.object(
+                environment, 'from_string',
+                wraps=environment.from_string) as from_string:
+            generate('Custom {{ reply_code }}')
+            generate('Other {{ reply_code }}')
+            generate('Other {{ reply_code }}')
+        self.assertEqual(from_string.call_count, 1)
+        self.assertIs(
+            environment.get_template('dsn.jinja2'),
+            environment.get_template('dsn.jinja2'))
+
+    def test_templates_cache_bounded(self):
+        for i in range(templates_cache.max_size + 10):
+            templates_cache.get('Template {}'.format(i))
+        self.assertEqual(
+            len(templates_cache.templates), templates_cache.max_size)
+
@@ -0,0 +1,33 @@
+from django.test import TestCase
+
+from ..models import RawMail
+
+
+class RawMailTestCase(TestCase):
+    def test_identical_content_stored_once(self):
+        raw_mail_01, created_01 = RawMail.objects.get_or_create(
+            content=b'Same body')
+        raw_mail_02, created_02 = RawMail.objects.get_or_create(
+            content='Same body')
+
+        self.assertTrue(created_01)
+        self.assertFalse(created_02)
+        self.assertEqual(raw_mail_01.pk, raw_mail_02.pk)
+        self.assertEqual(RawMail.objects.count(), 1)
+
+    def test_content_roundtrip(self):
+        body = 'Hé ho\n'.encode('utf-8') * 1000 + b'\xff8bit'
+        raw_mail, _ = RawMail.objects.get_or_create(content=body)
+        raw_mail = RawMail.objects.get(pk=raw_mail.pk)
+
+        self.assertEqual(raw_mail.raw_content, body)
+        self.assertLess(len(bytes(raw_mail.data)), len(body))
+        self.assertEqual(
+            raw_mail.content.encode('utf-8', 'surrogateescape'), body)
+
+    def test_lookup_by_signature(self):
+        raw_mail, _ = RawMail.objects.get_or_create(content='test')
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                RawMail.objects.get_or_create(content='test'),
+                (raw_mail, False))
@@ -0,0 +1,211 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.db import connection
+from django.db import OperationalError
+from django.test import TestCase
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from django_fsm import TransitionNotAllowed
+
+from munch.apps.users.tests.factories import UserFactory
+from munch.apps.transactional.models import Mail
+from munch.apps.transactional.models import MailStatus
+from munch.apps.transactional.tests.factories import MailFactory
+from munch.apps.campaigns.models import MailStatus as CampaignsMailStatus
+from munch.apps.campaigns.tests.factories import MessageFactory
+from munch.apps.campaigns.tests.factories import MailFactory as \
+    CampaignsMailFactory
+
+from ..statuses import StatusBuffer
+
+
+class BulkRecordTestCase(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.mail_01 = MailFactory(author=self.user)
+        self.mail_02 = MailFactory(author=self.user)
+        self.now = timezone.now()
+
+    def mk_status(self, status, seconds=0):
+        return MailStatus(
+            status=status, destination_domain='example.com',
+            creation_date=self.now + timedelta(seconds=seconds))
+
+    def test_statuses_applied_in_order(self):
+        statuses = MailStatus.objects.bulk_record([
+            (self.mail_01.identifier, self.mk_status(MailStatus.QUEUED)),
+            (self.mail_02.identifier, self.mk_status(MailStatus.QUEUED)),
+            (self.mail_01.identifier, self.mk_status(MailStatus.SENDING, 1)),
+            (self.mail_01.identifier, self.mk_status(MailStatus.DROPPED, 2)),
+            (self.mail_02.identifier, self.mk_status(MailStatus.SENDING, 3)),
+        ])
+        self.assertEqual(len(statuses), 5)
+        self.assertEqual(MailStatus.objects.count(), 5)
+
+        self.mail_01.refresh_from_db()
+        self.assertEqual(self.mail_01.curstatus, MailStatus.DROPPED)
+        self.assertEqual(self.mail_01.first_status_date, self.now)
+        self.assertEqual(
+            self.mail_01.latest_status_date, self.now + timedelta(seconds=2))
+        self.assertEqual(self.mail_01.delivery_duration, timedelta(seconds=2))
+        self.assertTrue(self.mail_01.had_delay)
+        self.assertIsNone(self.mail_01.message)
+
+        self.mail_02.refresh_from_db()
+        self.assertEqual(self.mail_02.curstatus, MailStatus.SENDING)
+        self.assertFalse(self.mail_02.had_delay)
+        self.assertIsNotNone(self.mail_02.message)
+
+    def test_queries_do_not_grow_with_statuses(self):
+        mails = [MailFactory(author=self.user) for _ in range(5)]
+        MailStatus.objects.bulk_record([
+            (mails[0].identifier, self.mk_status(MailStatus.QUEUED))])
+
+        with CaptureQueriesContext(connection) as one_status:
+            MailStatus.objects.bulk_record([
+                (mails[1].identifier, self.mk_status(MailStatus.QUEUED))])
+        with CaptureQueriesContext(connection) as many_statuses:
+            MailStatus.objects.bulk_record([
+                (mail.identifier, self.mk_status(status))
+                for status in [MailStatus.QUEUED, MailStatus.SENDING]
+                for mail in mails[2:]])
+        self.assertEqual(
+            len(one_status.captured_queries),
+            len(many_statuses.captured_queries))
+
+    def test_unknown_mail_dropped(self):
+        statuses = MailStatus.objects.bulk_record([
+            ('unknown', self.mk_status(MailStatus.QUEUED)),
+            (self.mail_01.identifier, self.mk_status(MailStatus.QUEUED))])
+        self.assertEqual(len(statuses), 1)
+        self.assertEqual(statuses[0].mail, self.mail_01)
+
+    def test_forbidden_transition_dropped(self):
+        mail = CampaignsMailFactory(
+            message=MessageFactory(author=self.user))
+        statuses = CampaignsMailStatus.objects.bulk_record([
+            (mail.identifier, CampaignsMailStatus(
+                status=CampaignsMailStatus.DELIVERED,
+                destination_domain='example.com')),
+            (mail.identifier, CampaignsMailStatus(
+                status=CampaignsMailStatus.QUEUED,
+                destination_domain='example.com'))])
+        self.assertEqual(
+            [status.status for status in statuses],
+            [CampaignsMailStatus.QUEUED])
+        mail.refresh_from_db()
+        self.assertEqual(mail.curstatus, CampaignsMailStatus.QUEUED)
+
+
+class StatusBufferTestCase(TestCase):
+    def setUp(self):
+        self.buffer = StatusBuffer(MailStatus)
+        self.buffer.conn.delete(self.buffer.key)
+        self.buffer.conn.delete(self.buffer.dead_letter_key)
+        self.mail = MailFactory()
+
+    def tearDown(self):
+        self.buffer.conn.delete(self.buffer.key)
+        self.buffer.conn.delete(self.buffer.dead_letter_key)
+
+    def test_flush(self):
+        for status in [MailStatus.QUEUED, MailStatus.SENDING]:
+            self.buffer.push(MailStatus(
+                status=status, destination_domain='example.com',
+                status_code='2.0.0 Ok'), self.mail.identifier)
+        self.assertEqual(len(self.buffer), 2)
+        self.assertEqual(MailStatus.objects.count(), 0)
+
+        self.assertEqual(self.buffer.flush(batch_size=1), 2)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(
+            list(MailStatus.objects.order_by('pk').values_list(
+                'status', 'status_code')),
+            [(MailStatus.QUEUED, '2.0.0'), (MailStatus.SENDING, '2.0.0')])
+        self.mail.refresh_from_db()
+        self.assertEqual(self.mail.curstatus, MailStatus.SENDING)
+
+    def push(self, status=MailStatus.QUEUED):
+        self.buffer.push(MailStatus(
+            status=status, destination_domain='example.com'),
+            self.mail.identifier)
+
+    def test_flush_database_unavailable_keeps_statuses(self):
+        self.push()
+        with patch.object(
+                MailStatus.objects, 'bulk_record',
+                side_effect=OperationalError):
+            with self.assertRaises(OperationalError):
+                self.buffer.flush()
+        self.assertEqual(len(self.buffer), 1)
+
+    def test_flush_bad_status_does_not_block_others(self):
+        self.push()
+        self.buffer.conn.rpush(self.buffer.key, b'not json')
+        self.push(MailStatus.SENDING)
+        self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(MailStatus.objects.count(), 2)
+        self.assertEqual(
+            self.buffer.conn.lrange(self.buffer.dead_letter_key, 0, -1),
+            [b'not json'])
+
+    def test_flush_failing_status_dead_lettered(self):
+        self.push()
+        with patch.object(
+                MailStatus.objects, 'bulk_record', side_effect=ValueError):
+            for _ in range(StatusBuffer.MAX_ATTEMPTS - 1):
+                self.buffer.flush()
+                self.assertEqual(len(self.buffer), 1)
+            self.buffer.flush()
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(
+            self.buffer.conn.llen(self.buffer.dead_letter_key), 1)
+
+    def test_post_processing_failure_not_retried(self):
+        self.push(MailStatus.DROPPED)
+        with patch(
+                'munch.core.mail.models.AbstractMailStatus.count_bounce',
+                side_effect=ConnectionError):
+            self.assertEqual(self.buffer.flush(), 1)
+        self.buffer.flush()
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(MailStatus.objects.count(), 1)
+
+
+class UpdateMailStatusTestCase(TestCase):
+    def setUp(self):
+        self.mail = MailFactory()
+        self.now = timezone.now()
+
+    def test_only_status_fields_written(self):
+        MailStatus.objects.create(
+            mail=self.mail, status=MailStatus.QUEUED, creation_date=self.now,
+            destination_domain='example.com')
+        # Concurrent changes of the mail are not overwritten
+        Mail.objects.filter(pk=self.mail.pk).update(
+            headers={'To': 'someone@example.com'},
+            first_status_date=self.now - timedelta(seconds=10))
+
+        MailStatus.objects.create(
+            mail=self.mail, status=MailStatus.DROPPED,
+            creation_date=self.now + timedelta(seconds=5),
+            destination_domain='example.com')
+        self.mail.refresh_from_db()
+        self.assertEqual(self.mail.headers, {'To': 'someone@example.com'})
+        self.assertEqual(self.mail.curstatus, MailStatus.DROPPED)
+        self.assertEqual(
+            self.mail.first_status_date, self.now - timedelta(seconds=10))
+        self.assertEqual(self.mail.delivery_duration, timedelta(seconds=15))
+        self.assertTrue(self.mail.had_delay)
+        self.assertIsNone(self.mail.message)
+
+    def test_forbidden_transition(self):
+        mail = CampaignsMailFactory(
+            message=MessageFactory(author=UserFactory()))
+        with self.assertRaises(TransitionNotAllowed):
+            CampaignsMailStatus.objects.create(
+                mail=mail, status=CampaignsMailStatus.DELIVERED,
+                destination_domain='example.com')
+        self.assertFalse(CampaignsMailStatus.objects.exists())
@@ -45,3 +45,22 @@ def get_app_url(domain=None, organization=None):
             scheme, organization.settings.nickname, domain)
     else:
         return settings.APPLICATION_URL.strip('/')
+
+
+class UrlTemplate:
+    """ An url built once, then formatted for many values
+
+    :param build: f(**kwargs) -> url, called once with markers as values
+                  (reverse() is slow).
+
+    Values must be url-safe (as identifiers), as they are not quoted.
+    """
+    def __init__(self, build, *names):
+        markers = {name: uuid.uuid4().hex for name in names}
+        template = build(**markers).replace('{', '{{').replace('}', '}}')
+        for name, marker in markers.items():
+            template = template.replace(marker, '{%s}' % name)
+        self.template = template
+
+    def format(self, **kwargs):
+        return self.template.format(**kwargs)
@@ -1,13 +1,16 @@
 import re
 import uuid
 import time
+import hashlib
+import threading
+from collections import OrderedDict
 from math import floor
 from email.generator import Generator
 from email.utils import formatdate
 
-from jinja2 import Template
 from jinja2 import Environment
 from jinja2 import PackageLoader
+from jinja2 import FileSystemBytecodeCache
 
 from .parsers import parse_email_date
 from ..models import AbstractMailStatus
@@ -123,6 +126,35 @@ ACTIONS_STATUS_MAP = {
     '5': 'failed'
 }
 
+# Shared by every DSN of the process: templates are compiled once (and
+# their bytecode cached on disk, for other processes).
+environment = Environment(
+    loader=PackageLoader('munch.core.mail.utils', 'templates'),
+    bytecode_cache=FileSystemBytecodeCache(), auto_reload=False)
+
+
+class TemplatesCache:
+    """ Bounded LRU cache of compiled custom templates, by source digest """
+    def __init__(self, environment, max_size=128):
+        self.environment = environment
+        self.max_size = max_size
+        self.templates = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, source):
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        with self.lock:
+            template = self.templates.pop(key, None)
+            if template is None:
+                template = self.environment.from_string(source)
+            self.templates[key] = template
+            if len(self.templates) > self.max_size:
+                self.templates.popitem(last=False)
+        return template
+
+
+templates_cache = TemplatesCache(environment)
+
 
 class DSN:
     """ Delivery status notification
@@ -175,14 +207,12 @@ class DSN:
             'original_body': original_body.decode('utf-8'),
         })
 
-        environment = Environment(
-            loader=PackageLoader('munch.core.mail.utils', 'templates'))
         dsn_template = environment.get_template('dsn.jinja2')
 
         if template is None:
             dsn_body_template = environment.get_template('dsn.body.jinja2')
         else:
-            dsn_body_template = Template(template)
+            dsn_body_template = templates_cache.get(template)
 
         self.context.update(
             {'dsn_body': dsn_body_template.render(self.context)})
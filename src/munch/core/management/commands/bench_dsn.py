@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from munch.core.mail.utils.dsn import DSN
+from munch.core.mail.utils.dsn import environment
+from munch.core.mail.utils.dsn import templates_cache
+
+CUSTOM_TEMPLATE = 'Your message to {{ original_recipient }} failed'
+
+
+def generate(template=None):
+    return DSN('dsn@example.com', 'sender@example.com').generate(
+        original_headers={'To': 'someone@example.com', 'Subject': 'Hi'},
+        original_body=b'[message omitted]', reply_code='550',
+        reply_message='5.1.1 Unknown user', reporting_mta='mx.example.com',
+        remote_mta='mx.example.org', date='Fri, 5 Aug 2014 23:35:50 +0700',
+        template=template)
+
+
+def clear_caches():
+    """ Forget in-process compiled templates (on-disk bytecode is kept) """
+    environment.cache.clear()
+    templates_cache.templates.clear()
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure DSN generation throughput, with and without in-process '
+        'compiled templates.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations', dest='iterations', type=int, default=500)
+
+    def timeit(self, iterations, template=None, cold=False):
+        generate(template)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            if cold:
+                clear_caches()
+            generate(template)
+        return iterations / (time.perf_counter() - start)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        for name, template in [
+                ('default', None), ('custom', CUSTOM_TEMPLATE)]:
+            cold = self.timeit(iterations, template, cold=True)
+            warm = self.timeit(iterations, template)
+            self.stdout.write(
+                '{:>7} template: cold {:8.0f} DSN/s, '
+                'cached {:8.0f} DSN/s ({:.1f}x)'.format(
+                    name, cold, warm, warm / cold))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from munch.core.mail.bounces import bounce_counters
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild rolling bounce counters (used by the bounce opt-out "
+        "policy) from mail statuses history. Run it after BOUNCE_POLICY "
+        "changes.")
+
+    def handle(self, *args, **options):
+        count = bounce_counters.rebuild()
+        self.stdout.write('Bounces counted: {}'.format(count))
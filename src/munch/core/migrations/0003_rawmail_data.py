@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_permissions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rawmail',
+            name='data',
+            field=models.BinaryField(
+                default=b'', verbose_name='compressed content'),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='rawmail',
+            name='content',
+            field=models.TextField(
+                blank=True, default='', verbose_name='content'),
+        ),
+        migrations.AlterField(
+            model_name='rawmail',
+            name='signature',
+            field=models.CharField(max_length=64, verbose_name='signature'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import zlib
+import hashlib
+
+from django.db import migrations
+
+
+def compress_and_deduplicate(apps, schema_editor):
+    RawMail = apps.get_model('core', 'RawMail')
+    Mail = apps.get_model('transactional', 'Mail')
+
+    seen = {}
+    for raw_mail in RawMail.objects.order_by('pk').iterator():
+        content = raw_mail.content.encode('utf-8', 'surrogateescape')
+        signature = hashlib.sha256(content).hexdigest()
+        if signature in seen:
+            Mail.objects.filter(message_id=raw_mail.pk).update(
+                message_id=seen[signature])
+            raw_mail.delete()
+            continue
+        seen[signature] = raw_mail.pk
+        raw_mail.signature = signature
+        raw_mail.data = zlib.compress(content)
+        raw_mail.save(update_fields=['signature', 'data'])
+
+
+def decompress(apps, schema_editor):
+    RawMail = apps.get_model('core', 'RawMail')
+
+    for raw_mail in RawMail.objects.iterator():
+        content = zlib.decompress(raw_mail.data)
+        raw_mail.signature = hashlib.md5(content).hexdigest()
+        raw_mail.content = content.decode('utf-8', 'surrogateescape')
+        raw_mail.save(update_fields=['signature', 'content'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_rawmail_data'),
+        ('transactional', '0002_permissions'),
+    ]
+
+    operations = [
+        migrations.RunPython(compress_and_deduplicate, decompress),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_rawmail_compress'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='rawmail',
+            name='content',
+        ),
+        migrations.AlterField(
+            model_name='rawmail',
+            name='signature',
+            field=models.CharField(
+                max_length=64, unique=True, verbose_name='signature'),
+        ),
+    ]
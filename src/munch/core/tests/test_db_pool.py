@@ -0,0 +1,80 @@
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import gevent
+import psycopg2.extensions
+from django.test import TestCase
+
+from ..db.pool import PoolTimeout
+from ..db.pool import ConnectionPool
+from ..db.pool import release_connections
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTestCase(TestCase):
+    def mk_pool(self, max_size=2, **kwargs):
+        return ConnectionPool(FakeConnection, max_size, **kwargs)
+
+    def test_reuse(self):
+        pool = self.mk_pool()
+        connection = pool.checkout()
+        pool.checkin(connection)
+        self.assertIs(pool.checkout(), connection)
+        self.assertEqual(pool.stats['created'], 1)
+        self.assertEqual(pool.stats['checkouts'], 2)
+
+    def test_closed_connection_not_reused(self):
+        pool = self.mk_pool()
+        connection = pool.checkout()
+        pool.checkin(connection)
+        connection.closed = True
+        self.assertIsNot(pool.checkout(), connection)
+        self.assertEqual(pool.stats['created'], 2)
+
+    def test_rollback_on_checkin(self):
+        pool = self.mk_pool()
+        connection = pool.checkout()
+        connection.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        pool.checkin(connection)
+        self.assertEqual(connection.rollbacks, 1)
+
+    def test_bounded(self):
+        pool = self.mk_pool(max_size=1, timeout=0.01)
+        pool.checkout()
+        self.assertEqual(pool.in_use, 1)
+        with self.assertRaises(PoolTimeout):
+            pool.checkout()
+        self.assertEqual(pool.stats['timeouts'], 1)
+
+    def test_wait_for_checkin(self):
+        pool = self.mk_pool(max_size=1, timeout=1)
+        connection = pool.checkout()
+        gevent.spawn_later(0.05, pool.checkin, connection)
+        self.assertIs(pool.checkout(), connection)
+        self.assertGreater(pool.stats['wait_max'], 0)
+
+    def test_release_connections(self):
+        idle = Mock(connection=Mock(), in_atomic_block=False)
+        atomic = Mock(connection=Mock(), in_atomic_block=True)
+        connections = {'idle': idle, 'atomic': atomic}
+        with patch('munch.core.db.pool._pools', dict.fromkeys(connections)):
+            with patch('django.db.connections', connections):
+                release_connections()
+        idle.close.assert_called_once_with()
+        atomic.close.assert_not_called()
@@ -30,6 +30,7 @@ def cli(ctx, config):
 
 list(map(lambda cmd: cli.add_command(import_string(cmd)), (
     'munch.runner.commands.run.run',
+    'munch.runner.commands.bench.bench',
     'munch.runner.commands.help.help',
     'munch.runner.commands.django.django',
 )))
@@ -0,0 +1,281 @@
+import click
+
+
+def percentile(values, percent):
+    """ Nearest-rank percentile of an already sorted list """
+    if not values:
+        return 0.
+    index = int(round(percent / 100 * (len(values) - 1)))
+    return values[min(index, len(values) - 1)]
+
+
+def format_timings(name, timings):
+    timings = sorted(timings)
+    return '{:<60} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+        name, len(timings),
+        percentile(timings, 50) * 1000,
+        percentile(timings, 90) * 1000,
+        percentile(timings, 99) * 1000)
+
+
+def mk_message(sender, recipients, size):
+    """ Builds an HTML message of about `size` bytes, with some links """
+    from email.mime.text import MIMEText
+
+    chunk = (
+        '<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
+        '<a href="http://example.com/{}">Read more</a></p>\n')
+    chunks, length, i = [], 0, 0
+    while length < size:
+        chunks.append(chunk.format(i % 20))
+        length += len(chunks[-1])
+        i += 1
+    message = MIMEText(
+        '<html><body>{}</body></html>'.format(''.join(chunks)), 'html')
+    message['From'] = sender
+    message['To'] = ', '.join(recipients)
+    message['Subject'] = 'Munch benchmark'
+    return message.as_string()
+
+
+def count_queries(counter):
+    """ Count every query made by the process """
+    from django.db.backends.utils import CursorWrapper
+
+    def wrap(method):
+        def wrapper(self, *args, **kwargs):
+            counter['queries'] += 1
+            return method(self, *args, **kwargs)
+        return wrapper
+
+    CursorWrapper.execute = wrap(CursorWrapper.execute)
+    CursorWrapper.executemany = wrap(CursorWrapper.executemany)
+
+
+def time_policies(queue, timings):
+    """ Record execution time of each queue policy """
+    import time
+
+    def wrap(name, method):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timings.setdefault(name, []).append(
+                    time.perf_counter() - start)
+        return wrapper
+
+    for policy in queue.queue_policies:
+        name = '{}.{}'.format(
+            policy.__class__.__module__, policy.__class__.__name__)
+        for method in ('apply', 'apply_batch'):
+            if hasattr(policy, method):
+                setattr(policy, method, wrap(name, getattr(policy, method)))
+
+
+def mk_fixtures():
+    from munch.apps.users.models import MunchUser
+    from munch.apps.users.models import Organization
+    from munch.apps.users.models import SmtpApplication
+    from munch.apps.domains.models import SendingDomain
+
+    organization = Organization.objects.create(
+        name='Benchmark', contact_email='bench@bench.example.com')
+    user = MunchUser(
+        identifier='bench@bench.example.com', organization=organization,
+        first_name='Bench', last_name='Mark', is_active=True)
+    user.set_password(None)
+    user.save()
+    SendingDomain.objects.create(
+        name='bench.example.com', organization=organization)
+    return SmtpApplication.objects.create(identifier='bench', author=user)
+
+
+@click.group()
+def bench():
+    "Benchmark a service."
+
+
+@bench.command()
+@click.option(
+    '--clients', '-c', default=10, show_default=True,
+    help='Number of concurrent SMTP clients.')
+@click.option(
+    '--messages', '-n', default=1000, show_default=True,
+    help='Total number of SMTP transactions.')
+@click.option(
+    '--size', '-s', default=10, show_default=True,
+    help='Message size, in KB.')
+@click.option(
+    '--recipients', '-r', default=1, show_default=True,
+    help='Number of recipients per transaction.')
+@click.option(
+    '--reconnect', is_flag=True, default=False,
+    help='Open a new connection (and AUTH) for each transaction.')
+@click.option('--no-auth', is_flag=True, default=False, help=(
+    'Do not authenticate (every transaction is then refused).'))
+@click.option('--starttls', is_flag=True, default=False, help=(
+    'Use STARTTLS, requires --tls-certfile and --tls-keyfile.'))
+@click.option('--tls-certfile', type=click.Path(exists=True))
+@click.option('--tls-keyfile', type=click.Path(exists=True))
+@click.option('--no-db-pool', is_flag=True, default=False, help=(
+    'Do not use the database connections pool of the edge.'))
+@click.option(
+    '--keepdb', is_flag=True, default=False,
+    help='Preserve the test database between runs.')
+def smtp(**options):
+    """ Load-test the transactional smtp smarthost.
+
+    Starts the edge on a random local port, against a test database and
+    the dummy mail backend, drives concurrent SMTP clients through it and
+    reports throughput, queue policies latency and database queries per
+    transaction.
+    """
+    from gevent import monkey
+    monkey.patch_all(thread=False)
+
+    import os
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "munch.settings")
+
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+    if options['starttls'] and not (
+            options['tls_certfile'] and options['tls_keyfile']):
+        raise click.BadParameter(
+            '--starttls requires --tls-certfile and --tls-keyfile')
+
+    # Must be set before django.setup(), which instanciates the backend
+    from django.conf import settings
+    settings.MASS_EMAIL_BACKEND = 'munch.core.mail.backend.DummyBackend'
+    settings.CELERY_ALWAYS_EAGER = True
+    settings.TRANSACTIONAL['SMTP_SMARTHOST_TLS'] = None
+    if options['starttls']:
+        settings.TRANSACTIONAL['SMTP_SMARTHOST_TLS'] = {
+            'certfile': options['tls_certfile'],
+            'keyfile': options['tls_keyfile']}
+
+    import django
+    django.setup()
+
+    import ssl
+    import time
+    import smtplib
+
+    import gevent
+    from gevent.pool import Pool
+    from django.db import connection
+    from django.db import connections
+
+    from munch.core.db import pool as db_pool
+    from munch.apps.transactional.queue import queue
+    from munch.apps.transactional.edge import TransactionalSmtpEdge
+    from munch.apps.transactional.edge import EdgeValidators
+
+    test_database_name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+    old_database_name = settings.DATABASES['default']['NAME']
+    if not options['no_db_pool'] and settings.TRANSACTIONAL.get(
+            'EDGE_DB_POOL_SIZE', 20):
+        connection.close()
+        db_pool.install()
+
+    application = mk_fixtures()
+
+    ssl_context = None
+    if options['starttls']:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        ssl_context.load_cert_chain(
+            options['tls_certfile'], keyfile=options['tls_keyfile'])
+
+    counter = {'queries': 0}
+    policies_timings = {}
+    count_queries(counter)
+    time_policies(queue, policies_timings)
+
+    edge = TransactionalSmtpEdge(
+        ('127.0.0.1', 0), queue,
+        pool=Pool(options['clients'] * 2),
+        hostname='bench.munch.localhost',
+        validator_class=EdgeValidators,
+        context=ssl_context,
+        auth=True)
+    edge.start()
+    gevent.sleep(0.1)
+    port = edge.server.server_port
+
+    sender = 'bench@bench.example.com'
+    recipients = [
+        'rcpt-{}@example.org'.format(i)
+        for i in range(options['recipients'])]
+    message = mk_message(sender, recipients, options['size'] * 1024)
+    latencies, errors = [], []
+
+    def connect():
+        client = smtplib.SMTP('127.0.0.1', port)
+        client.ehlo()
+        if options['starttls']:
+            client.starttls(context=ssl._create_unverified_context())
+            client.ehlo()
+        if not options['no_auth']:
+            client.login(application.username, application.secret)
+        return client
+
+    def run_client(count):
+        client = None
+        for i in range(count):
+            start = time.perf_counter()
+            try:
+                if client is None:
+                    client = connect()
+                client.sendmail(sender, recipients, message)
+                latencies.append(time.perf_counter() - start)
+            except (smtplib.SMTPException, OSError) as err:
+                errors.append(err)
+                client = None
+            if options['reconnect'] and client is not None:
+                client.quit()
+                client = None
+        if client is not None:
+            client.quit()
+
+    per_client, rest = divmod(options['messages'], options['clients'])
+    click.echo('Sending {} transactions ({} recipients, {}KB) '
+               'with {} clients to 127.0.0.1:{}...'.format(
+                   options['messages'], options['recipients'],
+                   options['size'], options['clients'], port))
+    start = time.perf_counter()
+    gevent.joinall([
+        gevent.spawn(run_client, per_client + (1 if i < rest else 0))
+        for i in range(options['clients'])])
+    duration = time.perf_counter() - start
+
+    edge.server.stop(timeout=1)
+    edge.kill()
+
+    sent = len(latencies)
+    click.echo('')
+    click.echo('Transactions: {} sent, {} failed in {:.2f}s'.format(
+        sent, len(errors), duration))
+    if errors:
+        click.echo('First error: {!r}'.format(errors[0]))
+    click.echo('Throughput: {:.1f} transactions/s, {:.1f} recipients/s'.format(
+        sent / duration, sent * options['recipients'] / duration))
+    if sent:
+        click.echo(
+            'DB queries: {:.1f} per transaction, {:.1f} per recipient'.format(
+                counter['queries'] / sent,
+                counter['queries'] / (sent * options['recipients'])))
+    click.echo('')
+    click.echo('{:<60} {:>7} {:>9} {:>9} {:>9}'.format(
+        'Latency (ms)', 'count', 'p50', 'p90', 'p99'))
+    click.echo(format_timings('SMTP transaction (client side)', latencies))
+    for name, timings in policies_timings.items():
+        click.echo(format_timings(name, timings))
+
+    connections.close_all()
+    db_pool.close_all_pools()
+    settings.DATABASES['default']['NAME'] = test_database_name
+    connection.creation.destroy_test_db(
+        old_database_name, verbosity=0, keepdb=options['keepdb'])
@@ -42,6 +42,10 @@ def smtp():
 
     from django.conf import settings
 
+    if settings.TRANSACTIONAL.get('EDGE_DB_POOL_SIZE', 20):
+        from munch.core.db import pool as db_pool
+        db_pool.install()
+
     from gevent import sleep
     from gevent.pool import Pool
     from slimta.system import drop_privileges
@@ -51,6 +55,7 @@ def smtp():
     from munch.apps.transactional.edge import (
         TransactionalSmtpEdge, ProxyProtocolTransactionalSmtpEdge)
     from munch.apps.transactional.edge import EdgeValidators
+    from munch.apps.transactional.backpressure import backpressure
 
     monkey_patch_slimta_exception()
 
@@ -103,6 +108,7 @@ def smtp():
         settings.TRANSACTIONAL.get('SMTP_BIND_HOST'),
         settings.TRANSACTIONAL.get('SMTP_BIND_PORT')))
     edge.start()
+    backpressure.start(pool)
 
     if settings.TRANSACTIONAL.get('DROP_PRIVILEGES_USER') is not None:
         # ??? Really needed? See python-slimta/examples/slimta-mail.py...
@@ -212,38 +218,65 @@ def cron(**options):
 @run.command()
 def backmuncher():
     "Run smtp that handle feedback loops, unsuscribes and more."
+    from gevent import monkey
+    # Same as smtp: do not patch threads (see above)
+    monkey.patch_all(thread=False)
+
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
 
     import django
     django.setup()
 
     from django.conf import settings
-    from slimta.edge.smtp import SmtpEdge
+
+    if settings.BACKMUNCHER.get('DB_POOL_SIZE', 10):
+        from munch.core.db import pool as db_pool
+        db_pool.install(
+            max_size=settings.BACKMUNCHER.get('DB_POOL_SIZE', 10),
+            timeout=settings.BACKMUNCHER.get('DB_POOL_TIMEOUT', 10),
+            max_idle=settings.BACKMUNCHER.get('DB_POOL_MAX_IDLE', 300))
+
+    import gevent
+    from gevent.pool import Pool
     from slimta.system import drop_privileges
-    from slimta.util.proxyproto import ProxyProtocol
     from slimta.relay.blackhole import BlackholeRelay
 
     from munch.core.mail.backmuncher import Queue
+    from munch.core.mail.backmuncher import counters
+    from munch.core.mail.backmuncher import BackMuncherSmtpEdge
+    from munch.core.mail.backmuncher import ProxyProtocolBackMuncherSmtpEdge
 
-    edge_class = SmtpEdge
+    pool = Pool(settings.BACKMUNCHER.get('MAX_CONN', 200))
+
+    edge_class = BackMuncherSmtpEdge
     if settings.BACKMUNCHER.get('PROXYPROTO_ENABLED', False):
-        class ProxyProtocolSmtpEdge(ProxyProtocol, SmtpEdge):
-            pass
-        edge_class = ProxyProtocolSmtpEdge
+        edge_class = ProxyProtocolBackMuncherSmtpEdge
 
+    timeouts = settings.BACKMUNCHER.get('TIMEOUTS', {})
     edge = edge_class(
         (
             settings.BACKMUNCHER.get('SMTP_BIND_HOST'),
             settings.BACKMUNCHER.get('SMTP_BIND_PORT')),
         Queue(BlackholeRelay()),
+        data_timeout=timeouts.get('data_timeout'),
+        command_timeout=timeouts.get('command_timeout'),
+        pool=pool,
         hostname=settings.BACKMUNCHER.get('EDGE_EHLO_AS', None),
     )
 
-    log.info('Listening on {}:{}'.format(
+    log.info('Listening on {}:{} ({} connections max)'.format(
         settings.BACKMUNCHER.get('SMTP_BIND_HOST'),
-        settings.BACKMUNCHER.get('SMTP_BIND_PORT')))
+        settings.BACKMUNCHER.get('SMTP_BIND_PORT'), pool.size))
     edge.start()
 
+    stats_interval = settings.BACKMUNCHER.get('STATS_INTERVAL', 60)
+    if stats_interval:
+        gevent.spawn(counters.log_forever, stats_interval)
+
     if settings.BACKMUNCHER.get('DROP_PRIVILEGES_USER') is not None:
+        gevent.sleep(0.1)
+
         # If this command is run with root user (to be allowed to
         # open reserved ports like 25), we should then "switch" to a
         # normal user for security.
@@ -258,8 +291,13 @@ def backmuncher():
         edge.get()
     except KeyboardInterrupt:
         try:
+            stop_timeout = settings.BACKMUNCHER.get('STOP_TIMEOUT', 5)
             edge.server.close()
             log.info('Stop accepting connections.')
+            # Let current sessions finish, up to stop_timeout seconds
+            if not pool.join(timeout=stop_timeout):
+                log.info('{} connections still open, closing them.'.format(
+                    len(pool)))
             log.info('Edge stopped...')
             edge.server.stop(timeout=1)
         except KeyboardInterrupt:
@@ -182,6 +182,18 @@ CELERYBEAT_SCHEDULE = {
         'args': (['ok'], ),
         'schedule': timedelta(hours=12),
     },
+    'flush_transactional_status_buffer': {
+        'task': 'munch.apps.transactional.status.flush_status_buffer',
+        'schedule': timedelta(seconds=1),
+    },
+    'flush_campaigns_status_buffer': {
+        'task': 'munch.apps.campaigns.utils.flush_status_buffer',
+        'schedule': timedelta(seconds=1),
+    },
+    'flush_transactional_webhooks': {
+        'task': 'munch.apps.transactional.status.flush_webhooks',
+        'schedule': timedelta(seconds=1),
+    },
 }
 
 ##########
@@ -237,6 +249,7 @@ X_POOL_HEADER = 'X-Munch-Pool'
 X_MESSAGE_ID_HEADER = 'X-Munch-Message-Id'
 X_HTTP_DSN_RETURN_PATH_HEADER = 'X-Munch-HTTP-Return-Path'
 X_SMTP_DSN_RETURN_PATH_HEADER = 'X-Munch-SMTP-Return-Path'
+X_HTTP_DSN_RETURN_PATH_BATCHING_HEADER = 'X-Munch-HTTP-Return-Path-Batching'
 
 #################
 # Transactional #
@@ -246,6 +259,8 @@ TRANSACTIONAL = {
     'X_MESSAGE_ID_HEADER': X_MESSAGE_ID_HEADER,
     'X_HTTP_DSN_RETURN_PATH_HEADER': X_HTTP_DSN_RETURN_PATH_HEADER,
     'X_SMTP_DSN_RETURN_PATH_HEADER': X_SMTP_DSN_RETURN_PATH_HEADER,
+    'X_HTTP_DSN_RETURN_PATH_BATCHING_HEADER': (
+        X_HTTP_DSN_RETURN_PATH_BATCHING_HEADER),
     'X_MAIL_BATCH_HEADER': 'X-Munch-MailBatch',
     'X_MAIL_BATCH_CATEGORY_HEADER': 'X-Munch-MailBatch-Category',
     'X_MAIL_TRACK_OPEN_HEADER': 'X-Munch-Track-Open',
@@ -258,6 +273,21 @@ TRANSACTIONAL = {
     # Default is 200
     'EDGE_MAX_CONN': 200,
     'EDGE_TIMEOUTS': {'data_timeout': None, 'command_timeout': None},
+    # Database connections pool shared by the greenlets of the SMTP edge
+    # (`munch run smtp`). Set EDGE_DB_POOL_SIZE to 0 to disable it.
+    'EDGE_DB_POOL_SIZE': 20,
+    # How long (in seconds) a session waits for a pooled connection
+    'EDGE_DB_POOL_TIMEOUT': 10,
+    # Pooled connections idle for longer than that (in seconds) are closed
+    'EDGE_DB_POOL_MAX_IDLE': 300,
+    # The edge answers "451 4.3.2" to MAIL and DATA while a broker queue
+    # holds more messages than its high-water mark (by worker type), or
+    # while more than that ratio of EDGE_MAX_CONN connections are in use.
+    'EDGE_BACKPRESSURE_QUEUES_HIGH_WATER': {
+        'core': 50000, 'status': 100000},
+    'EDGE_BACKPRESSURE_POOL_HIGH_WATER': 0.95,
+    # How often (in seconds) broker queues depth is sampled
+    'EDGE_BACKPRESSURE_INTERVAL': 5,
     'PROXYPROTO_ENABLED': False,
     'STATUS_WORKER_QUEUE': 'munch.status',
     'SMTP_SMARTHOST_TLS': None,
@@ -267,6 +297,23 @@ TRANSACTIONAL = {
     'SMTP_BIND_HOST': '127.0.0.1',
     'SMTP_BIND_PORT': 1025,
     'SMTP_STOP_TIMEOUT': 5,
+    # How long (in seconds) the edge caches an authenticated client context
+    # (user, organization, sending domains) before resolving it again.
+    'AUTH_CONTEXT_TTL': 60,
+    # How often (in seconds) the edge checks, for each envelope, whether the
+    # context was invalidated by another process (application, user...
+    # changes).
+    'AUTH_CONTEXT_CHECK_INTERVAL': 1,
+    # Credentials verified by the edge are cached (as HMAC digests), for at
+    # most EDGE_AUTH_CACHE_SIZE SMTP applications and EDGE_AUTH_CACHE_TTL
+    # seconds.
+    'EDGE_AUTH_CACHE_SIZE': 10000,
+    'EDGE_AUTH_CACHE_TTL': 300,
+    # Failed logins are cached for EDGE_AUTH_FAILURES_TTL seconds, clients
+    # failing more than EDGE_AUTH_MAX_FAILURES times within that window are
+    # temporarily refused.
+    'EDGE_AUTH_FAILURES_TTL': 60,
+    'EDGE_AUTH_MAX_FAILURES': 10,
     'QUEUE_POLICIES': [
         'slimta.policy.split.RecipientSplit',
         'slimta.policy.split.RecipientDomainSplit',
@@ -281,10 +328,39 @@ TRANSACTIONAL = {
         'munch.apps.transactional.policies.queue.exec.Apply',
         'munch.apps.transactional.policies.queue.store_mail.Store'],
     # Status logging
+    # With STATUS_BATCHING, statuses are buffered in redis and recorded by
+    # batches of (at most) STATUS_BATCH_SIZE, every second.
+    'STATUS_BATCHING': False,
+    'STATUS_BATCH_SIZE': 1000,
     'STATUS_WEBHOOK_RETRIES': 20,
     'STATUS_WEBHOOK_RETRY_INTERVAL': 180,
+    # Webhooks are posted through keep-alive connections (at most
+    # STATUS_WEBHOOK_POOL_SIZE per host and worker), with (connect, read)
+    # timeouts in seconds.
+    'STATUS_WEBHOOK_POOL_SIZE': 10,
+    'STATUS_WEBHOOK_TIMEOUT': (3.05, 10),
+    # How many requests can be in flight to a webhook, across all workers
+    'STATUS_WEBHOOK_MAX_CONCURRENCY': 10,
+    # A webhook failing STATUS_WEBHOOK_BREAKER_THRESHOLD times in a row is
+    # not called for STATUS_WEBHOOK_BREAKER_TIMEOUT seconds.
+    'STATUS_WEBHOOK_BREAKER_THRESHOLD': 10,
+    'STATUS_WEBHOOK_BREAKER_TIMEOUT': 60,
+    # Statuses of mails with a X_HTTP_DSN_RETURN_PATH_BATCHING_HEADER are
+    # posted every second, as JSON lists of (at most)
+    # STATUS_WEBHOOK_BATCH_SIZE statuses, instead of one by one.
+    'STATUS_WEBHOOK_BATCH_SIZE': 100,
+    # Queued statuses of a webhook are dropped, oldest first, beyond
+    # STATUS_WEBHOOK_MAX_QUEUE_SIZE, or once queued for more than
+    # STATUS_WEBHOOK_MAX_AGE seconds.
+    'STATUS_WEBHOOK_MAX_QUEUE_SIZE': 10000,
+    'STATUS_WEBHOOK_MAX_AGE': 86400,
+    # How long (in seconds) status handlers keep mail headers in cache
+    'MAIL_HEADERS_CACHE_TTL': 300,
     'EXEC_QUEUE_POLICIES': [],
     'EXEC_QUEUE_POLICIES_CONTEXT_BUILTINS': [],
+    # Ephemeral policies are compiled once and only recompiled when their
+    # mtime changes; how often (in seconds) to stat them for changes.
+    'EXEC_QUEUE_POLICIES_CHECK_INTERVAL': 5,
     # Filters applied to add custom headers to emails for each recipient
     # (order matters).
     'HEADERS_FILTERS': [
@@ -321,6 +397,22 @@ CAMPAIGNS = {
     # an existing MX record on their domain.
     # BYPASS_DNS_CHECKS=True also disable this check
     'BYPASS_RECIPIENTS_MX_CHECK': False,
+    # Recipients domains MX records are resolved once for a message, when
+    # it starts sending, and kept in cache as long as their DNS TTL says,
+    # within these bounds (seconds)
+    'MX_CACHE_MIN_TTL': 60,
+    'MX_CACHE_MAX_TTL': 3600 * 24,
+    # How long to keep domains without MX record, or which could not be
+    # resolved (seconds)
+    'MX_NEGATIVE_TTL': 3600,
+    'MX_ERROR_TTL': 60,
+    # How many domains are resolved at the same time
+    'MX_RESOLVE_CONCURRENCY': 20,
+    # How many mails each sending task handles
+    'SEND_CHUNK_SIZE': 1000,
+    # How long (in seconds) template-level HTML and plaintext renderings
+    # of messages are kept in cache
+    'RENDER_CACHE_TTL': 3600 * 24,
     'SKIP_SPAM_CHECK': False,
     'SKIP_VIRUS_CHECK': False,
     # When to opt-out after a bounce ?
@@ -329,6 +421,10 @@ CAMPAIGNS = {
     # - how many bounces before optout ?
     # - in which time frame are the bounces counted ?
     'BOUNCE_POLICY': [(['4.'], 10, 30 * 6), (['5.', ''], 3, 365)],
+    # With STATUS_BATCHING, statuses are buffered in redis and recorded by
+    # batches of (at most) STATUS_BATCH_SIZE, every second.
+    'STATUS_BATCHING': False,
+    'STATUS_BATCH_SIZE': 1000,
     # Filters applied to the template provided by the organization to produce
     # the HTML template (order matters).
     'HTML_TEMPLATE_FILTERS': [
@@ -379,6 +475,31 @@ BACKMUNCHER = {
     'EDGE_EHLO_AS': 'localhost',
     'DROP_PRIVILEGES_USER': None,
     'DROP_PRIVILEGES_GROUP': None,
+    'PROXYPROTO_ENABLED': False,
+    # Concurrent SMTP sessions (greenlets)
+    'MAX_CONN': 200,
+    # In seconds, None to wait forever
+    'TIMEOUTS': {'data_timeout': 300, 'command_timeout': 120},
+    # How long (in seconds) current sessions may finish on shutdown
+    'STOP_TIMEOUT': 5,
+    # Database connections pool shared by sessions, 0 to disable it
+    'DB_POOL_SIZE': 10,
+    'DB_POOL_TIMEOUT': 10,
+    'DB_POOL_MAX_IDLE': 300,
+    # How often (in seconds) to log throughput by handler, 0 to disable
+    'STATS_INTERVAL': 60,
+    # Identifiers of sent mails are kept in daily bloom filters (bitmaps in
+    # redis) for IDENTIFIER_FILTER_DAYS days, so that incoming DSN, ARF and
+    # unsubscribe mails are checked without querying the database.
+    # Filters are sized so that, up to IDENTIFIER_FILTER_EXPECTED_MAILS
+    # mails a day, at most IDENTIFIER_FILTER_ERROR_RATE of unknown
+    # identifiers are taken for ours. Existing filters are meaningless once
+    # those settings change (until they expire).
+    'IDENTIFIER_FILTER_EXPECTED_MAILS': 1000000,
+    'IDENTIFIER_FILTER_ERROR_RATE': 0.01,
+    'IDENTIFIER_FILTER_DAYS': 15,
+    # Look identifiers missing from the filters up in database
+    'IDENTIFIER_DB_FALLBACK': True,
 }
 
 #########
@@ -406,6 +527,15 @@ DOMAINS = {
 UNSUBSCRIBE_PLACEHOLDER = 'UNSUBSCRIBE_URL'
 OPTOUTS = {
     'UNSUBSCRIBE_PLACEHOLDER': UNSUBSCRIBE_PLACEHOLDER,
+    # How often (in seconds) each process pulls opt-outs created elsewhere
+    # into its in-memory suppression index.
+    'INDEX_REFRESH_INTERVAL': 60,
+    # How often (in seconds) each process reads the shared version stamp
+    # telling that opt-outs were created elsewhere.
+    'INDEX_VERSION_CHECK_INTERVAL': 1,
+    # How far back (in seconds) each refresh looks for opt-outs committed
+    # while the previous one was running.
+    'INDEX_REFRESH_OVERLAP': 60,
 }
 
 ##########
@@ -476,7 +606,8 @@ MAILSEND = {
     'BLACKLISTED_HEADERS': [
         X_POOL_HEADER,
         X_HTTP_DSN_RETURN_PATH_HEADER,
-        X_SMTP_DSN_RETURN_PATH_HEADER],
+        X_SMTP_DSN_RETURN_PATH_HEADER,
+        X_HTTP_DSN_RETURN_PATH_BATCHING_HEADER],
     'RELAY_POLICIES': [
         'munch.apps.transactional.policies.relay.headers.RewriteReturnPath',
         'munch_mailsend.policies.relay.headers.StripBlacklisted',